@@ -0,0 +1,105 @@
+"""
+Measures the CPU the capture uses while the AI is on, idle with a viewer
+and idle without one, and how long the first frame takes once the AI is
+switched on again. The CPU time includes the capture process.
+
+    python3 benchmark_idle.py --url http://<camera>/video --seconds 10
+"""
+import argparse
+import os
+from time import perf_counter, sleep
+
+from core.detection import BufferlessVideoCapture
+from core.shm_capture import SharedMemoryCapture
+
+MODES = [
+    ("active", None),
+    ("idle, watched", 2),
+    ("idle, unwatched", 0),
+]
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', type=str, required=True, help='the camera stream, like detection.image_url')
+    parser.add_argument('--seconds', type=float, default=10, help='how long each mode is measured')
+    parser.add_argument('--resumes', type=int, default=5, help='how often the resume latency is measured')
+    parser.add_argument('--idle_fps', type=float, default=2)
+    return parser.parse_args()
+
+
+def cpu_seconds(pids) -> float:
+    """
+    The user and system CPU seconds the processes used so far, read from
+    /proc since the capture process is still running.
+    """
+    ticks = os.sysconf('SC_CLK_TCK')
+    total = 0
+    for pid in pids:
+        with open('/proc/{}/stat'.format(pid)) as stat_file:
+            # The fields after the command, which may contain spaces.
+            fields = stat_file.read().rsplit(')', 1)[1].split()
+        total += (int(fields[11]) + int(fields[12])) / ticks
+
+    return total
+
+
+def drain(capture):
+    while capture.read(0) is not None:
+        pass
+
+
+def measure(capture, pids, args):
+    for name, max_fps in MODES:
+        if max_fps is not None and max_fps > 0:
+            max_fps = args.idle_fps
+        capture.set_max_fps(max_fps)
+        sleep(1)
+
+        start, start_cpu, frames = perf_counter(), cpu_seconds(pids), 0
+        while perf_counter() - start < args.seconds:
+            # Reads like the main loop, which only waits for frames.
+            if capture.read(0.1) is not None:
+                frames += 1
+        elapsed = perf_counter() - start
+        cpu = (cpu_seconds(pids) - start_cpu) / elapsed
+
+        latencies = []
+        if max_fps is not None:
+            for _ in range(args.resumes):
+                capture.set_max_fps(max_fps)
+                sleep(1)
+                drain(capture)
+
+                resumed = perf_counter()
+                capture.set_max_fps(None)
+                while capture.read(0.1) is None:
+                    pass
+                latencies.append(perf_counter() - resumed)
+
+        print("  {:>16}: {:5.1f} frames/s, {:5.1%} of a CPU{}".format(
+            name,
+            frames / elapsed,
+            cpu,
+            ", resumes in {:.0f} ms on average, {:.0f} ms at most".format(
+                sum(latencies) / len(latencies) * 1000, max(latencies) * 1000
+            ) if latencies else ""
+        ))
+
+
+def main():
+    args = arg_parser()
+
+    print("thread:")
+    capture = BufferlessVideoCapture(args.url)
+    measure(capture, [os.getpid()], args)
+    capture.close()
+
+    print("process:")
+    capture = SharedMemoryCapture(args.url)
+    measure(capture, [os.getpid(), capture.process.pid], args)
+    capture.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import argparse
+from time import perf_counter
+
+import cv2
+
+from benchmark_threads import percentile
+
+PATHS = ["autoshape-legacy", "autoshape-remap", "tensor-remap", "traced-remap"]
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(
+        description="Compares the per-frame latency of the YOLO input paths on a camera frame."
+    )
+    parser.add_argument('--image', type=str, required=True, help='a camera frame, as it comes from the camera')
+    parser.add_argument('--frames', type=int, default=100)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--size', type=int, default=416)
+    parser.add_argument('--bottom_blackout_height', type=int, default=0)
+    parser.add_argument('--model_dir', type=str, default='models', help='where prepare_model.py saved the artifacts')
+    parser.add_argument('--paths', type=str, nargs='*', default=PATHS, choices=PATHS)
+    return parser.parse_args()
+
+
+def main():
+    args = arg_parser()
+
+    from core.preprocess import Preprocessor
+    from core.yolov5 import TensorBackend, load_artifacts, load_model, yolov5
+
+    image = cv2.imread(args.image)
+    preprocessor = Preprocessor(args.bottom_blackout_height)
+
+    # The cold start: what main.py loads before the first frame.
+    start = perf_counter()
+    artifacts, names = load_artifacts(args.model_dir)
+    traced_backend = TensorBackend(names=names, artifacts=artifacts)
+    traced_backend.warmup()
+    print("loaded and warmed up {} artifacts in {:.2f} s".format(len(artifacts), perf_counter() - start))
+
+    start = perf_counter()
+    load_model()
+    print("loaded the torch hub model in {:.2f} s".format(perf_counter() - start))
+    backend = TensorBackend()
+
+    def legacy(frame):
+        frame = cv2.rotate(frame, cv2.ROTATE_90_CLOCKWISE)
+        height, width, _ = frame.shape
+        cv2.rectangle(frame, (0, height - args.bottom_blackout_height), (width, height), (0, 0, 0), cv2.FILLED)
+        return yolov5(frame, args.size)[2]
+
+    def remap(inference):
+        def run(frame):
+            model_input, geometry = preprocessor.process(frame, args.size)
+            return preprocessor.to_frame_boxes(inference(model_input, args.size)[2], geometry)
+        return run
+
+    runs = {
+        "autoshape-legacy": legacy,
+        "autoshape-remap": remap(yolov5),
+        "tensor-remap": remap(backend),
+        "traced-remap": remap(traced_backend),
+    }
+
+    for name in args.paths:
+        run = runs[name]
+        latencies = []
+        for i in range(args.warmup + args.frames):
+            # The camera frame is copied outside of the measurement, since
+            # the legacy path paints over it.
+            frame = image.copy()
+            start = perf_counter()
+            boxes = run(frame)
+            if i >= args.warmup:
+                latencies.append(perf_counter() - start)
+
+        print("{:>16}: p50 {:.1f} ms, p95 {:.1f} ms, {:.1f} fps, {} boxes {}".format(
+            name,
+            percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.95) * 1000,
+            len(latencies) / sum(latencies),
+            len(boxes),
+            [(box['prediction'], box['conf']) for box in boxes]
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+"""
+Simulates the approach of a single bottle to compare steering strategies.
+The robot is a differential drive with the same x/y mixing as the EV3 code,
+the camera is a pinhole camera tilted towards the ground, and detections
+and commands arrive with the configured delays. Every run starts with a
+bottle at a random position in view and ends when the steering starts the
+pickup, or after the timeout.
+
+    python3 benchmark_servo.py --runs 200
+"""
+import argparse
+import json
+import math
+import random
+
+from core.ground import GroundPlane
+from core.instructions import StartPickupInstruction
+from core.steering import ServoConfig, ThresholdSteering, VisualServo
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--fps', type=float, default=5, help='frames the detection loop processes per second')
+    parser.add_argument('--inference_latency', type=float, default=0.15, help='seconds from capture to detection')
+    parser.add_argument('--network_latency', type=float, default=0.05, help='seconds from sending to executing a command')
+    parser.add_argument('--frame_drop', type=float, default=0, help='share of frames the detection misses the bottle in')
+    parser.add_argument('--start_pickup_vdist', type=int, default=200)
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--servo', type=str, default='{}', help='ServoConfig overrides as json, e.g. {"kp": 0.8}')
+    return parser.parse_args()
+
+
+class SimulatedCamera(object):
+    """
+    A pinhole camera at the front of the robot, looking forward and tilted
+    down. Frames are portrait, like the rotated frames of the real camera.
+    """
+
+    def __init__(self, width: int = 480, height: int = 640, focal_length: float = 400, mount_height: float = 0.15,
+                 tilt: float = math.radians(30)) -> None:
+        self.width = width
+        self.height = height
+        self.focal_length = focal_length
+        self.mount_height = mount_height
+        self.tilt = tilt
+
+    def project(self, forward: float, lateral: float):
+        """
+        Returns the pixel (u, v) of a point on the ground, given in robot
+        coordinates, or None if it is out of view.
+        """
+        depth = forward * math.cos(self.tilt) + self.mount_height * math.sin(self.tilt)
+        if depth <= 0:
+            return None
+
+        down = -forward * math.sin(self.tilt) + self.mount_height * math.cos(self.tilt)
+        u = self.width / 2 + self.focal_length * lateral / depth
+        v = self.height / 2 + self.focal_length * down / depth
+
+        if not (0 <= u < self.width and 0 <= v < self.height):
+            return None
+
+        return (u, v)
+
+    def ground_homography(self):
+        """
+        The pixel to floor homography a perfect calibration would measure:
+        the inverse of the projection above, which maps (forward, lateral, 1)
+        to (u, v, 1) up to scale.
+        """
+        cos_tilt, sin_tilt = math.cos(self.tilt), math.sin(self.tilt)
+        projection = [
+            [self.width / 2 * cos_tilt, self.focal_length, self.width / 2 * self.mount_height * sin_tilt],
+            [self.height / 2 * cos_tilt - self.focal_length * sin_tilt, 0,
+             self.height / 2 * self.mount_height * sin_tilt + self.focal_length * self.mount_height * cos_tilt],
+            [cos_tilt, 0, self.mount_height * sin_tilt],
+        ]
+        return invert(projection)
+
+
+def invert(m):
+    """
+    Inverts a 3x3 matrix by its adjugate.
+    """
+    cofactors = [
+        [
+            m[(i + 1) % 3][(j + 1) % 3] * m[(i + 2) % 3][(j + 2) % 3] -
+            m[(i + 1) % 3][(j + 2) % 3] * m[(i + 2) % 3][(j + 1) % 3]
+            for j in range(3)
+        ]
+        for i in range(3)
+    ]
+    determinant = sum(m[0][j] * cofactors[0][j] for j in range(3))
+    return [[cofactors[j][i] / determinant for j in range(3)] for i in range(3)]
+
+
+class SimulatedRobot(object):
+    """
+    Differential drive with the x/y mixing of Robot.moving_in_coord. A
+    trajectory is followed segment by segment, and the robot stops at its
+    end like the EV3 does.
+    """
+
+    def __init__(self, max_wheel_speed: float = 0.5, wheel_base: float = 0.16) -> None:
+        self.max_wheel_speed = max_wheel_speed
+        self.wheel_base = wheel_base
+        self.x = 0
+        self.y = 0
+        self.heading = 0
+        self.command = (0, 0)
+        self.trajectory = None
+        self.trajectory_start = 0
+
+    def execute(self, metadata: dict, t: float):
+        if "segments" in metadata:
+            self.trajectory = metadata["segments"]
+            self.trajectory_start = t
+        else:
+            self.trajectory = None
+            self.command = (metadata["x"], metadata["y"])
+
+    def step(self, dt: float, t: float):
+        if self.trajectory is not None:
+            self.command = (0, 0)
+            elapsed = t - self.trajectory_start
+            for duration, x, y in self.trajectory:
+                if elapsed < duration:
+                    self.command = (x, y)
+                    break
+                elapsed -= duration
+
+        x, y = self.command
+        left, right = y + x, y - x
+        largest = max(abs(left), abs(right))
+        if largest > 1:
+            left, right = left / largest, right / largest
+
+        left *= self.max_wheel_speed
+        right *= self.max_wheel_speed
+
+        speed = (left + right) / 2
+        # Positive x turns right, which is clockwise seen from above.
+        self.heading -= (left - right) / self.wheel_base * dt
+        self.x += speed * math.cos(self.heading) * dt
+        self.y += speed * math.sin(self.heading) * dt
+
+    def to_robot_frame(self, world_x: float, world_y: float):
+        dx, dy = world_x - self.x, world_y - self.y
+        forward = dx * math.cos(self.heading) + dy * math.sin(self.heading)
+        # Lateral is positive to the right of the robot.
+        lateral = dx * math.sin(self.heading) - dy * math.cos(self.heading)
+        return (forward, lateral)
+
+
+def run_approach(steering, camera: SimulatedCamera, bottle, args, rng: random.Random, dt: float = 0.01):
+    """
+    Returns (seconds until pickup or None on timeout, commands sent, pickup
+    error in meters from the center of the robot front).
+    """
+    robot = SimulatedRobot()
+    steering.reset()
+
+    frame_interval = 1 / args.fps
+    pending = []  # (time to execute, command)
+    commands = 0
+    t = 0
+    next_frame = 0
+
+    while t < args.timeout:
+        if t >= next_frame:
+            next_frame += frame_interval
+            # The frame shows the world as it was when it was captured, and
+            # the instruction goes out once inference has finished.
+            pixel = camera.project(*robot.to_robot_frame(*bottle))
+            decided_at = t + args.inference_latency
+            if pixel is not None and rng.random() >= args.frame_drop:
+                u, v = pixel
+                hdistance = camera.width // 2 - int(u)
+                vdistance = camera.height - int(v)
+                instruction = steering.get_instruction(hdistance, vdistance, camera.width, camera.height, decided_at)
+
+                if isinstance(instruction, StartPickupInstruction):
+                    forward, lateral = robot.to_robot_frame(*bottle)
+                    return (decided_at, commands, math.hypot(forward, lateral))
+
+                if instruction is not None:
+                    commands += 1
+                    metadata = json.loads(instruction.serialize())["metadata"]
+                    pending.append((decided_at + args.network_latency, metadata))
+
+        while len(pending) > 0 and pending[0][0] <= t:
+            robot.execute(pending.pop(0)[1], t)
+
+        robot.step(dt, t)
+        t += dt
+
+    return (None, commands, None)
+
+
+def random_bottle(camera: SimulatedCamera, rng: random.Random):
+    while True:
+        forward = rng.uniform(0.4, 2.0)
+        lateral = rng.uniform(-0.6, 0.6) * forward
+        if camera.project(forward, lateral) is not None:
+            return (forward, -lateral)
+
+
+def main():
+    args = arg_parser()
+    camera = SimulatedCamera()
+    strategies = {
+        'threshold': ThresholdSteering(args.start_pickup_vdist),
+        'pid': VisualServo(args.start_pickup_vdist, ServoConfig(**json.loads(args.servo))),
+        'metric': VisualServo(
+            args.start_pickup_vdist,
+            ServoConfig(**json.loads(args.servo)),
+            GroundPlane(camera.ground_homography())
+        ),
+        'trajectory': VisualServo(
+            args.start_pickup_vdist,
+            ServoConfig(**dict({"plan_horizon": 1.0}, **json.loads(args.servo))),
+            GroundPlane(camera.ground_homography())
+        ),
+    }
+
+    rng = random.Random(args.seed)
+    bottles = [random_bottle(camera, rng) for _ in range(args.runs)]
+
+    for name, steering in strategies.items():
+        times, commands, errors = [], [], []
+        # The same missed frames for every strategy.
+        drops = random.Random(args.seed)
+        for bottle in bottles:
+            duration, sent, error = run_approach(steering, camera, bottle, args, drops)
+            commands.append(sent)
+            if duration is not None:
+                times.append(duration)
+                errors.append(error)
+
+        times.sort()
+        mean_error = sum(errors) / len(errors) if errors else float("nan")
+        print("{:>9}: {}/{} picked up, time-to-pickup mean {:.1f} s, p90 {:.1f} s, "
+              "commands-per-pickup {:.1f}, grab distance {:.2f} m (sd {:.3f} m)".format(
+                  name,
+                  len(times),
+                  len(bottles),
+                  sum(times) / len(times) if times else float("nan"),
+                  times[int(len(times) * 0.9)] if times else float("nan"),
+                  sum(commands) / len(commands),
+                  mean_error,
+                  math.sqrt(sum((error - mean_error) ** 2 for error in errors) / len(errors)) if errors else float("nan")
+              ))
+
+
+if __name__ == "__main__":
+    main()
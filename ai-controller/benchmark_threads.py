@@ -0,0 +1,133 @@
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+from time import perf_counter
+
+RESULT_PREFIX = "RESULT "
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(
+        description="Sweeps torch and OpenCV thread counts and reports the fastest configuration for this host."
+    )
+    parser.add_argument('--image', type=str, required=True, help='a camera frame to run the pipeline on')
+    parser.add_argument('--frames', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--size', type=int, default=416)
+    parser.add_argument('--torch_threads', type=int, nargs='*', default=None)
+    parser.add_argument('--torch_interop_threads', type=int, nargs='*', default=[1, 2])
+    parser.add_argument('--opencv_threads', type=int, nargs='*', default=[1, 2])
+    parser.add_argument('--inference_cpus', type=int, nargs='*', default=None,
+                        help='pin the benchmark to these CPUs, like threads.inference_cpus in config.yml')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def default_thread_counts():
+    cpu_count = os.cpu_count() or 1
+    counts = [1]
+    while counts[-1] * 2 <= cpu_count:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != cpu_count:
+        counts.append(cpu_count)
+    return counts
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run_worker(args):
+    """
+    Runs the per-frame work of the main loop with a single thread
+    configuration. Torch only accepts the inter-op thread count once per
+    process, which is why every configuration gets its own worker.
+    """
+    import cv2
+    from core.threads import ThreadConfig, configure_thread_pools, pin_current_thread
+
+    pin_current_thread(args.inference_cpus)
+    configure_thread_pools(ThreadConfig(
+        args.torch_threads[0],
+        args.torch_interop_threads[0],
+        args.opencv_threads[0]
+    ))
+
+    from core.yolov5 import yolov5
+
+    image = cv2.imread(args.image)
+    latencies = []
+    for i in range(args.warmup + args.frames):
+        start = perf_counter()
+        frame = cv2.rotate(image, cv2.ROTATE_90_CLOCKWISE)
+        yolov5(frame, args.size)
+        cv2.imencode('.jpg', frame)
+        if i >= args.warmup:
+            latencies.append(perf_counter() - start)
+
+    print(RESULT_PREFIX + json.dumps({
+        'fps': len(latencies) / sum(latencies),
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+    }))
+
+
+def run_sweep(args):
+    torch_threads = args.torch_threads or default_thread_counts()
+    results = []
+
+    for threads, interop, opencv in itertools.product(torch_threads, args.torch_interop_threads, args.opencv_threads):
+        command = [
+            sys.executable, os.path.realpath(__file__), '--worker',
+            '--image', args.image,
+            '--frames', str(args.frames),
+            '--warmup', str(args.warmup),
+            '--size', str(args.size),
+            '--torch_threads', str(threads),
+            '--torch_interop_threads', str(interop),
+            '--opencv_threads', str(opencv),
+        ]
+        if args.inference_cpus:
+            command += ['--inference_cpus'] + [str(cpu) for cpu in args.inference_cpus]
+        output = subprocess.run(
+            command,
+            cwd=os.path.dirname(os.path.realpath(__file__)),
+            stdout=subprocess.PIPE,
+            universal_newlines=True
+        ).stdout
+
+        lines = [line for line in output.splitlines() if line.startswith(RESULT_PREFIX)]
+        if len(lines) == 0:
+            print("torch={} interop={} opencv={}: worker failed".format(threads, interop, opencv))
+            continue
+
+        result = json.loads(lines[-1][len(RESULT_PREFIX):])
+        result.update({'torch_threads': threads, 'torch_interop_threads': interop, 'opencv_threads': opencv})
+        results.append(result)
+        print("torch={torch_threads} interop={torch_interop_threads} opencv={opencv_threads}: "
+              "{fps:.1f} fps, p50 {p50_ms:.1f} ms, p95 {p95_ms:.1f} ms".format(**result))
+
+    if len(results) == 0:
+        return
+
+    best_throughput = max(results, key=lambda result: result['fps'])
+    best_latency = min(results, key=lambda result: result['p95_ms'])
+
+    print("\nBest throughput: {:.1f} fps, best p95 latency: {:.1f} ms".format(
+        best_throughput['fps'], best_latency['p95_ms']))
+    print("Add this to config.yml for the best throughput:")
+    print("threads:")
+    for key in ['torch_threads', 'torch_interop_threads', 'opencv_threads']:
+        print("  {}: {}".format(key, best_throughput[key]))
+
+
+if __name__ == "__main__":
+    args = arg_parser()
+    if args.worker:
+        run_worker(args)
+    else:
+        run_sweep(args)
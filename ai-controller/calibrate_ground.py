@@ -0,0 +1,116 @@
+"""
+Measures the homography from pixels of the rotated camera frame to the
+floor, which lets the steering work with the metric distance to a bottle.
+Put at least four markers on the floor in front of the robot, measure
+where they are in meters (forward from the front of the robot, and to the
+right of its center line, negative to the left), then click them in the
+same order in the window. Enter finishes, Backspace removes the last click.
+
+    python3 calibrate_ground.py --url http://<camera>/video --ground 0.2,0 0.2,0.15 0.5,-0.2 0.5,0.2 0.8,0
+
+The camera must not move after the calibration, and the result is printed
+as the ground section of config.yml.
+"""
+import argparse
+
+import cv2
+import numpy as np
+
+KEY_ENTER = 13
+KEY_BACKSPACE = 8
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', type=str, default=None, help='the camera stream, like detection.image_url')
+    parser.add_argument('--image', type=str, default=None, help='a camera frame, as it comes from the camera')
+    parser.add_argument('--ground', type=str, nargs='+', required=True,
+                        help='the markers on the floor as forward,lateral in meters')
+    parser.add_argument('--pixels', type=str, nargs='*', default=None,
+                        help='the markers in the rotated frame as u,v, instead of clicking them')
+    return parser.parse_args()
+
+
+def parse_points(points):
+    return [tuple(float(value) for value in point.split(',')) for point in points]
+
+
+def read_frame(args):
+    if args.image is not None:
+        frame = cv2.imread(args.image)
+    else:
+        ret, frame = cv2.VideoCapture(args.url).read()
+        frame = frame if ret else None
+
+    if frame is None:
+        raise IOError("Could not read a frame")
+
+    # The same rotation as the detection pipeline, whose pixels are mapped.
+    return cv2.rotate(frame, cv2.ROTATE_90_CLOCKWISE)
+
+
+def click_points(frame, ground):
+    pixels = []
+
+    def on_mouse(event, x, y, flags, param):
+        if event == cv2.EVENT_LBUTTONDOWN and len(pixels) < len(ground):
+            pixels.append((x, y))
+
+    cv2.namedWindow("calibration")
+    cv2.setMouseCallback("calibration", on_mouse)
+
+    while True:
+        preview = frame.copy()
+        for i, (u, v) in enumerate(pixels):
+            cv2.circle(preview, (u, v), 4, (0, 0, 255), cv2.FILLED)
+            cv2.putText(preview, "{:g}, {:g}".format(*ground[i]), (u + 6, v - 6), cv2.FONT_HERSHEY_SIMPLEX, 0.5,
+                        (0, 0, 255), 1)
+        if len(pixels) < len(ground):
+            cv2.putText(preview, "click the marker at {:g}, {:g}".format(*ground[len(pixels)]), (10, 20),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 2)
+        cv2.imshow("calibration", preview)
+
+        key = cv2.waitKey(30) & 0xFF
+        if key == KEY_ENTER and len(pixels) == len(ground):
+            break
+        if key == KEY_BACKSPACE and len(pixels) > 0:
+            pixels.pop()
+
+    cv2.destroyAllWindows()
+    return pixels
+
+
+def main():
+    args = arg_parser()
+    ground = parse_points(args.ground)
+    if len(ground) < 4:
+        print("At least four markers are needed.")
+        return
+
+    if args.pixels is not None:
+        pixels = parse_points(args.pixels)
+    else:
+        pixels = click_points(read_frame(args), ground)
+    if len(pixels) != len(ground):
+        print("Got {} pixels for {} markers.".format(len(pixels), len(ground)))
+        return
+
+    homography, _ = cv2.findHomography(np.array(pixels, dtype=np.float64), np.array(ground, dtype=np.float64))
+    if homography is None:
+        print("The markers do not determine a homography, are three of them on a line?")
+        return
+
+    print("Error per marker:")
+    for (u, v), (forward, lateral) in zip(pixels, ground):
+        x, y, w = homography @ np.array([u, v, 1])
+        print("  {:g}, {:g}: {:.1f} cm".format(forward, lateral, np.hypot(x / w - forward, y / w - lateral) * 100))
+
+    print("\nAdd this to config.yml:")
+    print("ground:")
+    print("  homography: [{}]".format(", ".join(
+        "[{}]".format(", ".join("{:.8g}".format(value) for value in row)) for row in homography
+    )))
+
+
+if __name__ == "__main__":
+    main()
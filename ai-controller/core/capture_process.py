@@ -0,0 +1,102 @@
+"""
+The capture process of SharedMemoryCapture, which starts it as
+
+    python -m core.capture_process <stream> <lock file> <slots> [<cpu>,<cpu>,...]
+
+It only imports what decoding needs, not torch. See SharedMemoryCapture for
+how it talks to the inference process.
+"""
+import logging
+import os
+import sys
+from multiprocessing import resource_tracker, shared_memory
+from time import perf_counter
+
+import cv2
+
+from core.mjpeg import open_capture
+from core.shm_capture import UNLIMITED_FPS, FileLock, SharedFrameRing
+from core.threads import pin_current_thread
+
+logger = logging.getLogger(__name__)
+
+STDOUT = 1
+
+
+def notify():
+    """
+    Tells the inference process a frame was published. A full pipe already
+    holds notifications it has not read, so the byte is not needed then.
+    """
+    try:
+        os.write(STDOUT, b".")
+    except BlockingIOError:
+        pass
+
+
+def run_capture(name, lock_path: str, slots: int, cpus):
+    """
+    Decodes the stream in its own process, so decoding neither competes with
+    the inference process for the GIL nor for its cores. The ring is sized
+    from the first frame, frames of another size are resized to it. Like
+    BufferlessVideoCapture, frames beyond max_fps are grabbed but not
+    decoded. Stops when the stream ends or the inference process is gone.
+    """
+    pin_current_thread(cpus)
+    parent = os.getppid()
+    cap = open_capture(name)
+    ret, frame = cap.read()
+    if not ret:
+        logger.error("Could not read from %s", name)
+        return
+
+    os.write(STDOUT, "{}\n".format(" ".join(str(value) for value in frame.shape)).encode())
+    memory = shared_memory.SharedMemory(name=sys.stdin.readline().strip())
+    # The inference process owns the memory and unlinks it, the resource
+    # tracker of this process would unlink it as well when it exits.
+    resource_tracker.unregister(memory._name, "shared_memory")
+    lock = FileLock(lock_path)
+    ring = SharedFrameRing(memory, frame.shape, slots, lock)
+    height, width, _ = frame.shape
+    last_decode = 0
+    os.set_blocking(STDOUT, False)
+
+    try:
+        while ret:
+            if frame.shape != ring.shape:
+                frame = cv2.resize(frame, (width, height))
+            ring.write(frame)
+            notify()
+
+            while True:
+                if os.getppid() != parent or not cap.grab():
+                    return
+
+                limit = ring.max_fps[0]
+                if limit == UNLIMITED_FPS:
+                    break
+                now = perf_counter()
+                if limit > 0 and now - last_decode >= 1 / limit:
+                    last_decode = now
+                    break
+
+            ret, frame = cap.retrieve()
+    except BrokenPipeError:
+        # The inference process closed its end.
+        pass
+    finally:
+        ring.frames = None
+        ring.header = None
+        ring.max_fps = None
+        memory.close()
+        lock.close()
+
+
+def main():
+    name = sys.argv[1]
+    cpus = [int(cpu) for cpu in sys.argv[4].split(",")] if len(sys.argv) > 4 else None
+    run_capture(int(name) if name.isdigit() else name, sys.argv[2], int(sys.argv[3]), cpus)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,69 @@
 import cv2
 import queue
 import threading
+from time import perf_counter, time
 from typing import Tuple
 from core.instructions import *
+from core.metrics import REGISTRY
+from core.mjpeg import open_capture
+from core.motion_gate import MotionGate
+from core.overlay import DetectionResult
+from core.preprocess import Preprocessor
+from core.resolution import ResolutionController
+from core.steering import Steering, ThresholdSteering
+from core.targeting import TargetSelector
+from core.telemetry import RangeFusion
+from core.threads import pin_current_thread
 from core.yolov5 import yolov5
 
+captured_counter = REGISTRY.counter("frames_captured", "Frames decoded from the camera stream")
+dropped_counter = REGISTRY.counter("frames_dropped", "Decoded frames replaced by a newer one before they were processed")
+inference_histogram = REGISTRY.histogram("inference_seconds", "Time spent in YOLO inference per frame")
+
+DEFAULT_INPUT_SIZE = 416
+
 class DetectionConfig(object):
     """
     The configuration for the detection feature of the system.
     """
 
-    def __init__(self, image_url: str, failed_detection_threshold: int, bottom_blackout_height: int, start_pickup_vdist: int):
+    def __init__(self, image_url: str, failed_detection_threshold: int, bottom_blackout_height: int, start_pickup_vdist: int,
+                 target_policy: str = "nearest", max_target_jump: int = 80, input_sizes: list = None,
+                 latency_budget_ms: float = 150, near_vdist: int = 150, marginal_conf: float = 0.8,
+                 motion_threshold: float = 2.0, max_reused_frames: int = 15, steering: str = "pid",
+                 preprocessing: str = "remap", camera_matrix: list = None, dist_coeffs: list = None,
+                 backend: str = "tensor", model_dir: str = "models", capture: str = "process",
+                 capture_slots: int = 3, fusion_range: float = None):
         self.image_url = image_url
         self.failed_detection_threshold = failed_detection_threshold
         self.bottom_blackout_height = bottom_blackout_height
         self.start_pickup_vdist = self.bottom_blackout_height + start_pickup_vdist
+        self.target_policy = target_policy
+        self.max_target_jump = max_target_jump
+        self.input_sizes = input_sizes if input_sizes is not None else [256, 320, 416]
+        self.latency_budget = latency_budget_ms / 1000
+        self.near_vdist = self.bottom_blackout_height + near_vdist
+        self.marginal_conf = marginal_conf
+        self.motion_threshold = motion_threshold
+        self.max_reused_frames = max_reused_frames
+        self.steering = steering
+        self.preprocessing = preprocessing
+        self.camera_matrix = camera_matrix
+        self.dist_coeffs = dist_coeffs
+        self.backend = backend
+        self.model_dir = model_dir
+        self.capture = capture
+        self.capture_slots = capture_slots
+        self.fusion_range = fusion_range
 
 class BufferlessVideoCapture:
 
-    def __init__(self, name):
-        self.cap = cv2.VideoCapture(name)
+    def __init__(self, name, cpus=None):
+        self.cap = open_capture(name)
+        self.cpus = cpus
+        # None decodes every frame, 0 none, see set_max_fps.
+        self.max_fps = None
+        self.stopped = False
         self.q = queue.Queue()
         t = threading.Thread(target=self._reader)
         t.daemon = True
@@ -30,27 +74,80 @@ class BufferlessVideoCapture:
         Read frames from the video capture as soon as they become available. We
         only keep track of the latest frame of the capture.
         """
-        while True:
-            ret, frame = self.cap.read()
+        pin_current_thread(self.cpus)
+        last_decode = 0
+
+        while not self.stopped:
+            # Grabbing keeps reading the stream, so it is current when
+            # decoding resumes, decoding is what costs. An MJPEG stream only
+            # decodes in retrieve, see open_capture.
+            if not self.cap.grab():
+                break
+
+            max_fps = self.max_fps
+            if max_fps is not None:
+                now = perf_counter()
+                if max_fps <= 0 or now - last_decode < 1 / max_fps:
+                    continue
+                last_decode = now
+
+            ret, frame = self.cap.retrieve()
             if not ret:
                 break
+            captured_counter.inc()
             if not self.q.empty():
                 try:
                     self.q.get_nowait()   # discard previous (unprocessed) frame
+                    dropped_counter.inc()
                 except queue.Empty:
                     pass
 
             self.q.put(frame)
 
-    def read(self):
-        return self.q.get()
+        self.cap.release()
+
+    def read(self, timeout: float = None):
+        """
+        Returns the latest frame, or None if none was decoded within the
+        timeout.
+        """
+        try:
+            return self.q.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def set_max_fps(self, max_fps: float = None):
+        """
+        Limits how many frames per second are decoded, None decodes every
+        frame and 0 pauses decoding while the stream keeps being read.
+        """
+        self.max_fps = max_fps
+
+    def close(self):
+        # The reader thread releases the capture once it sees this.
+        self.stopped = True
 
 
 class BottleDetector(object):
 
-    def __init__(self, failed_detection_threshold: int, start_pickup_vdist: int) -> None:
+    def __init__(self, failed_detection_threshold: int, start_pickup_vdist: int, target_selector: TargetSelector = None,
+                 resolution_controller: ResolutionController = None, motion_gate: MotionGate = None,
+                 steering: Steering = None, preprocessor: Preprocessor = None, inference=None,
+                 fusion: RangeFusion = None) -> None:
         self.failed_detection_threshold = failed_detection_threshold
         self.start_pickup_vdist = start_pickup_vdist
+        self.steering = steering if steering is not None else ThresholdSteering(start_pickup_vdist)
+        self.target_selector = target_selector if target_selector is not None else TargetSelector()
+        self.resolution_controller = resolution_controller
+        self.motion_gate = motion_gate
+        # With a preprocessor, get_instruction takes the camera frames as
+        # they are, otherwise rotated and with the bottom blacked out.
+        self.preprocessor = preprocessor
+        # Called like yolov5(frame, size), e.g. a TensorBackend.
+        self.inference = inference if inference is not None else yolov5
+        self.fusion = fusion
+        self.last_detection = None
+        self.last_result = None
         self.initialize()
 
 
@@ -58,6 +155,14 @@ class BottleDetector(object):
         self.failed_detections = 0
         self.is_roaming = True
         self.is_picking_up = False
+        self.target_selector.reset()
+        self.steering.reset()
+        if self.resolution_controller is not None:
+            self.resolution_controller.initialize()
+        if self.motion_gate is not None:
+            self.motion_gate.initialize()
+        if self.fusion is not None:
+            self.fusion.reset()
 
     def get_distance(self, box, frame_width: int, frame_height: int) -> Tuple[float, float]:
         xmin, xmax, ymax = int(box['xmin']), int(box['xmax']), int(box['ymax'])
@@ -69,63 +174,83 @@ class BottleDetector(object):
 
         return (horizontal_distance, vertical_distance)
 
-    def get_instruction_from_distance(self, hdistance, vdistance):
-        if vdistance < self.start_pickup_vdist and abs(hdistance) < 10:
-            self.is_picking_up = True
-            return StartPickupInstruction()
-
-        if hdistance > 10:
-            return TurnLeftInstruction(hdistance)
+    def get_instruction_from_distance(self, hdistance, vdistance, frame_width, frame_height):
+        instruction = self.steering.get_instruction(hdistance, vdistance, frame_width, frame_height, time())
 
-        elif hdistance < -10:
-            return TurnRightInstruction(hdistance)
-
-        else:
-            return MoveForwardInstruction()
-
-    def draw_labels(self, boxes, width, height, img):
-        font = cv2.FONT_HERSHEY_PLAIN
-        for i in range(len(boxes)):
-            xmin, ymin, xmax, ymax, conf, label = boxes[i]['xmin'], boxes[i]['ymin'], boxes[i]['xmax'], \
-                                                  boxes[i]['ymax'], boxes[i]['conf'], boxes[i]['prediction']
-            xmin = int(xmin)
-            ymin = int(ymin)
-            xmax = int(xmax)
-            ymax = int(ymax)
-
-            cv2.rectangle(img, (xmin, ymin), (xmax, ymax), (255, 0, 0), 2)
-            cv2.putText(img, f"{label} {conf}", (xmin, ymin), font, 1, (255, 0, 0), 1)
-            box_center_bottom_x = xmin + (xmax - xmin) // 2
-            cv2.line(img, (width // 2, ymax), (width // 2, height), (255, 255, 255), 2, 8)  # bottom image center line
-            cv2.line(img, (box_center_bottom_x, ymax), (width // 2, height), (255, 255, 0), 2, 8)  # box center line
+        if isinstance(instruction, StartPickupInstruction):
+            self.is_picking_up = True
 
-            cv2.putText(img, f"bottom right corner distance {width // 2 - box_center_bottom_x} ", (0, height), font, 1,
-                        (255, 0, 0), 2)
-        return img
+        return instruction
 
     def get_instruction(self, frame):
+        """
+        Runs detection on the frame and returns the instruction for the robot,
+        if any. The frame is not modified, the detections are kept in
+        last_result for the viewers.
+        """
         if self.is_picking_up:
-            return (None, frame)
+            self.last_result = None
+            return None
 
-        frame_width, frame_height, boxes = yolov5(frame)
-        frame = self.draw_labels(boxes, frame_width, frame_height, frame)
+        frame_width, frame_height, boxes = self.__detect(frame)
 
+        target = self.target_selector.select(boxes, frame_width, frame_height)
+        self.last_result = DetectionResult(boxes, frame_width, frame_height, target)
         instruction = None
 
-        if self.is_roaming and len(boxes) == 1:
+        if self.is_roaming and target is not None:
             self.is_roaming = False
             instruction = StopRoamingInstruction()
 
-        elif not self.is_roaming and len(boxes) == 1:
-            hdistance, vdistance = self.get_distance(boxes[0], frame_width, frame_height)
-            instruction = self.get_instruction_from_distance(hdistance, vdistance)
+        elif not self.is_roaming and target is not None:
+            self.failed_detections = 0
+            if self.target_selector.switched:
+                self.steering.reset()
+                if self.fusion is not None:
+                    self.fusion.reset()
+
+            hdistance, vdistance = self.get_distance(target, frame_width, frame_height)
+            if self.fusion is not None and self.fusion.confirms(hdistance, vdistance, frame_width, frame_height):
+                self.is_picking_up = True
+                instruction = StartPickupInstruction()
+            else:
+                instruction = self.get_instruction_from_distance(hdistance, vdistance, frame_width, frame_height)
 
         elif self.failed_detections >= self.failed_detection_threshold:
             self.failed_detections = 0
             self.is_roaming = True
+            self.target_selector.reset()
             instruction = StartRoamingInstruction()
 
-        elif not self.is_roaming and len(boxes) != 1:
+        elif not self.is_roaming:
             self.failed_detections += 1
 
-        return (instruction, frame)
+        if self.resolution_controller is not None:
+            self.resolution_controller.update(boxes, frame_height, self.is_roaming)
+
+        return instruction
+
+    def __detect(self, frame):
+        size = self.resolution_controller.size if self.resolution_controller is not None else DEFAULT_INPUT_SIZE
+
+        geometry = None
+        if self.preprocessor is not None:
+            frame, geometry = self.preprocessor.process(frame, size)
+
+        if self.motion_gate is not None and not self.motion_gate.should_infer(frame) \
+                and self.last_detection is not None:
+            return self.last_detection
+
+        start = perf_counter()
+        frame_width, frame_height, boxes = self.inference(frame, size)
+        latency = perf_counter() - start
+        inference_histogram.record(latency)
+        if self.resolution_controller is not None:
+            self.resolution_controller.record_latency(size, latency)
+
+        if geometry is not None:
+            frame_width, frame_height = geometry.frame_width, geometry.frame_height
+            boxes = self.preprocessor.to_frame_boxes(boxes, geometry)
+
+        self.last_detection = (frame_width, frame_height, boxes)
+        return self.last_detection
@@ -0,0 +1,46 @@
+from math import atan2, hypot
+from typing import List
+
+
+class GroundPlane(object):
+    """
+    Maps pixels of the rotated camera frame to points on the floor, with the
+    homography calibrate_ground.py measures. Points are in meters in front
+    of (forward) and to the right of (lateral) the robot. This only holds
+    for pixels showing the floor, which the bottom center of a bottle's box
+    does.
+    """
+
+    def __init__(self, homography: List[List[float]]) -> None:
+        self.homography = homography
+
+    def to_ground(self, u: float, v: float):
+        """
+        Returns the (forward, lateral) floor point shown at pixel (u, v), or
+        None if the pixel is above the horizon.
+        """
+        h = self.homography
+        w = h[2][0] * u + h[2][1] * v + h[2][2]
+        if w == 0:
+            return None
+
+        forward = (h[0][0] * u + h[0][1] * v + h[0][2]) / w
+        lateral = (h[1][0] * u + h[1][1] * v + h[1][2]) / w
+        # Pixels above the horizon map to points behind the camera.
+        if forward <= 0:
+            return None
+
+        return (forward, lateral)
+
+    def range_bearing(self, u: float, v: float):
+        """
+        Returns the distance in meters and the bearing in radians (positive
+        to the right) of the floor point at pixel (u, v), or None if the
+        pixel is above the horizon.
+        """
+        point = self.to_ground(u, v)
+        if point is None:
+            return None
+
+        forward, lateral = point
+        return (hypot(forward, lateral), atan2(lateral, forward))
@@ -1,11 +1,28 @@
 from abc import ABC, abstractmethod
 import json
 from math import dist
+from time import time
 
 SPEED = 0.2
+# Seconds a movement stays valid after it was sent. The robot drops
+# movements that arrive later than this, e.g. after a Wi-Fi stall.
+MOVE_VALID_FOR = 0.5
 
 class Instruction(ABC):
 
+    # The MQTT QoS the instruction is published with. Movements are sent
+    # every frame, so losing one is cheaper than the acknowledgement.
+    qos = 0
+    # Whether only the latest of these instructions matters when they pile up
+    # while the connection is down.
+    coalesce = True
+    # The controller state the robot is in after this instruction, if it
+    # changes it.
+    mode = None
+    # Seconds after sending during which the robot may still execute the
+    # instruction, None if it never expires.
+    valid_for = MOVE_VALID_FOR
+
     @abstractmethod
     def serialize(self) -> str:
         """
@@ -14,6 +31,17 @@ class Instruction(ABC):
         """
         pass
 
+    def to_message(self, contents: dict) -> str:
+        """
+        Stamps the contents with the send time and, if the instruction
+        expires, the deadline for executing it.
+        """
+        message = dict(contents, sent_at=time())
+        if self.valid_for is not None:
+            message["deadline"] = message["sent_at"] + self.valid_for
+
+        return json.dumps(message)
+
 
 class TurnLeftInstruction(Instruction):
 
@@ -32,7 +60,7 @@ class TurnLeftInstruction(Instruction):
             self.contents["metadata"]["x"] = -distance / 100 * SPEED
 
     def serialize(self) -> str:
-        return json.dumps(self.contents)
+        return self.to_message(self.contents)
 
 
 class TurnRightInstruction(Instruction):
@@ -53,7 +81,7 @@ class TurnRightInstruction(Instruction):
 
 
     def serialize(self) -> str:
-        return json.dumps(self.contents)
+        return self.to_message(self.contents)
 
 
 class MoveForwardInstruction(Instruction):
@@ -67,10 +95,52 @@ class MoveForwardInstruction(Instruction):
     }
 
     def serialize(self) -> str:
-        return json.dumps(self.contents)
+        return self.to_message(self.contents)
+
+
+class MoveInstruction(Instruction):
+    """
+    Steers (x) and drives (y) at the same time.
+    """
+
+    def __init__(self, x: float, y: float) -> None:
+        self.contents = {
+            "command": "move",
+            "metadata": {
+                "x": round(x, 3),
+                "y": round(y, 3)
+            }
+        }
+
+    def serialize(self) -> str:
+        return self.to_message(self.contents)
+
+
+class TrajectoryInstruction(Instruction):
+    """
+    A short plan of moves the robot drives through on its own, as segments
+    of (duration in seconds, x, y). A new plan replaces the one the robot is
+    following, and the robot stops at the end of the plan.
+    """
+
+    def __init__(self, segments: list) -> None:
+        self.contents = {
+            "command": "trajectory",
+            "metadata": {
+                "segments": [[round(duration, 3), round(x, 3), round(y, 3)] for duration, x, y in segments]
+            }
+        }
+
+    def serialize(self) -> str:
+        return self.to_message(self.contents)
 
 
 class StopRoamingInstruction(Instruction):
+    qos = 1
+    coalesce = False
+    valid_for = None
+    mode = "commands"
+
     contents = {
         "command": "switch_state",
         "metadata": {
@@ -79,9 +149,14 @@ class StopRoamingInstruction(Instruction):
     }
 
     def serialize(self) -> str:
-        return json.dumps(self.contents)
+        return self.to_message(self.contents)
 
 class StartRoamingInstruction(Instruction):
+    qos = 1
+    coalesce = False
+    valid_for = None
+    mode = "roaming"
+
     contents = {
         "command": "switch_state",
         "metadata": {
@@ -90,10 +165,15 @@ class StartRoamingInstruction(Instruction):
     }
 
     def serialize(self) -> str:
-        return json.dumps(self.contents)
+        return self.to_message(self.contents)
 
 
 class StartPickupInstruction(Instruction):
+    qos = 1
+    coalesce = False
+    valid_for = None
+    mode = "grabbing"
+
     contents = {
         "command": "switch_state",
         "metadata": {
@@ -102,4 +182,4 @@ class StartPickupInstruction(Instruction):
     }
 
     def serialize(self) -> str:
-        return json.dumps(self.contents)
+        return self.to_message(self.contents)
@@ -0,0 +1,88 @@
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from threading import Lock
+from time import monotonic
+
+
+class LoggingConfig(object):
+    """
+    The log level and how many records per second each message may produce.
+    """
+
+    def __init__(self, level: str = "INFO", rate: float = 1, burst: int = 5) -> None:
+        self.level = logging.getLevelName(level.upper())
+        self.rate = rate
+        self.burst = burst
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most `rate` records per second (with bursts of up to
+    `burst`) for every distinct message template, and drops the rest. The
+    next record that passes mentions how many were dropped.
+    """
+
+    def __init__(self, rate: float = 1, burst: int = 5) -> None:
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.lock = Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = (record.name, record.msg)
+        now = monotonic()
+
+        with self.lock:
+            tokens, last, suppressed = self.buckets.get(key, (self.burst, now, 0))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+
+            if tokens < 1:
+                self.buckets[key] = (tokens, now, suppressed + 1)
+                return False
+
+            self.buckets[key] = (tokens - 1, now, 0)
+
+        if suppressed > 0:
+            record.msg = "{} ({} similar messages suppressed)".format(record.msg, suppressed)
+
+        return True
+
+
+_listener = None
+
+
+def start_logging(level: int = logging.INFO, rate: float = 1, burst: int = 5) -> None:
+    """
+    Routes all logging through a queue that a background thread writes to the
+    console, so logging never blocks the caller on console output. Records
+    are rate limited before they are queued.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    log_queue = queue.Queue(-1)
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter(rate, burst))
+
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter("%(asctime)s %(name)s %(levelname)s: %(message)s"))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(queue_handler)
+
+    _listener = QueueListener(log_queue, console_handler)
+    _listener.start()
+
+
+def stop_logging() -> None:
+    """
+    Writes out the queued records and stops the background thread.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,125 @@
+import http.client
+import logging
+import urllib.request
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MJPEG_CONTENT_TYPE = "multipart/x-mixed-replace"
+CONNECT_TIMEOUT = 10
+
+
+class MjpegStream(object):
+    """
+    Reads an MJPEG stream served over HTTP as a multipart response, with the
+    grab, retrieve and release calls of cv2.VideoCapture. FFmpeg decodes
+    every frame it grabs, here grab only reads the JPEG of the next part and
+    retrieve decodes it, so frames that are skipped cost no decoding.
+    """
+
+    def __init__(self, response, boundary: str) -> None:
+        self.response = response
+        # Cameras disagree on whether the parameter includes the leading
+        # dashes of the delimiter line, so both are compared without them.
+        self.boundary = boundary.encode().lstrip(b"-")
+        self.at_part = False
+        self.jpeg = None
+
+    def grab(self) -> bool:
+        try:
+            self.jpeg = self.__read_part()
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            logger.warning("Could not read the MJPEG stream: %s", e)
+            self.jpeg = None
+
+        return self.jpeg is not None
+
+    def retrieve(self):
+        if self.jpeg is None:
+            return False, None
+
+        frame = cv2.imdecode(np.frombuffer(self.jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+        return frame is not None, frame
+
+    def read(self):
+        if not self.grab():
+            return False, None
+
+        return self.retrieve()
+
+    def release(self):
+        self.response.close()
+
+    def __delimiter(self, line: bytes):
+        """
+        True for the delimiter of the next part, False for the closing one
+        and None for any other line.
+        """
+        line = line.strip().lstrip(b"-")
+        if line == self.boundary:
+            return True
+        if line == self.boundary + b"--":
+            return False
+
+        return None
+
+    def __read_part(self):
+        """
+        The JPEG of the next part, or None at the end of the stream.
+        """
+        while not self.at_part:
+            line = self.response.readline()
+            if not line or self.__delimiter(line) is False:
+                return None
+            self.at_part = self.__delimiter(line) is True
+
+        length = None
+        while True:
+            line = self.response.readline()
+            if not line:
+                return None
+            if not line.strip():
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            if name.strip().lower() == "content-length":
+                length = int(value)
+
+        self.at_part = False
+        if length is not None:
+            jpeg = self.response.read(length)
+            return jpeg if len(jpeg) == length else None
+
+        # Without a length the part ends at the next delimiter.
+        lines = []
+        while True:
+            line = self.response.readline()
+            if not line:
+                return None
+            delimiter = self.__delimiter(line)
+            if delimiter is not None:
+                self.at_part = delimiter
+                return b"".join(lines).rstrip(b"\r\n")
+            lines.append(line)
+
+
+def open_capture(name):
+    """
+    Opens the camera stream. An MJPEG stream over HTTP is read with
+    MjpegStream, anything else, like a camera index or an RTSP stream, with
+    cv2.VideoCapture, which decodes every frame it grabs.
+    """
+    if isinstance(name, str) and name.startswith(("http://", "https://")):
+        try:
+            response = urllib.request.urlopen(name, timeout=CONNECT_TIMEOUT)
+        except OSError as e:
+            logger.warning("Could not open %s, falling back to FFmpeg: %s", name, e)
+            return cv2.VideoCapture(name)
+
+        boundary = response.headers.get_param("boundary")
+        if response.headers.get_content_type() == MJPEG_CONTENT_TYPE and boundary:
+            return MjpegStream(response, boundary)
+        response.close()
+
+    return cv2.VideoCapture(name)
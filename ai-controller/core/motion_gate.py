@@ -0,0 +1,60 @@
+import cv2
+import logging
+
+from core.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+hit_rate_gauge = REGISTRY.gauge("motion_gate_hit_rate", "Share of frames that reused the previous detections")
+
+
+class MotionGate(object):
+    """
+    Decides whether a frame is different enough from the last inferred frame
+    to be worth running YOLO on. Both frames are reduced to a small grayscale
+    thumbnail, and inference is skipped when their mean absolute difference is
+    below the threshold. Every max_reused_frames frames inference runs anyway,
+    so slow changes are not missed forever.
+    """
+
+    def __init__(self, threshold: float, thumbnail_size: int = 32, max_reused_frames: int = 15,
+                 report_interval: int = 300) -> None:
+        self.threshold = threshold
+        self.thumbnail_size = (thumbnail_size, thumbnail_size)
+        self.max_reused_frames = max_reused_frames
+        self.report_interval = report_interval
+        self.frames = 0
+        self.hits = 0
+        self.initialize()
+
+    def initialize(self):
+        self.reference = None
+        self.reused_frames = 0
+
+    @property
+    def hit_rate(self) -> float:
+        if self.frames == 0:
+            return 0
+
+        return self.hits / self.frames
+
+    def should_infer(self, frame) -> bool:
+        thumbnail = cv2.resize(
+            cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY),
+            self.thumbnail_size,
+            interpolation=cv2.INTER_AREA
+        )
+
+        self.frames += 1
+        if self.report_interval > 0 and self.frames % self.report_interval == 0:
+            hit_rate_gauge.set(self.hit_rate)
+            logger.info("Motion gate reused detections for %.1f%% of %d frames", self.hit_rate * 100, self.frames)
+
+        if self.reference is not None and self.reused_frames < self.max_reused_frames and \
+                cv2.absdiff(thumbnail, self.reference).mean() < self.threshold:
+            self.hits += 1
+            self.reused_frames += 1
+            return False
+
+        self.reference = thumbnail
+        self.reused_frames = 0
+        return True
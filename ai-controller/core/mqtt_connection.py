@@ -1,7 +1,16 @@
 import json
-from threading import Condition
+import logging
+from threading import Condition, Lock
+from time import time
 from paho.mqtt.client import Client as MQTTClient, MQTTMessage
 
+from core.metrics import REGISTRY
+from core.threads import pin_current_thread
+
+logger = logging.getLogger(__name__)
+published_counter = REGISTRY.counter("instructions_published", "Instructions published to the robot")
+queued_counter = REGISTRY.counter("instructions_queued", "Instructions queued while the broker or robot was unreachable")
+
 class ConnectionConfig(object):
     """
     A data class with the information required to connect to the MQTT broker.
@@ -9,28 +18,104 @@ class ConnectionConfig(object):
 
     client_id = "ai-controller"
 
-    def __init__(self, mqtt_host: str, mqtt_port: int, keep_alive: int, topic: str):
+    def __init__(self, mqtt_host: str, mqtt_port: int, keep_alive: int, topic: str, robot_id: str = None,
+                 presence_topic: str = "fleet/presence", reconnect_min_delay: float = 0.1,
+                 reconnect_max_delay: float = 2, offline_queue_size: int = 32, telemetry_topic: str = None):
         self.mqtt_host = mqtt_host
         self.mqtt_port = mqtt_port
         self.keep_alive = keep_alive
         self.topic = topic
+        self.robot_id = robot_id
+        self.presence_topic = None
+        self.reconnect_min_delay = reconnect_min_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self.offline_queue_size = offline_queue_size
+        self.telemetry_topic = telemetry_topic
+
+        # With a robot id the control topic is not fixed: it is taken from
+        # the retained presence message of that robot, which names the
+        # control topic of the controller it is connected to.
+        if robot_id is not None:
+            self.client_id = "ai-controller-{}".format(robot_id)
+            self.presence_topic = "{}/{}".format(presence_topic, robot_id)
+
+
+class OfflineQueue(object):
+    """
+    Holds the instructions that could not be published while the broker or
+    the robot was unreachable. Only the latest movement is worth sending
+    after a reconnect, so a new movement replaces any queued one. State
+    switches are all kept in order, and drop the movements queued before
+    them, since those belong to the previous state. When full, a movement is
+    dropped before any state switch, so a switch is only lost when the queue
+    holds nothing else.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.items = []
+        self.lock = Lock()
+
+    def put(self, instruction) -> None:
+        item = (instruction.serialize(), instruction.qos, instruction.coalesce, instruction.mode)
+
+        with self.lock:
+            self.items = [queued for queued in self.items if not queued[2]]
+            self.items.append(item)
+
+            if len(self.items) > self.max_size:
+                self.items.pop(self.__overflow_index())
+
+    def __overflow_index(self) -> int:
+        for i, queued in enumerate(self.items):
+            if queued[2]:
+                return i
+
+        return 0
+
+    def drain(self) -> list:
+        with self.lock:
+            items = self.items
+            self.items = []
+
+        return items
 
 
 class MqttConnection(object):
 
-    def __init__(self, config: ConnectionConfig) -> None:
+    on_active_change = None
+    on_profile_request = None
+    on_shutdown_request = None
+    on_telemetry = None
+
+    def __init__(self, config: ConnectionConfig, cpus=None) -> None:
         self.config = config
+        self.cpus = cpus
         self.client = MQTTClient(config.client_id)
         self.cv = Condition()
         self.connected = False
+        self.topic = config.topic if config.presence_topic is None else None
+        # With a robot id, the telemetry topic is read from the presence too.
+        self.telemetry_topic = config.telemetry_topic if config.presence_topic is None else None
+        self.offline_queue = OfflineQueue(config.offline_queue_size)
+        # Held from draining the offline queue until the new instruction is
+        # published, so the network thread flushing the queue after a
+        # reconnect and the main thread publishing never overtake each
+        # other.
+        self.publish_lock = Lock()
 
     def connect(self):
         if self.connected:
             return
 
         self.client.on_connect = self.__on_connect
+        self.client.on_disconnect = self.__on_disconnect
         self.client.on_message = self.__on_message
 
+        # Paho reconnects on its own from the network loop, starting at the
+        # min delay and doubling up to the max delay.
+        self.client.reconnect_delay_set(self.config.reconnect_min_delay, self.config.reconnect_max_delay)
+
         self.client.connect_async(
             self.config.mqtt_host,
             self.config.mqtt_port,
@@ -50,28 +135,123 @@ class MqttConnection(object):
         return self.connected
 
     def submit_instruction(self, instruction):
-        assert self.is_connected()
-
         if instruction is None:
             return
 
-        print("Submitting instruction {}".format(instruction))
+        with self.publish_lock:
+            topic = self.topic
+            if not self.is_connected() or topic is None:
+                self.offline_queue.put(instruction)
+                queued_counter.inc()
+                return
 
-        self.client.publish(
-            self.config.topic,
-            instruction.serialize()
-        )
+            # Catches instructions queued while the connection was coming
+            # back.
+            self.__publish_queued(topic)
+
+            logger.info("Submitting instruction %s", instruction)
+
+            self.__publish(topic, instruction.serialize(), instruction.qos, instruction.mode)
+
+    def __publish(self, topic: str, payload: str, qos: int, mode: str):
+        self.client.publish(topic, payload, qos)
+        published_counter.inc()
+
+        # The current mode is kept as a retained message next to the control
+        # topic, so controllers that (re)connect later can read it. The robot
+        # only subscribes to the control topic itself and never receives it.
+        if mode is not None:
+            self.client.publish(
+                "{}/mode".format(topic),
+                json.dumps({"mode": mode, "timestamp": time()}),
+                1,
+                True
+            )
+
+    def __flush_offline_queue(self):
+        with self.publish_lock:
+            topic = self.topic
+            if topic is None:
+                return
+
+            self.__publish_queued(topic)
+
+    def __publish_queued(self, topic: str):
+        for payload, qos, _, mode in self.offline_queue.drain():
+            self.__publish(topic, payload, qos, mode)
 
     def __on_connect(self, client: MQTTClient, userdata: None, flags: None, rc: None):
-        print("Connected to mqtt broker")
-        self.client.subscribe(self.config.topic)
+        logger.info("Connected to mqtt broker")
+        # Callbacks run on paho's network thread.
+        pin_current_thread(self.cpus)
+        if self.config.presence_topic is not None:
+            self.client.subscribe(self.config.presence_topic, 1)
+        elif self.topic is not None:
+            self.client.subscribe(self.topic, 1)
+        if self.telemetry_topic is not None:
+            self.client.subscribe(self.telemetry_topic)
 
         with self.cv:
             self.connected = True
             self.cv.notify()
 
+        self.__flush_offline_queue()
+
+    def __on_disconnect(self, client: MQTTClient, userdata: None, rc: int):
+        self.connected = False
+
+        if rc != 0:
+            logger.warning("Lost connection to mqtt broker, reconnecting")
+
     def __on_message(self, client: MQTTClient, userdata: None, msg: MQTTMessage):
+        if msg.topic == self.config.presence_topic:
+            self.__on_presence(msg.payload)
+            return
+
+        if msg.topic == self.telemetry_topic:
+            if self.on_telemetry is not None:
+                self.on_telemetry(json.loads(msg.payload.decode("utf-8")))
+            return
+
         command = json.loads(msg.payload.decode("utf-8"))
 
         if command["command"] == "set_ai_active" and self.on_active_change is not None:
             self.on_active_change(command["metadata"]["active"])
+        elif command["command"] == "profile" and self.on_profile_request is not None:
+            self.on_profile_request(command["metadata"].get("seconds", 10))
+        elif command["command"] == "shutdown" and self.on_shutdown_request is not None:
+            self.on_shutdown_request()
+
+    def __on_presence(self, payload: bytes):
+        """
+        Follows the control topic of the robot. The topic changes whenever a
+        different controller connects to the robot, and is None while the
+        robot has no controller.
+        """
+        presence = json.loads(payload.decode("utf-8")) if len(payload) > 0 else {}
+        self.__follow_telemetry(presence.get("telemetry_topic"))
+        topic = presence.get("control_topic")
+
+        if topic == self.topic:
+            return
+
+        if self.topic is not None:
+            self.client.unsubscribe(self.topic)
+
+        logger.info("Robot %s is %s, control topic: %s", self.config.robot_id, presence.get("state", "gone"), topic)
+        self.topic = topic
+
+        if topic is not None:
+            self.client.subscribe(topic, 1)
+            self.__flush_offline_queue()
+
+    def __follow_telemetry(self, topic: str):
+        if topic == self.telemetry_topic:
+            return
+
+        if self.telemetry_topic is not None:
+            self.client.unsubscribe(self.telemetry_topic)
+
+        self.telemetry_topic = topic
+        if topic is not None:
+            self.client.subscribe(topic)
@@ -0,0 +1,103 @@
+import cv2
+
+OVERLAY_RASTER = "raster"
+OVERLAY_VECTOR = "vector"
+OVERLAY_OFF = "off"
+
+
+class OverlayConfig(object):
+    """
+    How detections are shown to the viewers of the stream. In raster mode
+    they are drawn on the preview frames, in vector mode the preview frames
+    stay clean and the boxes are served as JSON at /overlay for the web
+    controller to draw. preview_scale downscales the preview frames.
+    """
+
+    def __init__(self, mode: str = OVERLAY_RASTER, preview_scale: float = 1) -> None:
+        self.mode = mode
+        self.preview_scale = preview_scale
+
+
+class DetectionResult(object):
+    """
+    The boxes found in a frame and the one that is driven to, if any.
+    """
+
+    def __init__(self, boxes, frame_width: int, frame_height: int, target=None) -> None:
+        self.boxes = boxes
+        self.frame_width = frame_width
+        self.frame_height = frame_height
+        self.target = target
+
+
+def render_preview(frame, result: DetectionResult, config: OverlayConfig):
+    """
+    The frame for the viewers: downscaled, and with the detections drawn in
+    raster mode. Drawing happens on a copy, so the frame used for detection
+    is never touched.
+    """
+    preview = frame
+    if config.preview_scale != 1:
+        preview = cv2.resize(frame, None, fx=config.preview_scale, fy=config.preview_scale,
+                             interpolation=cv2.INTER_AREA)
+
+    if config.mode == OVERLAY_RASTER and result is not None:
+        if preview is frame:
+            preview = frame.copy()
+        draw_overlay(preview, result)
+
+    return preview
+
+
+def draw_overlay(img, result: DetectionResult):
+    """
+    Draws the boxes, their labels and the line from the bottom center of the
+    frame to each box onto img, which may be a downscaled preview.
+    """
+    height, width = img.shape[:2]
+    scale = width / result.frame_width
+    font = cv2.FONT_HERSHEY_PLAIN
+
+    for box in result.boxes:
+        xmin, ymin, xmax, ymax = [int(box[key] * scale) for key in ('xmin', 'ymin', 'xmax', 'ymax')]
+        conf, label = box['conf'], box['prediction']
+        color = (0, 255, 0) if box is result.target else (255, 0, 0)
+
+        cv2.rectangle(img, (xmin, ymin), (xmax, ymax), color, 2)
+        cv2.putText(img, f"{label} {conf:.2f}", (xmin, ymin), font, 1, color, 1)
+        box_center_bottom_x = xmin + (xmax - xmin) // 2
+        cv2.line(img, (width // 2, ymax), (width // 2, height), (255, 255, 255), 2, 8)  # bottom image center line
+        cv2.line(img, (box_center_bottom_x, ymax), (width // 2, height), (255, 255, 0), 2, 8)  # box center line
+
+        cv2.putText(img, f"bottom right corner distance {int((width // 2 - box_center_bottom_x) / scale)} ",
+                    (0, height), font, 1, (255, 0, 0), 2)
+
+    return img
+
+
+def to_vector_overlay(result: DetectionResult) -> dict:
+    """
+    The detections as a JSON-ready message. Coordinates are in pixels of a
+    frame of the given width and height, so clients scale them to whatever
+    size they show the stream at. FrameBuffer.set_overlay adds the timestamp
+    once it knows the overlay changed.
+    """
+    if result is None:
+        return {"width": None, "height": None, "boxes": []}
+
+    return {
+        "width": result.frame_width,
+        "height": result.frame_height,
+        "boxes": [
+            {
+                "xmin": float(box['xmin']),
+                "ymin": float(box['ymin']),
+                "xmax": float(box['xmax']),
+                "ymax": float(box['ymax']),
+                "conf": float(box['conf']),
+                "label": str(box['prediction']),
+                "target": box is result.target,
+            }
+            for box in result.boxes
+        ],
+    }
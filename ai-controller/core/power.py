@@ -0,0 +1,51 @@
+import logging
+
+from core.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+decode_fps_gauge = REGISTRY.gauge("capture_max_fps", "The decode rate limit of the capture, -1 while unlimited")
+
+
+class PowerConfig(object):
+    """
+    How much of the stream is decoded while the AI has nothing to do: while
+    it is off, or while the robot grabs a bottle. idle_fps frames per
+    second are decoded for the preview, and none at all while nobody watches
+    if pause_unwatched is set.
+    """
+
+    def __init__(self, idle_fps: float = 2, pause_unwatched: bool = True) -> None:
+        self.idle_fps = idle_fps
+        self.pause_unwatched = pause_unwatched
+
+
+class CaptureThrottle(object):
+    """
+    Sets the decode rate of the capture from what the pipeline needs. The
+    capture keeps reading the stream while throttled, so the first frame
+    after the AI is switched on is a current one, and arrives within a
+    frame interval.
+    """
+
+    def __init__(self, config: PowerConfig, capture) -> None:
+        self.config = config
+        self.capture = capture
+        self.max_fps = None
+        decode_fps_gauge.set(-1)
+
+    def update(self, active: bool, watched: bool):
+        if active:
+            max_fps = None
+        elif watched or not self.config.pause_unwatched:
+            max_fps = self.config.idle_fps
+        else:
+            max_fps = 0
+
+        if max_fps == self.max_fps:
+            return
+
+        logger.info("Decoding %s", "every frame" if max_fps is None else "{:g} frames per second".format(max_fps))
+        self.max_fps = max_fps
+        self.capture.set_max_fps(max_fps)
+        decode_fps_gauge.set(-1 if max_fps is None else max_fps)
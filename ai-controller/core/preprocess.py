@@ -0,0 +1,163 @@
+import cv2
+import math
+import numpy as np
+
+# The gray YOLOv5 pads letterboxed images with.
+PAD_VALUE = (114, 114, 114)
+
+
+def letterbox_shape(width: int, height: int, size: int, stride: int = 32):
+    """
+    How an image of width x height is letterboxed for an input size: returns
+    the scale, the scaled width and height, and the model input width and
+    height, which are padded up to a multiple of the stride.
+    """
+    scale = size / max(width, height)
+    scaled_width = round(width * scale)
+    scaled_height = round(height * scale)
+    input_width = int(math.ceil(scaled_width / stride) * stride)
+    input_height = int(math.ceil(scaled_height / stride) * stride)
+
+    return (scale, scaled_width, scaled_height, input_width, input_height)
+
+
+def model_input_shape(camera_width: int, camera_height: int, bottom_blackout_height: int, size: int,
+                      stride: int = 32):
+    """
+    The (height, width) of the model input the Preprocessor makes from camera
+    frames of camera_width x camera_height.
+    """
+    # Rotating clockwise swaps the sides, and the blackout is cut off the
+    # bottom of the rotated frame.
+    frame_width, frame_height = camera_height, camera_width
+    visible_height = max(1, frame_height - bottom_blackout_height)
+    _, _, _, input_width, input_height = letterbox_shape(frame_width, visible_height, size, stride)
+
+    return (input_height, input_width)
+
+
+class FrameGeometry(object):
+    """
+    How the model input of one camera resolution and input size relates to
+    the rotated camera frame: the model input is the part of the rotated
+    frame above the blackout, scaled by `scale` and padded by pad_x and
+    pad_y on each side up to a multiple of the model stride.
+    """
+
+    def __init__(self, frame_width: int, frame_height: int, visible_height: int, input_width: int,
+                 input_height: int, scale: float, pad_x: float, pad_y: float) -> None:
+        self.frame_width = frame_width
+        self.frame_height = frame_height
+        self.visible_height = visible_height
+        self.input_width = input_width
+        self.input_height = input_height
+        self.scale = scale
+        self.pad_x = pad_x
+        self.pad_y = pad_y
+
+
+class Preprocessor(object):
+    """
+    Turns camera frames into model input in a single cv2.remap pass. The
+    remap tables fold the 90 degree rotation, the crop of the bottom
+    blackout, optional lens undistortion, the resize and the letterbox
+    padding together, so every output pixel is computed once straight from
+    the camera frame, into a buffer that is reused for every frame. The
+    tables are built once per camera resolution and input size.
+
+    Since the blackout is cropped rather than painted black, the model does
+    not spend any pixels on it. Boxes are mapped back to the coordinates of
+    the rotated, uncropped frame, so everything downstream sees the same
+    coordinates as before.
+    """
+
+    def __init__(self, bottom_blackout_height: int, camera_matrix=None, dist_coeffs=None, stride: int = 32) -> None:
+        self.bottom_blackout_height = bottom_blackout_height
+        self.camera_matrix = np.array(camera_matrix, dtype=np.float64) if camera_matrix is not None else None
+        self.dist_coeffs = np.array(dist_coeffs, dtype=np.float64) if dist_coeffs is not None else None
+        self.stride = stride
+        self.tables = {}
+
+    def process(self, frame, size: int):
+        """
+        Returns the model input for the camera frame, and the geometry to map
+        boxes back with. The returned image is overwritten by the next call
+        with the same resolution and size.
+        """
+        map1, map2, buffer, geometry = self.__get_tables(frame.shape[0], frame.shape[1], size)
+
+        cv2.remap(frame, map1, map2, cv2.INTER_LINEAR, dst=buffer, borderMode=cv2.BORDER_CONSTANT,
+                  borderValue=PAD_VALUE)
+
+        return buffer, geometry
+
+    @staticmethod
+    def to_frame_boxes(boxes, geometry: FrameGeometry):
+        """
+        Maps boxes from model input coordinates to coordinates of the rotated
+        camera frame, in place.
+        """
+        for box in boxes:
+            box['xmin'] = round(min(max((box['xmin'] - geometry.pad_x) / geometry.scale, 0), geometry.frame_width), 2)
+            box['xmax'] = round(min(max((box['xmax'] - geometry.pad_x) / geometry.scale, 0), geometry.frame_width), 2)
+            box['ymin'] = round(min(max((box['ymin'] - geometry.pad_y) / geometry.scale, 0), geometry.visible_height), 2)
+            box['ymax'] = round(min(max((box['ymax'] - geometry.pad_y) / geometry.scale, 0), geometry.visible_height), 2)
+
+        return boxes
+
+    def __get_tables(self, camera_height: int, camera_width: int, size: int):
+        key = (camera_height, camera_width, size)
+        if key not in self.tables:
+            self.tables[key] = self.__build_tables(camera_height, camera_width, size)
+
+        return self.tables[key]
+
+    def __build_tables(self, camera_height: int, camera_width: int, size: int):
+        # Rotating clockwise swaps the sides, and the blackout is cut off the
+        # bottom of the rotated frame.
+        frame_width, frame_height = camera_height, camera_width
+        visible_height = max(1, frame_height - self.bottom_blackout_height)
+
+        scale, scaled_width, scaled_height, input_width, input_height = letterbox_shape(
+            frame_width, visible_height, size, self.stride
+        )
+        pad_x = (input_width - scaled_width) / 2
+        pad_y = (input_height - scaled_height) / 2
+
+        # The rotated frame pixel (x, y) every input pixel samples, with pixel
+        # centers lined up like cv2.resize does.
+        u, v = np.meshgrid(np.arange(input_width, dtype=np.float32), np.arange(input_height, dtype=np.float32))
+        x = (u - pad_x + 0.5) / scale - 0.5
+        y = (v - pad_y + 0.5) / scale - 0.5
+
+        # The rotated pixel (x, y) is the camera pixel at row
+        # camera_height - 1 - x and column y.
+        map_x = y
+        map_y = (camera_height - 1) - x
+
+        if self.camera_matrix is not None and self.dist_coeffs is not None:
+            # The undistortion table says, for every pixel of the undistorted
+            # image, where it lies in the distorted camera frame. Sampling it
+            # at the positions above composes both mappings.
+            undistort_x, undistort_y = cv2.initUndistortRectifyMap(
+                self.camera_matrix, self.dist_coeffs, None, self.camera_matrix,
+                (camera_width, camera_height), cv2.CV_32FC1
+            )
+            map_x, map_y = (
+                cv2.remap(undistort_x, map_x, map_y, cv2.INTER_LINEAR),
+                cv2.remap(undistort_y, map_x, map_y, cv2.INTER_LINEAR)
+            )
+
+        # The padding samples outside the frame, which remap fills with the
+        # pad value.
+        padding = (x < -0.5) | (x > frame_width - 0.5) | (y < -0.5) | (y > visible_height - 0.5)
+        map_x[padding] = -10
+        map_y[padding] = -10
+
+        # Fixed point tables are considerably faster to remap with.
+        map1, map2 = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+        buffer = np.empty((input_height, input_width, 3), dtype=np.uint8)
+        geometry = FrameGeometry(frame_width, frame_height, visible_height, input_width, input_height, scale,
+                                 pad_x, pad_y)
+
+        return (map1, map2, buffer, geometry)
@@ -0,0 +1,140 @@
+import logging
+import os
+import sys
+import threading
+from collections import Counter
+from time import perf_counter, sleep, strftime
+
+logger = logging.getLogger(__name__)
+
+
+class ProfilerConfig(object):
+    """
+    Where the profiles are written and how often the profiled thread is sampled.
+    """
+
+    def __init__(self, output_dir: str = "profiles", interval: float = 0.005, max_seconds: float = 60) -> None:
+        self.output_dir = output_dir
+        self.interval = interval
+        self.max_seconds = max_seconds
+
+
+class SamplingProfiler(object):
+    """
+    A sampling profiler for a single thread. While running, a background
+    thread reads the stack of the profiled thread every interval, which costs
+    the profiled thread nothing but a short wait on the GIL. Calls into
+    OpenCV or torch show up as the Python line that made them, so e.g.
+    cv2.rotate and cv2.imencode in the main loop are told apart.
+
+    When the run ends it writes a collapsed-stack file, that flamegraph.pl or
+    speedscope read as is, and a summary of the time spent per function.
+    """
+
+    def __init__(self, thread_id: int, config: ProfilerConfig) -> None:
+        self.thread_id = thread_id
+        self.config = config
+        self.lock = threading.Lock()
+        self.running = False
+
+    def start(self, seconds: float) -> str:
+        """
+        Starts profiling for the given number of seconds in the background.
+        Returns the path the profile will be written to, without extension,
+        or None when a profile is already being taken.
+        """
+        seconds = min(seconds, self.config.max_seconds)
+
+        with self.lock:
+            if self.running:
+                return None
+            self.running = True
+
+        output_path = os.path.join(self.config.output_dir, "profile-{}".format(strftime("%Y%m%d-%H%M%S")))
+
+        thread = threading.Thread(target=self.__run, args=(seconds, output_path))
+        thread.daemon = True
+        thread.start()
+
+        logger.info("Profiling for %s secs, writing to %s", seconds, output_path)
+        return output_path
+
+    def __run(self, seconds: float, output_path: str):
+        try:
+            stacks = self.__sample(seconds)
+            self.__write(stacks, output_path)
+        except Exception:
+            logger.exception("Profiling failed")
+        finally:
+            with self.lock:
+                self.running = False
+
+    def __sample(self, seconds: float) -> Counter:
+        stacks = Counter()
+        deadline = perf_counter() + seconds
+
+        while perf_counter() < deadline:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_name, code.co_filename, code.co_firstlineno, frame.f_lineno))
+                frame = frame.f_back
+            del frame
+
+            stacks[tuple(reversed(stack))] += 1
+            sleep(self.config.interval)
+
+        return stacks
+
+    def __write(self, stacks: Counter, output_path: str):
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+
+        with open(output_path + ".folded", "w") as folded_file:
+            for stack, count in stacks.most_common():
+                frames = ["{} ({}:{})".format(name, os.path.basename(filename), line)
+                          for name, filename, _, line in stack]
+                folded_file.write("{} {}\n".format(";".join(frames), count))
+
+        with open(output_path + ".txt", "w") as summary_file:
+            summary_file.write(self.summarize(stacks))
+
+        logger.info("Profile written to %s.folded and %s.txt", output_path, output_path)
+
+    @staticmethod
+    def summarize(stacks: Counter) -> str:
+        """
+        The share of samples each function was running itself (self) and was
+        on the stack at all (total), followed by the lines that were running
+        most often.
+        """
+        samples = sum(stacks.values())
+        if samples == 0:
+            return "No samples taken\n"
+
+        self_counts = Counter()
+        total_counts = Counter()
+        line_counts = Counter()
+        for stack, count in stacks.items():
+            name, filename, first_line, line = stack[-1]
+            self_counts[(name, filename, first_line)] += count
+            line_counts[(name, filename, line)] += count
+
+            for function in set((name, filename, first_line) for name, filename, first_line, _ in stack):
+                total_counts[function] += count
+
+        lines = ["{} samples".format(samples), "", "{:>7} {:>7}  function".format("self", "total")]
+        for function, total in total_counts.most_common():
+            name, filename, first_line = function
+            lines.append("{:>6.1%} {:>6.1%}  {} ({}:{})".format(
+                self_counts[function] / samples, total / samples, name, filename, first_line
+            ))
+
+        lines.extend(["", "{:>7}  line".format("self")])
+        for (name, filename, line), count in line_counts.most_common(20):
+            lines.append("{:>6.1%}  {} ({}:{})".format(count / samples, name, filename, line))
+
+        return "\n".join(lines) + "\n"
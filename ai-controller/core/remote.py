@@ -0,0 +1,244 @@
+import cv2
+import http.client
+import json
+import logging
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+from typing import List
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from core.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+requests_counter = REGISTRY.counter("remote_requests", "Frames sent to inference workers")
+failures_counter = REGISTRY.counter("remote_failures", "Requests to inference workers that failed or missed the deadline")
+fallback_counter = REGISTRY.counter("remote_fallbacks", "Frames inferred locally because no worker answered in time")
+remote_histogram = REGISTRY.histogram("remote_seconds", "Round trip time of requests to inference workers")
+
+ENCODING_RAW = "raw"
+ENCODING_JPEG = "jpeg"
+
+
+class RemoteConfig(object):
+    """
+    The inference workers to send frames to, as host:port. Frames are
+    inferred locally while the list is empty or no worker answers within the
+    deadline. raw frames are cheapest on localhost, jpeg ones over a
+    network.
+    """
+
+    def __init__(self, workers: List[str] = None, deadline_ms: float = 150, retry_interval: float = 5,
+                 encoding: str = ENCODING_JPEG, jpeg_quality: int = 90) -> None:
+        self.workers = workers if workers is not None else []
+        self.deadline = deadline_ms / 1000
+        self.retry_interval = retry_interval
+        self.encoding = encoding
+        self.jpeg_quality = jpeg_quality
+
+
+class RemoteWorker(object):
+    """
+    The client side of one inference worker: a kept-alive connection, its
+    measured latency, the load it last reported and when it failed last.
+    """
+
+    LATENCY_SMOOTHING = 0.2
+
+    def __init__(self, address: str) -> None:
+        host, _, port = address.rpartition(":")
+        self.address = address
+        self.host = host
+        self.port = int(port)
+        self.connection = None
+        self.latency = 0
+        self.load = 0
+        self.failed_at = None
+
+    @property
+    def cost(self) -> float:
+        """
+        The expected wait for an answer: the frames queued on the worker,
+        plus ours, times how long one frame took there.
+        """
+        return (self.load + 1) * self.latency
+
+    def request(self, body: bytes, headers: dict, size: int, timeout: float):
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+        self.connection.timeout = timeout
+        if self.connection.sock is None:
+            # Connected here rather than by request, so the frame is not
+            # held back by Nagle's algorithm either.
+            self.connection.connect()
+            self.connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connection.sock.settimeout(timeout)
+
+        start = perf_counter()
+        self.connection.request("POST", "/infer?size={}".format(size), body, headers)
+        response = self.connection.getresponse()
+        result = json.loads(response.read().decode('utf-8'))
+        if response.status != 200:
+            raise IOError("worker {} answered {}: {}".format(self.address, response.status, result))
+
+        latency = perf_counter() - start
+        remote_histogram.record(latency)
+        if self.latency == 0:
+            self.latency = latency
+        else:
+            self.latency += RemoteWorker.LATENCY_SMOOTHING * (latency - self.latency)
+        self.load = int(response.getheader("X-Queue-Depth", 0))
+        self.failed_at = None
+
+        return (result["width"], result["height"], result["boxes"])
+
+    def fail(self, now: float):
+        # The connection may hold half a response, so it is never reused.
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        self.failed_at = now
+
+
+class RemoteInference(object):
+    """
+    Infers frames on remote workers, and is called like yolov5(frame, size).
+    Each frame goes to the worker expected to answer first, going by the
+    load the workers report and their measured latency. A worker that fails
+    or misses the deadline is left alone for retry_interval seconds, and the
+    frame is tried on the next worker while the deadline allows. Frames no
+    worker answered in time are inferred by the local fallback.
+    """
+
+    def __init__(self, config: RemoteConfig, fallback, clock=perf_counter) -> None:
+        self.config = config
+        self.fallback = fallback
+        self.clock = clock
+        self.workers = [RemoteWorker(address) for address in config.workers]
+
+    def __call__(self, img, size=416):
+        start = self.clock()
+        deadline = start + self.config.deadline
+        body, headers = self.__encode(img)
+
+        for worker in self.__candidates(start):
+            remaining = deadline - self.clock()
+            if remaining <= 0:
+                break
+
+            requests_counter.inc()
+            try:
+                return worker.request(body, headers, size, remaining)
+            except (OSError, http.client.HTTPException, ValueError, KeyError) as e:
+                failures_counter.inc()
+                logger.warning("Inference worker %s failed: %s", worker.address, e)
+                worker.fail(self.clock())
+
+        fallback_counter.inc()
+        return self.fallback(img, size)
+
+    def __candidates(self, now: float):
+        """
+        The workers to try, the least loaded first. Workers that failed are
+        only retried after retry_interval.
+        """
+        available = [
+            worker for worker in self.workers
+            if worker.failed_at is None or now - worker.failed_at >= self.config.retry_interval
+        ]
+
+        return sorted(available, key=lambda worker: worker.cost)
+
+    def __encode(self, img):
+        height, width, channels = img.shape
+        if self.config.encoding == ENCODING_RAW:
+            headers = {"Content-Type": "application/octet-stream", "X-Shape": "{},{},{}".format(height, width, channels)}
+            return (np.ascontiguousarray(img).tobytes(), headers)
+
+        encoded = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, self.config.jpeg_quality])[1]
+        return (encoded.tobytes(), {"Content-Type": "image/jpeg"})
+
+
+class InferenceWorkerServer(BaseHTTPRequestHandler):
+    """
+    The worker side: answers POST /infer?size=N with the detections of the
+    frame in the body, and GET /health with the number of queued frames.
+    Frames are inferred one at a time, the queue depth is reported with
+    every answer so clients can spread their frames.
+    """
+
+    # Keeps the connections of the clients alive between frames. The
+    # headers and the body of an answer are separate writes, which Nagle's
+    # algorithm would hold back until the client's delayed ACK.
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    inference = None
+    inference_lock = threading.Lock()
+    queue_lock = threading.Lock()
+    queued = 0
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.__send_json(200, {"queued": InferenceWorkerServer.queued})
+        else:
+            self.__send_json(404, {"error": "unknown path"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/infer':
+            self.__send_json(404, {"error": "unknown path"})
+            return
+
+        try:
+            size = int(parse_qs(url.query).get('size', ['416'])[0])
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            img = self.__decode(body)
+        except ValueError as e:
+            self.__send_json(400, {"error": str(e)})
+            return
+
+        with InferenceWorkerServer.queue_lock:
+            InferenceWorkerServer.queued += 1
+        try:
+            with InferenceWorkerServer.inference_lock:
+                width, height, boxes = InferenceWorkerServer.inference(img, size)
+        finally:
+            with InferenceWorkerServer.queue_lock:
+                InferenceWorkerServer.queued -= 1
+
+        self.__send_json(200, {"width": width, "height": height, "boxes": boxes})
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def __decode(self, body: bytes):
+        if self.headers.get('Content-Type') == 'application/octet-stream':
+            shape = tuple(int(value) for value in self.headers.get('X-Shape', '').split(','))
+            # A bytearray, since torch wants the frames writable.
+            return np.frombuffer(bytearray(body), dtype=np.uint8).reshape(shape)
+
+        img = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError("the body is not an image")
+
+        return img
+
+    def __send_json(self, status: int, result: dict):
+        body = json.dumps(result).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', len(body))
+        self.send_header('X-Queue-Depth', InferenceWorkerServer.queued)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def run_worker_server(inference, port: int):
+    InferenceWorkerServer.inference = inference
+    httpd = ThreadingHTTPServer(('', port), InferenceWorkerServer)
+    logger.info("Inference worker listening on port %d", port)
+    httpd.serve_forever()
@@ -0,0 +1,95 @@
+from time import time
+from typing import List
+
+
+class ResolutionController(object):
+    """
+    Chooses the input size YOLO infers at for the next frame. While roaming,
+    or when nothing is in view, the smallest size is used since we only need
+    to notice that a bottle exists. The size is raised when a bottle is close
+    to the robot or when a detection is only just above the confidence
+    threshold, so the final approach runs at full precision. Sizes whose
+    measured latency is above the budget are skipped, but get a trial frame
+    every RETRY_INTERVAL seconds so their latency is measured again.
+    """
+
+    LATENCY_SMOOTHING = 0.2
+    # The first inferences at a size include warm-up, like loading the
+    # network for it, so they are not counted.
+    WARMUP_SAMPLES = 2
+    RETRY_INTERVAL = 10
+
+    def __init__(self, sizes: List[int], latency_budget: float, near_vdist: int, marginal_conf: float,
+                 hold_frames: int = 10, clock=time) -> None:
+        self.sizes = sorted(sizes)
+        self.latency_budget = latency_budget
+        self.near_vdist = near_vdist
+        self.marginal_conf = marginal_conf
+        self.hold_frames = hold_frames
+        self.clock = clock
+        self.latencies = {}
+        self.samples = {}
+        self.tried_at = {}
+        self.trial_size = None
+        self.initialize()
+
+    def initialize(self):
+        self.index = 0
+        self.frames_without_need = 0
+
+    @property
+    def size(self) -> int:
+        return self.sizes[self.index]
+
+    def record_latency(self, size: int, latency: float):
+        """
+        Keeps an exponential moving average of the inference latency (in
+        seconds) per input size, after the warm-up samples.
+        """
+        self.samples[size] = self.samples.get(size, 0) + 1
+        if self.samples[size] <= ResolutionController.WARMUP_SAMPLES:
+            return
+
+        if size not in self.latencies or size == self.trial_size:
+            # A trial frame replaces the average that kept the size skipped.
+            self.trial_size = None
+            self.latencies[size] = latency
+        else:
+            self.latencies[size] += ResolutionController.LATENCY_SMOOTHING * (latency - self.latencies[size])
+
+    def update(self, boxes: List[dict], frame_height: int, is_roaming: bool) -> int:
+        """
+        Adjusts the size based on the detections of the last frame and returns
+        the size to use for the next one.
+        """
+        if is_roaming or len(boxes) == 0:
+            wanted = 0
+        elif any(self.__needs_precision(box, frame_height) for box in boxes):
+            wanted = len(self.sizes) - 1
+        else:
+            wanted = min(1, len(self.sizes) - 1)
+
+        if wanted > self.index:
+            self.index += 1
+            self.frames_without_need = 0
+        elif wanted < self.index:
+            self.frames_without_need += 1
+            if self.frames_without_need >= self.hold_frames:
+                self.index -= 1
+                self.frames_without_need = 0
+        else:
+            self.frames_without_need = 0
+
+        now = self.clock()
+        while self.index > 0 and self.latencies.get(self.size, 0) > self.latency_budget:
+            if now - self.tried_at.get(self.size, now) >= ResolutionController.RETRY_INTERVAL:
+                self.tried_at[self.size] = now
+                self.trial_size = self.size
+                break
+            self.tried_at.setdefault(self.size, now)
+            self.index -= 1
+
+        return self.size
+
+    def __needs_precision(self, box: dict, frame_height: int) -> bool:
+        return frame_height - box['ymax'] < self.near_vdist or box['conf'] < self.marginal_conf
@@ -0,0 +1,237 @@
+import fcntl
+import logging
+import os
+import select
+import subprocess
+import sys
+import tempfile
+import numpy as np
+from multiprocessing import shared_memory
+from time import perf_counter
+
+from core.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+captured_counter = REGISTRY.counter("frames_captured", "Frames decoded from the camera stream")
+dropped_counter = REGISTRY.counter("frames_dropped", "Decoded frames replaced by a newer one before they were processed")
+
+# The header is a row of int64 in front of the slots: the number of frames
+# published, the slot of the latest one, the slot the reader holds, the
+# max_fps of the capture process (as a float64), then the sequence number of
+# every slot.
+HEADER_COUNT = 0
+HEADER_LATEST = 1
+HEADER_PINNED = 2
+HEADER_MAX_FPS = 3
+HEADER_SEQUENCES = 4
+NO_SLOT = -1
+SLOT_ALIGNMENT = 64
+# The shared max_fps while every frame is decoded.
+UNLIMITED_FPS = -1
+
+
+class FileLock(object):
+    """
+    A lock shared between processes through flock on a file. Unlike a
+    multiprocessing lock it only needs the path, so the capture process can
+    be started on its own with subprocess. It does not exclude threads of the
+    same process from each other.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.file = open(path, "a")
+
+    def __enter__(self):
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+
+    def __exit__(self, *args):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+
+    def close(self):
+        self.file.close()
+
+
+class SharedFrameRing(object):
+    """
+    A ring of frame slots in shared memory, written by the capture process
+    and read by the inference process without copying.
+
+    Every slot has a sequence number that is odd while the writer fills it
+    and even once the frame is complete, like a seqlock. The reader keeps
+    using a frame until it asks for the next one, which is longer than a
+    seqlock can protect, so it pins the slot it reads and the writer never
+    picks the pinned slot or the latest complete one. Pinning takes a lock
+    for a few header updates, the frames themselves are copied without it.
+    With three slots the writer always finds a free one and never waits for
+    the reader.
+    """
+
+    def __init__(self, memory: shared_memory.SharedMemory, shape, slots: int, lock: FileLock) -> None:
+        self.memory = memory
+        self.shape = tuple(shape)
+        self.slots = slots
+        self.lock = lock
+        self.header = np.ndarray((HEADER_SEQUENCES + slots,), dtype=np.int64, buffer=memory.buf)
+        self.max_fps = np.ndarray((1,), dtype=np.float64, buffer=memory.buf, offset=HEADER_MAX_FPS * 8)
+
+        frame_bytes = int(np.prod(self.shape))
+        slot_bytes = -(-frame_bytes // SLOT_ALIGNMENT) * SLOT_ALIGNMENT
+        offset = SharedFrameRing.header_bytes(slots)
+        self.frames = [
+            np.ndarray(self.shape, dtype=np.uint8, buffer=memory.buf, offset=offset + i * slot_bytes)
+            for i in range(slots)
+        ]
+
+    @staticmethod
+    def header_bytes(slots: int) -> int:
+        return -(-(HEADER_SEQUENCES + slots) * 8 // SLOT_ALIGNMENT) * SLOT_ALIGNMENT
+
+    @staticmethod
+    def size(shape, slots: int) -> int:
+        frame_bytes = int(np.prod(shape))
+        return SharedFrameRing.header_bytes(slots) + slots * -(-frame_bytes // SLOT_ALIGNMENT) * SLOT_ALIGNMENT
+
+    def initialize(self):
+        self.header[:] = 0
+        self.header[HEADER_LATEST] = NO_SLOT
+        self.header[HEADER_PINNED] = NO_SLOT
+        self.max_fps[0] = UNLIMITED_FPS
+
+    def write(self, frame):
+        with self.lock:
+            slot = next(
+                i for i in range(self.slots)
+                if i != self.header[HEADER_LATEST] and i != self.header[HEADER_PINNED]
+            )
+            count = int(self.header[HEADER_COUNT])
+            self.header[HEADER_SEQUENCES + slot] = 2 * count + 1
+
+        self.frames[slot][...] = frame
+
+        with self.lock:
+            self.header[HEADER_SEQUENCES + slot] = 2 * count + 2
+            self.header[HEADER_LATEST] = slot
+            self.header[HEADER_COUNT] = count + 1
+
+    def read(self, last_count: int):
+        """
+        Pins the latest frame and returns it with the number of frames
+        published so far, or None if there is none newer than last_count.
+        The frame stays valid until the next read.
+        """
+        with self.lock:
+            count = int(self.header[HEADER_COUNT])
+            if count <= last_count:
+                return None
+
+            slot = int(self.header[HEADER_LATEST])
+            self.header[HEADER_PINNED] = slot
+            # A complete frame is never written while it is the latest.
+            assert self.header[HEADER_SEQUENCES + slot] == 2 * count
+            return (self.frames[slot], count)
+
+
+class SharedMemoryCapture(object):
+    """
+    Reads the stream like BufferlessVideoCapture, from a capture process that
+    decodes into a SharedFrameRing. read returns the latest frame, without
+    copying it, and the frame must not be modified or kept beyond the next
+    read.
+
+    The capture process runs core.capture_process instead of a
+    multiprocessing child, which would import main.py and with it torch
+    again. It sends the frame shape over its stdout, gets the name of the
+    shared memory on its stdin, and afterwards writes a byte to its stdout
+    for every frame, which read waits on.
+    """
+
+    def __init__(self, name, cpus=None, slots: int = 3) -> None:
+        lock_fd, self.lock_path = tempfile.mkstemp(prefix="capture-", suffix=".lock")
+        os.close(lock_fd)
+
+        command = [sys.executable, "-m", "core.capture_process", str(name), self.lock_path, str(slots)]
+        if cpus:
+            command.append(",".join(str(cpu) for cpu in cpus))
+        self.process = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        )
+
+        shape = self.process.stdout.readline().split()
+        if len(shape) == 0:
+            self.process.wait()
+            os.remove(self.lock_path)
+            raise IOError("Could not read from {}".format(name))
+        shape = tuple(int(value) for value in shape)
+
+        self.lock = FileLock(self.lock_path)
+        self.memory = shared_memory.SharedMemory(create=True, size=SharedFrameRing.size(shape, slots))
+        self.ring = SharedFrameRing(self.memory, shape, slots, self.lock)
+        self.ring.initialize()
+        self.process.stdin.write("{}\n".format(self.memory.name).encode())
+        self.process.stdin.flush()
+
+        self.notifications = self.process.stdout.fileno()
+        os.set_blocking(self.notifications, False)
+        self.last_count = 0
+
+    def read(self, timeout: float = None):
+        """
+        Returns the latest frame, or None if none was decoded within the
+        timeout.
+        """
+        start = perf_counter()
+        while True:
+            result = self.ring.read(self.last_count)
+            if result is None:
+                # The notifications of frames that were already read are
+                # dropped before checking again, so the wait below neither
+                # returns for them nor misses a frame published meanwhile.
+                self.__drain_notifications()
+                result = self.ring.read(self.last_count)
+            if result is not None:
+                break
+
+            if self.process.poll() is not None:
+                raise IOError("The capture process stopped")
+
+            remaining = 1 if timeout is None else timeout - (perf_counter() - start)
+            if remaining <= 0:
+                return None
+            select.select([self.notifications], [], [], min(1, remaining))
+
+        frame, count = result
+        captured_counter.inc(count - self.last_count)
+        dropped_counter.inc(count - self.last_count - 1)
+        self.last_count = count
+
+        return frame
+
+    def __drain_notifications(self):
+        try:
+            while len(os.read(self.notifications, 4096)) == 4096:
+                pass
+        except BlockingIOError:
+            pass
+
+    def set_max_fps(self, max_fps: float = None):
+        """
+        Limits how many frames per second the capture process decodes, None
+        decodes every frame and 0 pauses decoding while the stream keeps
+        being read.
+        """
+        self.ring.max_fps[0] = UNLIMITED_FPS if max_fps is None else max_fps
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+        self.ring.frames = None
+        self.ring.header = None
+        self.ring.max_fps = None
+        self.memory.close()
+        self.memory.unlink()
+        self.lock.close()
+        os.remove(self.lock_path)
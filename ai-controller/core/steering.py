@@ -0,0 +1,247 @@
+from abc import ABC, abstractmethod
+from math import cos, sin, sqrt
+from core.ground import GroundPlane
+from core.instructions import *
+
+
+class Steering(ABC):
+    """
+    Turns the position of the target in the frame into the instruction that
+    drives the robot towards it. Returns a StartPickupInstruction once the
+    target is in the grab zone, and None when there is nothing new to send.
+    """
+
+    @abstractmethod
+    def get_instruction(self, hdistance: float, vdistance: float, frame_width: int, frame_height: int, now: float):
+        pass
+
+    def reset(self):
+        """
+        Called whenever the robot starts following a different target.
+        """
+        pass
+
+
+class ThresholdSteering(Steering):
+    """
+    Turns in place while the target is more than 10 pixels off center, and
+    otherwise drives straight ahead at a fixed speed.
+    """
+
+    def __init__(self, start_pickup_vdist: int) -> None:
+        self.start_pickup_vdist = start_pickup_vdist
+
+    def get_instruction(self, hdistance, vdistance, frame_width, frame_height, now):
+        if vdistance < self.start_pickup_vdist and abs(hdistance) < 10:
+            return StartPickupInstruction()
+
+        if hdistance > 10:
+            return TurnLeftInstruction(hdistance)
+
+        elif hdistance < -10:
+            return TurnRightInstruction(hdistance)
+
+        else:
+            return MoveForwardInstruction()
+
+
+class PIDController(object):
+
+    def __init__(self, kp: float, ki: float, kd: float, integral_limit: float = 1) -> None:
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.integral_limit = integral_limit
+        self.reset()
+
+    def reset(self):
+        self.integral = 0
+
+    def update(self, error: float, error_rate: float, dt: float) -> float:
+        # Clamping the integral keeps it from winding up while the robot
+        # cannot turn any faster.
+        self.integral = max(-self.integral_limit, min(self.integral_limit, self.integral + error * dt))
+
+        return self.kp * error + self.ki * self.integral + self.kd * error_rate
+
+
+class ServoConfig(object):
+    """
+    The gains and limits of the visual servo. Errors are normalized: the
+    heading error is -1 at the left edge of the frame and 1 at the right edge.
+    far_speed, slow_range, grab_range, grab_lateral and bearing_scale are
+    only used with a ground plane calibration. They are in meters, except
+    bearing_scale, the bearing in radians that counts as a heading error
+    of 1. With a plan_horizon in
+    seconds, trajectories of plan_segments segments are sent every
+    plan_interval seconds instead of a move every frame.
+    """
+
+    def __init__(self, kp: float = 0.15, ki: float = 0.02, kd: float = 0.01, lookahead: float = 0.3,
+                 max_turn: float = 0.3, min_speed: float = 0.1, max_speed: float = 0.4, approach_gain: float = 2,
+                 heading_slowdown: float = 0.5, pickup_tolerance: int = 10, min_change: float = 0.02,
+                 resend_interval: float = 0.2, far_speed: float = 0.8, slow_range: float = 0.6,
+                 grab_range: float = 0.15, grab_lateral: float = 0.03, bearing_scale: float = 0.6,
+                 plan_horizon: float = None,
+                 plan_segments: int = 4, plan_interval: float = 0.4, plan_change: float = 0.05):
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.lookahead = lookahead
+        self.max_turn = max_turn
+        self.min_speed = min_speed
+        self.max_speed = max_speed
+        self.approach_gain = approach_gain
+        self.heading_slowdown = heading_slowdown
+        self.pickup_tolerance = pickup_tolerance
+        self.min_change = min_change
+        self.resend_interval = resend_interval
+        self.far_speed = far_speed
+        self.slow_range = slow_range
+        self.grab_range = grab_range
+        self.grab_lateral = grab_lateral
+        self.bearing_scale = bearing_scale
+        self.plan_horizon = plan_horizon
+        self.plan_segments = plan_segments
+        self.plan_interval = plan_interval
+        self.plan_change = plan_change
+
+
+class VisualServo(Steering):
+    """
+    Steers and drives at the same time. The turn rate comes from a PID
+    controller on the heading error, with the error extrapolated by the
+    box velocity over the lookahead time to make up for the inference and
+    network delay. The forward speed shrinks as the target gets closer to
+    the grab zone and while the heading error is large.
+
+    With a ground plane calibration the target is located on the floor
+    instead. The heading error then is its bearing, which unlike the pixel
+    offset does not depend on how far away the target is, and the speed
+    follows a schedule on its metric range: far_speed
+    until slow_range before the grab zone, then a constant deceleration down
+    to min_speed at grab_range, where the pickup starts once the target is
+    within grab_lateral of the center.
+
+    A new move is only sent when it differs noticeably from the last one, or
+    when the last one is about to go stale on the robot. With a plan horizon
+    a trajectory is sent instead, whose turn follows the heading error as
+    its measured rate predicts it, so the robot keeps steering between
+    plans and through frames the detection misses.
+    """
+
+    VELOCITY_SMOOTHING = 0.5
+    MAX_FRAME_GAP = 1
+
+    def __init__(self, start_pickup_vdist: int, config: ServoConfig = None, ground: GroundPlane = None) -> None:
+        self.start_pickup_vdist = start_pickup_vdist
+        self.config = config if config is not None else ServoConfig()
+        self.ground = ground
+        self.pid = PIDController(self.config.kp, self.config.ki, self.config.kd)
+        self.reset()
+
+    def reset(self):
+        self.pid.reset()
+        self.last_error = None
+        self.last_time = None
+        self.error_rate = 0
+        self.last_sent = None
+        self.last_sent_at = None
+
+    def get_instruction(self, hdistance, vdistance, frame_width, frame_height, now):
+        target = None
+        if self.ground is not None:
+            # Back to the pixel of the bottom center of the box.
+            target = self.ground.range_bearing(frame_width // 2 - hdistance, frame_height - vdistance)
+
+        if target is not None:
+            distance, bearing = target
+            in_grab_zone = distance * cos(bearing) < self.config.grab_range
+            if in_grab_zone and abs(distance * sin(bearing)) < self.config.grab_lateral:
+                return StartPickupInstruction()
+
+            error = bearing / self.config.bearing_scale
+        else:
+            in_grab_zone = vdistance < self.start_pickup_vdist
+            if in_grab_zone and abs(hdistance) < self.config.pickup_tolerance:
+                return StartPickupInstruction()
+
+            error = -hdistance / (frame_width / 2)
+
+        if self.last_time is None or now - self.last_time > VisualServo.MAX_FRAME_GAP:
+            self.pid.reset()
+            self.error_rate = 0
+            dt = 0
+        else:
+            dt = now - self.last_time
+            if dt > 0:
+                rate = (error - self.last_error) / dt
+                self.error_rate += VisualServo.VELOCITY_SMOOTHING * (rate - self.error_rate)
+
+        self.last_error = error
+        self.last_time = now
+
+        predicted_error = error + self.error_rate * self.config.lookahead
+        x = self.pid.update(predicted_error, self.error_rate, dt)
+        x = max(-self.config.max_turn, min(self.config.max_turn, x))
+
+        if in_grab_zone:
+            # In the grab zone but not centered yet: only turn.
+            speed = 0
+        elif target is not None:
+            speed = self.__scheduled_speed(target[0])
+        else:
+            remaining = max(0, vdistance - self.start_pickup_vdist) / frame_height
+            speed = self.config.min_speed + (self.config.max_speed - self.config.min_speed) * \
+                min(1, remaining * self.config.approach_gain)
+        y = speed * self.__heading_slowdown(predicted_error)
+
+        if self.config.plan_horizon is not None:
+            return self.__plan(x, y, speed, predicted_error, now)
+
+        return self.__throttle(x, y, now)
+
+    def __heading_slowdown(self, error: float) -> float:
+        return max(0, 1 - abs(error) / self.config.heading_slowdown)
+
+    def __scheduled_speed(self, distance: float) -> float:
+        # The speed of a constant deceleration grows with the square root of
+        # the distance left.
+        remaining = max(0, distance - self.config.grab_range)
+        return self.config.min_speed + (self.config.far_speed - self.config.min_speed) * \
+            sqrt(min(1, remaining / self.config.slow_range))
+
+    def __throttle(self, x: float, y: float, now: float):
+        if self.last_sent is not None and now - self.last_sent_at < self.config.resend_interval and \
+                abs(x - self.last_sent[0]) < self.config.min_change and \
+                abs(y - self.last_sent[1]) < self.config.min_change:
+            return None
+
+        self.last_sent = (x, y)
+        self.last_sent_at = now
+
+        return MoveInstruction(x, y)
+
+    def __plan(self, x: float, y: float, speed: float, error: float, now: float):
+        if self.last_sent is not None and now - self.last_sent_at < self.config.plan_interval and \
+                abs(x - self.last_sent[0]) < self.config.plan_change and \
+                abs(y - self.last_sent[1]) < self.config.plan_change:
+            return None
+
+        self.last_sent = (x, y)
+        self.last_sent_at = now
+
+        step = self.config.plan_horizon / self.config.plan_segments
+        segments = [(step, x, y)]
+        for i in range(1, self.config.plan_segments):
+            # The turn shrinks with the heading error, which stops at zero
+            # instead of overshooting.
+            planned_error = error + self.error_rate * i * step
+            if planned_error * error <= 0:
+                planned_error = 0
+
+            turn = x * planned_error / error if error != 0 else x
+            turn = max(-self.config.max_turn, min(self.config.max_turn, turn))
+            segments.append((step, turn, speed * self.__heading_slowdown(planned_error)))
+
+        return TrajectoryInstruction(segments)
@@ -0,0 +1,100 @@
+from typing import List, Optional, Tuple
+
+POLICY_NEAREST = "nearest"
+POLICY_HEADING = "heading"
+POLICY_CONFIDENCE = "confidence"
+
+POLICIES = [POLICY_NEAREST, POLICY_HEADING, POLICY_CONFIDENCE]
+
+
+def box_bottom_center(box) -> Tuple[float, float]:
+    return (box['xmin'] + (box['xmax'] - box['xmin']) / 2, box['ymax'])
+
+
+class TargetSelector(object):
+    """
+    Picks the bottle the robot should drive to when several are in view. The
+    chosen target is followed across frames by matching the bottom center of
+    its box, so the robot does not switch between bottles on every frame. The
+    other bottles are kept as a ranked queue, which is used to pick the next
+    target when the current one is lost.
+    """
+
+    def __init__(self, policy: str = POLICY_NEAREST, max_target_jump: int = 80, max_missed_frames: int = 5) -> None:
+        if policy not in POLICIES:
+            raise ValueError("Unknown target policy '{}', expected one of {}".format(policy, POLICIES))
+
+        self.policy = policy
+        self.max_target_jump = max_target_jump
+        self.max_missed_frames = max_missed_frames
+        self.reset()
+
+    def reset(self):
+        self.target = None
+        self.queue = []
+        self.missed_frames = 0
+        # Whether the last selected target is a different bottle than the
+        # one before it.
+        self.switched = False
+
+    def select(self, boxes: List[dict], frame_width: int, frame_height: int) -> Optional[dict]:
+        """
+        Returns the box to steer towards in this frame, or None if neither the
+        current target nor any other bottle is visible.
+        """
+        if len(boxes) == 0:
+            self.__miss()
+            return None
+
+        ranked = sorted(boxes, key=lambda box: self.__score(box, frame_width, frame_height))
+
+        target = None
+        if self.target is not None:
+            target = self.__closest(self.target, ranked)
+
+        self.switched = target is None
+
+        if target is None:
+            for queued in self.queue:
+                target = self.__closest(queued, ranked)
+                if target is not None:
+                    break
+
+        if target is None:
+            target = ranked[0]
+
+        self.target = target
+        self.queue = [box for box in ranked if box is not target]
+        self.missed_frames = 0
+
+        return target
+
+    def __miss(self):
+        self.missed_frames += 1
+        if self.missed_frames > self.max_missed_frames:
+            self.reset()
+
+    def __closest(self, reference: dict, boxes: List[dict]) -> Optional[dict]:
+        ref_x, ref_y = box_bottom_center(reference)
+        closest, closest_distance = None, self.max_target_jump
+
+        for box in boxes:
+            x, y = box_bottom_center(box)
+            distance = ((x - ref_x) ** 2 + (y - ref_y) ** 2) ** 0.5
+            if distance <= closest_distance:
+                closest, closest_distance = box, distance
+
+        return closest
+
+    def __score(self, box: dict, frame_width: int, frame_height: int) -> float:
+        """
+        Lower is better for every policy.
+        """
+        x, y = box_bottom_center(box)
+
+        if self.policy == POLICY_NEAREST:
+            return frame_height - y
+        elif self.policy == POLICY_HEADING:
+            return abs(frame_width / 2 - x)
+        else:
+            return -box['conf']
@@ -0,0 +1,101 @@
+import logging
+from collections import deque
+from threading import Lock
+from time import time
+
+from core.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+telemetry_counter = REGISTRY.counter("telemetry_received", "Telemetry messages received from the robot")
+fused_counter = REGISTRY.counter("fused_pickups", "Pickups started because the ultrasonic distance confirmed a close bottle")
+
+
+class RobotTelemetry(object):
+    """
+    The recent telemetry samples of the robot, updated from paho's network
+    thread. The robot publishes its samples in batches, so every sample of a
+    message is kept, numbered in arrival order. The robot's clock is not
+    synchronized with ours, so the age of a sample is taken from when its
+    message arrived.
+    """
+
+    def __init__(self, history: int = 50, clock=time) -> None:
+        self.clock = clock
+        self.lock = Lock()
+        self.samples = deque(maxlen=history)
+        self.received = 0
+
+    def update(self, message: dict):
+        fields = message.get("fields") or []
+        samples = message.get("samples") or []
+        if len(samples) == 0:
+            return
+
+        telemetry_counter.inc()
+        with self.lock:
+            arrived_at = self.clock()
+            for values in samples:
+                self.received += 1
+                self.samples.append((self.received, dict(zip(fields, values)), arrived_at))
+
+    def since(self, number: int) -> tuple:
+        """
+        The samples numbered after `number` with their age in seconds, oldest
+        first, and the number of the latest sample.
+        """
+        with self.lock:
+            now = self.clock()
+            samples = [(sample, now - arrived_at) for (n, sample, arrived_at) in self.samples if n > number]
+            return samples, self.received
+
+
+class RangeFusion(object):
+    """
+    Starts the pickup when the ultrasonic sensor confirms what the camera
+    sees: a bottle in the lower part of the frame, close to the center where
+    the sensor points, and a distance reading within max_range cm. The
+    sensor reads the bottle sooner and more precisely than its box reaches
+    the pickup line, but its wide beam also hits walls and furniture, which
+    is why it only counts together with the box. The reading has to confirm
+    the bottle on `confirmations` telemetry samples in a row. Every sample
+    of a batch counts once, in order, on the first frame after its message
+    arrived; samples that arrive while the bottle is not in front are
+    skipped, and one older than max_age by then breaks the row. Only the
+    frame following the message needs to come within max_age, so the
+    telemetry rate and batch size do not bound it.
+    """
+
+    def __init__(self, telemetry: RobotTelemetry, max_range: float, max_offset: float = 0.1, max_age: float = 0.5,
+                 confirmations: int = 2) -> None:
+        self.telemetry = telemetry
+        self.max_range = max_range
+        self.max_offset = max_offset
+        self.max_age = max_age
+        self.confirmations = confirmations
+        self.confirmed = 0
+        self.last_sample = 0
+
+    def reset(self):
+        self.confirmed = 0
+
+    def confirms(self, hdistance: float, vdistance: float, frame_width: int, frame_height: int) -> bool:
+        samples, self.last_sample = self.telemetry.since(self.last_sample)
+        in_front = abs(hdistance) < frame_width * self.max_offset and vdistance < frame_height / 2
+
+        if not in_front:
+            self.reset()
+            return False
+
+        for sample, age in samples:
+            if age > self.max_age or sample.get("distance") is None or sample["distance"] > self.max_range:
+                self.reset()
+                continue
+
+            self.confirmed += 1
+            if self.confirmed >= self.confirmations:
+                logger.info("Ultrasonic distance %s cm confirms the bottle", sample["distance"])
+                fused_counter.inc()
+                self.reset()
+                return True
+
+        return False
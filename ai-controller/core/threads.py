@@ -0,0 +1,63 @@
+import logging
+import os
+from typing import List
+
+import cv2
+
+logger = logging.getLogger(__name__)
+
+
+class ThreadConfig(object):
+    """
+    The thread pool sizes and CPU affinity for each thread of the pipeline.
+    Any value that is None is left at the library or OS default.
+    """
+
+    def __init__(self, torch_threads: int = None, torch_interop_threads: int = None, opencv_threads: int = None,
+                 inference_cpus: List[int] = None, capture_cpus: List[int] = None, server_cpus: List[int] = None,
+                 mqtt_cpus: List[int] = None):
+        self.torch_threads = torch_threads
+        self.torch_interop_threads = torch_interop_threads
+        self.opencv_threads = opencv_threads
+        self.inference_cpus = inference_cpus
+        self.capture_cpus = capture_cpus
+        self.server_cpus = server_cpus
+        self.mqtt_cpus = mqtt_cpus
+
+
+def configure_thread_pools(config: ThreadConfig):
+    """
+    Sizes the torch and OpenCV thread pools. This has to run before the first
+    inference, since torch refuses to resize the inter-op pool once it has
+    been used.
+    """
+    # Imported here, so the capture process can pin itself without loading
+    # torch.
+    import torch
+
+    if config.torch_threads is not None:
+        torch.set_num_threads(config.torch_threads)
+
+    if config.torch_interop_threads is not None:
+        try:
+            torch.set_num_interop_threads(config.torch_interop_threads)
+        except RuntimeError as e:
+            logger.warning("Could not set torch inter-op threads: %s", e)
+
+    if config.opencv_threads is not None:
+        cv2.setNumThreads(config.opencv_threads)
+
+
+def pin_current_thread(cpus: List[int]):
+    """
+    Restricts the calling thread to the given CPUs. Threads started afterwards
+    from this thread (such as torch's worker pool) inherit the affinity. Does
+    nothing when cpus is empty or the platform has no affinity support.
+    """
+    if not cpus or not hasattr(os, "sched_setaffinity"):
+        return
+
+    try:
+        os.sched_setaffinity(0, cpus)
+    except OSError as e:
+        logger.warning("Could not pin thread to CPUs %s: %s", cpus, e)
@@ -1,8 +1,16 @@
-from time import sleep
+from time import sleep, time
 import cv2
 import io
+import logging
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
 import threading
+from urllib.parse import parse_qs, urlparse
+
+from core.metrics import REGISTRY
+from core.threads import pin_current_thread
+
+logger = logging.getLogger(__name__)
 
 
 class FrameBuffer:
@@ -11,6 +19,29 @@ class FrameBuffer:
         self.frame = None
         # buffer to hold incoming frame
         self.buffer = io.BytesIO()
+        # the detections of the latest frame, for the vector overlay, which
+        # is only served when vector_overlay is set, and the message sent
+        # for it, with the time it changed
+        self.overlay = None
+        self.overlay_message = None
+        self.overlay_version = 0
+        self.vector_overlay = False
+        # the number of clients watching the stream, frames are only encoded
+        # while there is at least one
+        self.subscribers = 0
+        self.cv = threading.Condition()
+
+    @property
+    def has_subscribers(self) -> bool:
+        return self.subscribers > 0
+
+    def subscribe(self):
+        with self.cv:
+            self.subscribers += 1
+
+    def unsubscribe(self):
+        with self.cv:
+            self.subscribers -= 1
 
     def write(self, buf):
         # if it's a JPEG image
@@ -20,7 +51,45 @@ class FrameBuffer:
             self.buffer.write(buf)
             # extract frame
             self.buffer.truncate()
-            self.frame = self.buffer.getvalue()
+            with self.cv:
+                self.frame = self.buffer.getvalue()
+                self.cv.notify_all()
+
+    def set_overlay(self, overlay: dict):
+        """
+        Publishes the overlay of the latest frame to the /overlay clients,
+        unless it is the same as the last one. The timestamp is only added
+        here, so it does not make every overlay look new.
+        """
+        with self.cv:
+            if overlay == self.overlay:
+                return
+
+            self.overlay = overlay
+            self.overlay_message = dict(overlay, timestamp=time())
+            self.overlay_version += 1
+            self.cv.notify_all()
+
+    def wait_for_overlay(self, version: int, timeout: float):
+        """
+        Returns the latest overlay and its version once it is newer than
+        version, or None if it did not change within the timeout.
+        """
+        with self.cv:
+            if not self.cv.wait_for(lambda: self.overlay_version > version, timeout):
+                return None
+
+            return (self.overlay_message, self.overlay_version)
+
+    def wait_for_frame(self, timeout: float = 1):
+        """
+        Returns the latest frame, waiting for the first one after a client
+        subscribed, since nothing is encoded while no one watches. Returns
+        None if no frame arrived in time.
+        """
+        with self.cv:
+            self.cv.wait_for(lambda: self.frame is not None, timeout)
+            return self.frame
 
 
 class MJPEGServer(BaseHTTPRequestHandler):
@@ -29,9 +98,29 @@ class MJPEGServer(BaseHTTPRequestHandler):
     or republishes images from another pygecko process.
     """
 
+    profiler = None
+
+    # Seconds between the comments sent while the overlay does not change,
+    # so a closed connection is noticed and its thread ends.
+    OVERLAY_HEARTBEAT = 5
+
     def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/profile' and MJPEGServer.profiler is not None:
+            self.__start_profile(url.query)
+            return
+
+        if self.path == '/metrics':
+            body = REGISTRY.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', len(body))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
         if not MJPEGServer.frame_buffer:
-            print("No framebuffer found!")
+            logger.warning("No framebuffer found!")
             self.send_response(404)
             self.send_header('Content-type', 'text/html')
             self.end_headers()
@@ -48,18 +137,46 @@ class MJPEGServer(BaseHTTPRequestHandler):
             self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
             self.end_headers()
 
-            while True:
-                frame = MJPEGServer.frame_buffer.frame
-                self.wfile.write(b'--FRAME\r\n')
-                self.send_header('Content-Type', 'image/jpeg')
-                self.send_header('Content-Length', len(frame))
-                self.end_headers()
-                self.wfile.write(frame)
-                self.wfile.write(b'\r\n')
-                sleep(0.1)
+            MJPEGServer.frame_buffer.subscribe()
+            try:
+                while True:
+                    frame = MJPEGServer.frame_buffer.wait_for_frame()
+                    if frame is None:
+                        continue
+
+                    self.wfile.write(b'--FRAME\r\n')
+                    self.send_header('Content-Type', 'image/jpeg')
+                    self.send_header('Content-Length', len(frame))
+                    self.end_headers()
+                    self.wfile.write(frame)
+                    self.wfile.write(b'\r\n')
+                    sleep(0.1)
+            finally:
+                MJPEGServer.frame_buffer.unsubscribe()
+
+        elif self.path == '/overlay' and MJPEGServer.frame_buffer.vector_overlay:
+            # Server-sent events, so a browser reads them with EventSource.
+            self.send_response(200)
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+
+            version = 0
+            try:
+                while True:
+                    update = MJPEGServer.frame_buffer.wait_for_overlay(version, MJPEGServer.OVERLAY_HEARTBEAT)
+                    if update is None:
+                        self.wfile.write(b': heartbeat\n\n')
+                    else:
+                        overlay, version = update
+                        self.wfile.write('data: {}\n\n'.format(json.dumps(overlay)).encode('utf-8'))
+                    self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                logger.debug("Overlay client disconnected")
 
         else:
-            print('error', self.path)
+            logger.warning("Unknown path %s", self.path)
             self.send_response(404)
             self.send_header('Content-type', 'text/html')
             self.end_headers()
@@ -67,11 +184,39 @@ class MJPEGServer(BaseHTTPRequestHandler):
             self.wfile.write('<h1>{0!s} not found</h1>'.format(self.path).encode('utf-8'))
             self.wfile.write('</body></html>'.encode('utf-8'))
 
-def run_mjpeg_server():
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def __start_profile(self, query: str):
+        """
+        Starts profiling the main loop, e.g. GET /profile?seconds=10. Answers
+        with the path of the profile, or 409 while one is being taken.
+        """
+        try:
+            seconds = float(parse_qs(query).get('seconds', ['10'])[0])
+        except ValueError:
+            self.send_response(400)
+            self.end_headers()
+            return
+
+        output_path = MJPEGServer.profiler.start(seconds)
+        body = json.dumps({"output": output_path}).encode('utf-8')
+
+        self.send_response(409 if output_path is None else 202)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
+def run_mjpeg_server(cpus=None, profiler=None):
     frame_buffer = FrameBuffer()
     MJPEGServer.frame_buffer = frame_buffer
+    MJPEGServer.profiler = profiler
 
     def runner():
+        # Request handler threads are started from here and inherit the
+        # affinity.
+        pin_current_thread(cpus)
         address = ('', 9000)
         httpd = ThreadingHTTPServer(address, MJPEGServer)
         httpd.serve_forever()
@@ -0,0 +1,68 @@
+import cv2
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+KEY_ESC = 27
+KEY_ENTER = 13
+
+
+class ViewerConfig(object):
+    """
+    Whether to show the frames in a local window, and how often it refreshes.
+    Without the window the program runs headless, and the frames are only
+    available from the MJPEG server.
+    """
+
+    def __init__(self, enabled: bool = True, fps: float = 15) -> None:
+        self.enabled = enabled
+        self.fps = fps
+
+
+class LocalViewer(object):
+    """
+    Shows the latest frame in an OpenCV window from its own thread, so the
+    GUI event handling of imshow and waitKey never runs in the control loop.
+    The control loop only hands over a reference to the frame. Enter toggles
+    the AI and Esc quits, like before.
+    """
+
+    def __init__(self, config: ViewerConfig, on_toggle, on_quit) -> None:
+        self.config = config
+        self.on_toggle = on_toggle
+        self.on_quit = on_quit
+        self.frame = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def show(self, frame):
+        self.frame = frame
+
+    def __run(self):
+        delay = max(1, int(1000 / self.config.fps))
+        shown = None
+
+        while not self.stopped.is_set():
+            frame = self.frame
+            if frame is not None and frame is not shown:
+                cv2.imshow("Image", frame)
+                shown = frame
+
+            key = cv2.waitKey(delay)
+            if key == KEY_ESC:
+                self.on_quit()
+            elif key == KEY_ENTER:
+                self.on_toggle()
+
+        cv2.destroyAllWindows()
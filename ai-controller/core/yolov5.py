@@ -1,34 +1,237 @@
+import cv2
+import hashlib
+import json
 import torch
+import torchvision
 import os
 import logging
 from PIL import Image
 
+from core.preprocess import PAD_VALUE, letterbox_shape
+
 yolo_model = 'yolov5s'
+WEIGHTS = 'last_plastic_botte.pt'
+CONF_THRESHOLD = 0.7  # confidence threshold (0-1)
+IOU_THRESHOLD = 0.45  # NMS IoU threshold (0-1)
 
 logging.info(f"YOLO model - {yolo_model}")
 
-model = torch.hub.load("ultralytics/yolov5", 'custom', path='last_plastic_botte.pt')
+# Loaded on first use, since loading through torch hub is slow and not needed
+# when every input shape has a prepared artifact.
+model = None
+
+
+def load_model():
+    global model
+    if model is None:
+        model = torch.hub.load("ultralytics/yolov5", 'custom', path=WEIGHTS)
+        model.conf = CONF_THRESHOLD
+        model.iou = IOU_THRESHOLD
 
+    return model
 
-def yolov5(img):
+
+def yolov5(img, size=416):
     """Process a PIL image."""
 
     # Inference
-    model.conf = 0.7  # confidence threshold (0-1)
-    model.iou = 0.45  # NMS IoU threshold (0-1)
-
-    results = model(img, size=416)
+    results = load_model()(img, size=size)
     names = results.names
 
     bbs = []
     height, width, channels = img.shape
     if results.xyxy is not None:
-        res = results.xyxy[0]
-        if len(res) > 0:
-            xmin, ymin, xmax, ymax, conf = res[0][0].item(), res[0][1].item(), res[0][2].item(), res[0][3].item(), \
-                                           res[0][4].item()
+        for row in results.xyxy[0]:
+            xmin, ymin, xmax, ymax, conf = row[0].item(), row[1].item(), row[2].item(), row[3].item(), \
+                                           row[4].item()
             bb = {'xmin': round(xmin, 2), 'ymin': round(ymin, 2), 'xmax': round(xmax, 2),
-                  'ymax': round(ymax, 2), 'conf': round(conf, 2), 'prediction': names[int(res[0][5].item())]}
+                  'ymax': round(ymax, 2), 'conf': round(conf, 2), 'prediction': names[int(row[5].item())]}
             bbs.append(bb)
 
     return width, height, bbs
+
+
+def weights_hash(weights: str = WEIGHTS) -> str:
+    digest = hashlib.sha256()
+    with open(weights, 'rb') as weights_file:
+        for chunk in iter(lambda: weights_file.read(1 << 20), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()[:16]
+
+
+def artifact_path(directory: str, digest: str, height: int, width: int) -> str:
+    return os.path.join(directory, "{}-{}x{}.torchscript".format(digest, height, width))
+
+
+def load_artifacts(directory: str, weights: str = WEIGHTS):
+    """
+    Loads the TorchScript artifacts prepare_model.py made from the current
+    weights. Returns the networks by (height, width) of their input, and the
+    class names. Artifacts of other weights are ignored.
+    """
+    networks = {}
+    names = None
+    if not os.path.isdir(directory) or not os.path.isfile(weights):
+        return (networks, names)
+
+    prefix = weights_hash(weights) + "-"
+    for file_name in sorted(os.listdir(directory)):
+        if not file_name.startswith(prefix) or not file_name.endswith(".torchscript"):
+            continue
+
+        height, width = file_name[len(prefix):-len(".torchscript")].split("x")
+        extra_files = {"names.json": ""}
+        networks[(int(height), int(width))] = torch.jit.load(
+            os.path.join(directory, file_name), map_location="cpu", _extra_files=extra_files
+        )
+        names = json.loads(extra_files["names.json"])
+        logging.info("Loaded model artifact %s", file_name)
+
+    return (networks, names)
+
+
+# inference_mode skips the autograd bookkeeping no_grad still does, it was
+# added in torch 1.9.
+inference_mode = getattr(torch, "inference_mode", torch.no_grad)
+
+
+class TensorBackend(object):
+    """
+    Runs the model without the AutoShape wrapper. AutoShape checks the input
+    type, copies, letterboxes, normalizes and stacks the image on every call
+    and builds a Detections object we only read the boxes from. Here the
+    frame is copied into a float tensor that is allocated once per input
+    shape and fed straight into the network, followed by a plain NMS.
+
+    Frames coming from the Preprocessor are already sized and padded for the
+    model. Other frames are letterboxed here, and their boxes are scaled back
+    to the frame. The channels are passed in the order AutoShape got them, so
+    both backends detect the same.
+
+    Input shapes with a prepared artifact run the fused, traced channels_last
+    network from it, the others the model loaded through torch hub.
+    """
+
+    def __init__(self, network=None, names=None, conf: float = CONF_THRESHOLD, iou: float = IOU_THRESHOLD,
+                 stride: int = 32, max_det: int = 1000, artifacts: dict = None) -> None:
+        self.network = network
+        self.names = names
+        self.conf = conf
+        self.iou = iou
+        self.stride = stride
+        self.max_det = max_det
+        self.artifacts = artifacts if artifacts is not None else {}
+        self.inputs = {}
+
+    def warmup(self):
+        """
+        Runs every artifact a few times, since TorchScript optimizes a
+        network during its first runs, which would otherwise stall the first
+        frames.
+        """
+        with inference_mode():
+            for height, width in self.artifacts:
+                network, tensor = self.__get_input(height, width)
+                tensor.zero_()
+                for _ in range(3):
+                    network(tensor)
+
+    def __call__(self, img, size=416):
+        height, width, _ = img.shape
+        image, scale, pad_x, pad_y = self.__letterbox(img, size)
+
+        with inference_mode():
+            network, tensor = self.__get_input(image.shape[0], image.shape[1])
+            # copy_ converts from uint8 HWC to the NCHW layout and type of
+            # the tensor in one pass.
+            tensor[0].copy_(torch.from_numpy(image).permute(2, 0, 1))
+            prediction = network(tensor.mul_(1 / 255))
+            if isinstance(prediction, (list, tuple)):
+                prediction = prediction[0]
+            detections = self.__nms(prediction[0]).cpu().tolist()
+
+        bbs = []
+        for xmin, ymin, xmax, ymax, conf, cls in detections:
+            bb = {'xmin': round((xmin - pad_x) / scale, 2), 'ymin': round((ymin - pad_y) / scale, 2),
+                  'xmax': round((xmax - pad_x) / scale, 2), 'ymax': round((ymax - pad_y) / scale, 2),
+                  'conf': round(conf, 2), 'prediction': self.names[int(cls)]}
+            bbs.append(bb)
+
+        return width, height, bbs
+
+    def __letterbox(self, img, size: int):
+        height, width, _ = img.shape
+        if max(height, width) == size and height % self.stride == 0 and width % self.stride == 0:
+            return (img, 1, 0, 0)
+
+        scale, scaled_width, scaled_height, input_width, input_height = letterbox_shape(
+            width, height, size, self.stride
+        )
+        pad_x = (input_width - scaled_width) / 2
+        pad_y = (input_height - scaled_height) / 2
+
+        image = cv2.resize(img, (scaled_width, scaled_height), interpolation=cv2.INTER_LINEAR)
+        image = cv2.copyMakeBorder(
+            image,
+            int(round(pad_y - 0.1)), int(round(pad_y + 0.1)), int(round(pad_x - 0.1)), int(round(pad_x + 0.1)),
+            cv2.BORDER_CONSTANT,
+            value=PAD_VALUE
+        )
+
+        return (image, scale, pad_x, pad_y)
+
+    def __get_input(self, height: int, width: int):
+        """
+        The network for the input shape and the tensor its input is copied
+        into.
+        """
+        key = (height, width)
+        if key not in self.inputs:
+            if key in self.artifacts:
+                # Artifacts are traced on the CPU, in channels_last.
+                network = self.artifacts[key]
+                tensor = torch.empty((1, 3, height, width), dtype=torch.float32)
+                tensor = tensor.contiguous(memory_format=torch.channels_last)
+            else:
+                logging.info("No model artifact for %dx%d input, using the torch hub model", height, width)
+                network = self.__get_network()
+                parameter = next(network.parameters())
+                tensor = torch.empty((1, 3, height, width), dtype=parameter.dtype, device=parameter.device)
+
+            self.inputs[key] = (network, tensor)
+
+        return self.inputs[key]
+
+    def __get_network(self):
+        if self.network is None:
+            self.network = load_model().model
+            self.network.eval()
+        if self.names is None:
+            self.names = load_model().names
+
+        return self.network
+
+    def __nms(self, prediction):
+        """
+        Turns the raw (boxes, 5 + classes) output into (xmin, ymin, xmax,
+        ymax, conf, class) rows, like non_max_suppression of YOLOv5 with a
+        single label per box.
+        """
+        prediction = prediction[prediction[:, 4] > self.conf]
+        if prediction.shape[0] == 0:
+            return prediction.new_zeros((0, 6))
+
+        scores = prediction[:, 5:] * prediction[:, 4:5]
+        conf, cls = scores.max(1)
+        keep = conf > self.conf
+        prediction, conf, cls = prediction[keep], conf[keep], cls[keep]
+
+        boxes = prediction[:, :4].clone()
+        boxes[:, 0] = prediction[:, 0] - prediction[:, 2] / 2
+        boxes[:, 1] = prediction[:, 1] - prediction[:, 3] / 2
+        boxes[:, 2] = prediction[:, 0] + prediction[:, 2] / 2
+        boxes[:, 3] = prediction[:, 1] + prediction[:, 3] / 2
+
+        keep = torchvision.ops.batched_nms(boxes.float(), conf.float(), cls, self.iou)[:self.max_det]
+        return torch.cat((boxes[keep], conf[keep, None], cls[keep, None].to(boxes.dtype)), 1)
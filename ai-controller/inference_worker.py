@@ -0,0 +1,43 @@
+"""
+Runs the detection model for ai-controllers that cannot keep up on their
+own, e.g. on a desktop next to a robot with a weak laptop. List the worker
+in remote.workers of the controller's config.yml. Several workers can run
+on one machine on different ports, and several controllers can share them.
+
+    python3 inference_worker.py --port 9100
+"""
+import argparse
+import os
+
+from core.logger import start_logging, stop_logging
+from core.remote import run_worker_server
+from core.threads import ThreadConfig, configure_thread_pools
+from core.yolov5 import TensorBackend, load_artifacts
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--model_dir', type=str, default=os.path.join(os.path.dirname(os.path.realpath(__file__)), 'models'),
+                        help='where prepare_model.py saved the artifacts')
+    parser.add_argument('--torch_threads', type=int, default=None)
+    return parser.parse_args()
+
+
+def main():
+    args = arg_parser()
+    start_logging()
+    configure_thread_pools(ThreadConfig(args.torch_threads))
+
+    artifacts, names = load_artifacts(args.model_dir)
+    backend = TensorBackend(names=names, artifacts=artifacts)
+    backend.warmup()
+
+    try:
+        run_worker_server(backend, args.port)
+    finally:
+        stop_logging()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,44 @@
 import cv2
+import logging
+import signal
+import threading
 from os import path
+from time import perf_counter
 from typing import Tuple
 import yaml
 
 from core.detection import DetectionConfig, BufferlessVideoCapture, BottleDetector
+from core.ground import GroundPlane
 from core.instructions import *
+from core.logger import LoggingConfig, start_logging, stop_logging
+from core.metrics import REGISTRY, RateMeter
+from core.motion_gate import MotionGate
 from core.mqtt_connection import ConnectionConfig, MqttConnection
+from core.overlay import OVERLAY_VECTOR, OverlayConfig, render_preview, to_vector_overlay
+from core.power import CaptureThrottle, PowerConfig
+from core.preprocess import Preprocessor
+from core.profiler import ProfilerConfig, SamplingProfiler
+from core.remote import RemoteConfig, RemoteInference
+from core.resolution import ResolutionController
+from core.shm_capture import SharedMemoryCapture
+from core.steering import ServoConfig, ThresholdSteering, VisualServo
+from core.targeting import TargetSelector
+from core.telemetry import RangeFusion, RobotTelemetry
+from core.threads import ThreadConfig, configure_thread_pools, pin_current_thread
 from core.video_server import run_mjpeg_server
+from core.viewer import LocalViewer, ViewerConfig
+from core.yolov5 import TensorBackend, load_artifacts, yolov5
 
 CONFIG_NAME = "config.yml"
+# Seconds the loop waits for a frame before it checks again whether it should
+# stop or decode more frames.
+READ_TIMEOUT = 0.1
 
+logger = logging.getLogger(__name__)
 
-def load_config() -> Tuple[ConnectionConfig, DetectionConfig]:
+
+def load_config() -> Tuple[ConnectionConfig, DetectionConfig, ThreadConfig, ServoConfig, LoggingConfig, ProfilerConfig,
+                           ViewerConfig, OverlayConfig, RemoteConfig, PowerConfig, GroundPlane]:
     """
     Loads the yaml config into memory. The config file has unique values for
     each environment, and is therefore not committed to the repository. There
@@ -57,17 +84,128 @@ def load_config() -> Tuple[ConnectionConfig, DetectionConfig]:
         parsed_config["mqtt_server"].get("host"),
         parsed_config["mqtt_server"].get("port"),
         parsed_config["mqtt_server"].get("keep_alive"),
-        parsed_config["mqtt_server"].get("topic")
+        parsed_config["mqtt_server"].get("topic"),
+        parsed_config["mqtt_server"].get("robot_id"),
+        parsed_config["mqtt_server"].get("topic_presence") or "fleet/presence",
+        parsed_config["mqtt_server"].get("reconnect_min_delay", 0.1),
+        parsed_config["mqtt_server"].get("reconnect_max_delay", 2),
+        parsed_config["mqtt_server"].get("offline_queue_size", 32),
+        parsed_config["mqtt_server"].get("topic_telemetry")
     )
 
     detection_config = DetectionConfig(
         parsed_config["detection"].get("image_url"),
         parsed_config["detection"].get("failed_detection_threshold"),
         parsed_config["detection"].get("bottom_blackout_height"),
-        parsed_config["detection"].get("start_pickup_vdist")
+        parsed_config["detection"].get("start_pickup_vdist"),
+        parsed_config["detection"].get("target_policy", "nearest"),
+        parsed_config["detection"].get("max_target_jump", 80),
+        parsed_config["detection"].get("input_sizes"),
+        parsed_config["detection"].get("latency_budget_ms", 150),
+        parsed_config["detection"].get("near_vdist", 150),
+        parsed_config["detection"].get("marginal_conf", 0.8),
+        parsed_config["detection"].get("motion_threshold", 2.0),
+        parsed_config["detection"].get("max_reused_frames", 15),
+        parsed_config["detection"].get("steering", "pid"),
+        parsed_config["detection"].get("preprocessing", "remap"),
+        parsed_config["detection"].get("camera_matrix"),
+        parsed_config["detection"].get("dist_coeffs"),
+        parsed_config["detection"].get("backend", "tensor"),
+        # Relative to the config file, an absolute path is kept as is.
+        path.join(path.dirname(config_path), parsed_config["detection"].get("model_dir", "models")),
+        parsed_config["detection"].get("capture", "process"),
+        parsed_config["detection"].get("capture_slots", 3),
+        parsed_config["detection"].get("fusion_range")
+    )
+
+    thread_config = parsed_config.get("threads") or {}
+    thread_config = ThreadConfig(
+        thread_config.get("torch_threads"),
+        thread_config.get("torch_interop_threads"),
+        thread_config.get("opencv_threads"),
+        thread_config.get("inference_cpus"),
+        thread_config.get("capture_cpus"),
+        thread_config.get("server_cpus"),
+        thread_config.get("mqtt_cpus")
     )
 
-    return (connection_config, detection_config)
+    servo_config = parsed_config.get("servo") or {}
+    defaults = ServoConfig()
+    servo_config = ServoConfig(
+        servo_config.get("kp", defaults.kp),
+        servo_config.get("ki", defaults.ki),
+        servo_config.get("kd", defaults.kd),
+        servo_config.get("lookahead", defaults.lookahead),
+        servo_config.get("max_turn", defaults.max_turn),
+        servo_config.get("min_speed", defaults.min_speed),
+        servo_config.get("max_speed", defaults.max_speed),
+        servo_config.get("approach_gain", defaults.approach_gain),
+        servo_config.get("heading_slowdown", defaults.heading_slowdown),
+        servo_config.get("pickup_tolerance", defaults.pickup_tolerance),
+        servo_config.get("min_change", defaults.min_change),
+        servo_config.get("resend_interval", defaults.resend_interval),
+        servo_config.get("far_speed", defaults.far_speed),
+        servo_config.get("slow_range", defaults.slow_range),
+        servo_config.get("grab_range", defaults.grab_range),
+        servo_config.get("grab_lateral", defaults.grab_lateral),
+        servo_config.get("bearing_scale", defaults.bearing_scale),
+        servo_config.get("plan_horizon", defaults.plan_horizon),
+        servo_config.get("plan_segments", defaults.plan_segments),
+        servo_config.get("plan_interval", defaults.plan_interval),
+        servo_config.get("plan_change", defaults.plan_change)
+    )
+
+    logging_config = parsed_config.get("logging") or {}
+    logging_config = LoggingConfig(
+        logging_config.get("level", "INFO"),
+        logging_config.get("rate", 1),
+        logging_config.get("burst", 5)
+    )
+
+    profiler_config = parsed_config.get("profiler") or {}
+    profiler_config = ProfilerConfig(
+        # Relative to the config file, an absolute path is kept as is.
+        path.join(path.dirname(config_path), profiler_config.get("output_dir", "profiles")),
+        profiler_config.get("interval", 0.005),
+        profiler_config.get("max_seconds", 60)
+    )
+
+    viewer_config = parsed_config.get("viewer") or {}
+    viewer_config = ViewerConfig(
+        viewer_config.get("enabled", True),
+        viewer_config.get("fps", 15)
+    )
+
+    overlay_config = parsed_config.get("overlay") or {}
+    overlay_config = OverlayConfig(
+        overlay_config.get("mode", "raster"),
+        overlay_config.get("preview_scale", 1)
+    )
+
+    remote_config = parsed_config.get("remote") or {}
+    remote_config = RemoteConfig(
+        remote_config.get("workers") or [],
+        remote_config.get("deadline_ms", 150),
+        remote_config.get("retry_interval", 5),
+        remote_config.get("encoding", "jpeg"),
+        remote_config.get("jpeg_quality", 90)
+    )
+
+    power_config = parsed_config.get("power") or {}
+    power_config = PowerConfig(
+        power_config.get("idle_fps", 2),
+        power_config.get("pause_unwatched", True)
+    )
+
+    ground_config = parsed_config.get("ground") or {}
+    ground_plane = None
+    if ground_config.get("homography") is not None:
+        ground_plane = GroundPlane(ground_config.get("homography"))
+
+    return (
+        connection_config, detection_config, thread_config, servo_config, logging_config, profiler_config,
+        viewer_config, overlay_config, remote_config, power_config, ground_plane
+    )
 
 
 def discard_bottom_pixels(frame, frame_width, frame_height, discard_height):
@@ -80,59 +218,182 @@ def discard_bottom_pixels(frame, frame_width, frame_height, discard_height):
     )
 
 
+def rotate_frame(frame, discard_height):
+    frame = cv2.rotate(frame, cv2.ROTATE_90_CLOCKWISE)
+    frame_height, frame_width, _ = frame.shape
+
+    return discard_bottom_pixels(frame, frame_width, frame_height, discard_height)
+
+
 def main():
     main.run_model = False
     config_load_result = load_config()
     if config_load_result is None:
         return
 
-    connection_config, detection_config = config_load_result
+    connection_config, detection_config, thread_config, servo_config, logging_config, profiler_config, \
+        viewer_config, overlay_config, remote_config, power_config, ground_plane = config_load_result
+
+    start_logging(logging_config.level, logging_config.rate, logging_config.burst)
+
+    configure_thread_pools(thread_config)
+
+    mqtt_connection = MqttConnection(connection_config, thread_config.mqtt_cpus)
+    target_selector = TargetSelector(detection_config.target_policy, detection_config.max_target_jump)
+    resolution_controller = ResolutionController(
+        detection_config.input_sizes,
+        detection_config.latency_budget,
+        detection_config.near_vdist,
+        detection_config.marginal_conf
+    )
+    if detection_config.steering == "threshold":
+        steering = ThresholdSteering(detection_config.start_pickup_vdist)
+    else:
+        steering = VisualServo(detection_config.start_pickup_vdist, servo_config, ground_plane)
+
+    preprocessor = None
+    if detection_config.preprocessing == "remap":
+        preprocessor = Preprocessor(
+            detection_config.bottom_blackout_height,
+            detection_config.camera_matrix,
+            detection_config.dist_coeffs
+        )
 
-    mqtt_connection = MqttConnection(connection_config)
-    detector = BottleDetector(detection_config.failed_detection_threshold, detection_config.start_pickup_vdist)
-    capture = BufferlessVideoCapture(detection_config.image_url)
+    inference = yolov5
+    if detection_config.backend == "tensor":
+        artifacts, names = load_artifacts(detection_config.model_dir)
+        inference = TensorBackend(names=names, artifacts=artifacts)
+        inference.warmup()
+    if remote_config.workers:
+        # The local model stays loaded, to take over when no worker answers.
+        inference = RemoteInference(remote_config, inference)
+
+    telemetry = RobotTelemetry()
+    fusion = None
+    if detection_config.fusion_range is not None:
+        fusion = RangeFusion(telemetry, detection_config.fusion_range)
+
+    detector = BottleDetector(
+        detection_config.failed_detection_threshold,
+        detection_config.start_pickup_vdist,
+        target_selector,
+        resolution_controller,
+        MotionGate(detection_config.motion_threshold, max_reused_frames=detection_config.max_reused_frames),
+        steering,
+        preprocessor,
+        inference,
+        fusion
+    )
+    if detection_config.capture == "process":
+        capture = SharedMemoryCapture(
+            detection_config.image_url,
+            thread_config.capture_cpus,
+            detection_config.capture_slots
+        )
+    else:
+        capture = BufferlessVideoCapture(detection_config.image_url, thread_config.capture_cpus)
+    throttle = CaptureThrottle(power_config, capture)
 
 
     def on_active_change(new_active_state: bool) -> None:
-        print("Changing AI active status: {}".format(new_active_state))
+        logger.info("Changing AI active status: %s", new_active_state)
 
         if new_active_state:
             detector.initialize()
 
         main.run_model = new_active_state
+        if new_active_state:
+            # Decodes every frame again right away rather than on the next
+            # loop iteration.
+            throttle.update(True, True)
+
+    stop_requested = threading.Event()
+
+    def on_shutdown() -> None:
+        logger.info("Shutdown requested")
+        stop_requested.set()
+
+    def on_toggle() -> None:
+        on_active_change(not main.run_model)
+
+    # Without a window these are the local controls: SIGINT or SIGTERM stops
+    # the program, SIGUSR1 toggles the AI.
+    signal.signal(signal.SIGINT, lambda signum, frame: on_shutdown())
+    signal.signal(signal.SIGTERM, lambda signum, frame: on_shutdown())
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: on_toggle())
+
+    # Profiles the thread running the detection loop below.
+    profiler = SamplingProfiler(threading.get_ident(), profiler_config)
 
     mqtt_connection.on_active_change = on_active_change
+    mqtt_connection.on_profile_request = profiler.start
+    mqtt_connection.on_shutdown_request = on_shutdown
+    mqtt_connection.on_telemetry = telemetry.update
     mqtt_connection.connect()
 
-    mjpeg_image_buffer = run_mjpeg_server()
+    mjpeg_image_buffer = run_mjpeg_server(thread_config.server_cpus, profiler)
+    mjpeg_image_buffer.vector_overlay = overlay_config.mode == OVERLAY_VECTOR
+
+    viewer = None
+    if viewer_config.enabled:
+        viewer = LocalViewer(viewer_config, on_toggle, on_shutdown)
+        viewer.start()
 
-    while True:
-        frame = cv2.rotate(capture.read(), cv2.ROTATE_90_CLOCKWISE)
-        frame_height, frame_width, _ = frame.shape
+    # Pinned last, so the threads started above do not inherit the inference
+    # CPUs. Torch starts its worker threads on the first inference.
+    pin_current_thread(thread_config.inference_cpus)
 
-        frame = discard_bottom_pixels(
-            frame,
-            frame_width,
-            frame_height,
-            detection_config.bottom_blackout_height
+    fps_meter = RateMeter(REGISTRY.gauge("fps", "Frames processed per second by the main loop"))
+    loop_histogram = REGISTRY.histogram("loop_seconds", "Time spent processing one frame in the main loop")
+
+    while not stop_requested.is_set():
+        # Only the preview needs frames while the AI is off or the robot is
+        # grabbing, and nothing does while no one watches.
+        throttle.update(
+            main.run_model and not detector.is_picking_up,
+            mjpeg_image_buffer.has_subscribers or viewer is not None
         )
+        camera_frame = capture.read(READ_TIMEOUT)
+        if camera_frame is None:
+            continue
+
+        loop_start = perf_counter()
+        fps_meter.tick(loop_start)
+
+        # The preprocessor rotates and crops for the model by itself, so the
+        # rotated frame is only made for the viewers.
+        frame = None
+        if preprocessor is None:
+            frame = rotate_frame(camera_frame, detection_config.bottom_blackout_height)
 
         if main.run_model:
-            instruction, frame = detector.get_instruction(frame)
+            instruction = detector.get_instruction(camera_frame if preprocessor is not None else frame)
             mqtt_connection.submit_instruction(instruction)
 
-        mjpeg_image_buffer.write(cv2.imencode('.jpg', frame)[1].tobytes())
+        result = detector.last_result if main.run_model else None
+        if overlay_config.mode == OVERLAY_VECTOR:
+            mjpeg_image_buffer.set_overlay(to_vector_overlay(result))
+
+        # The preview is only rendered and encoded while someone watches it.
+        if mjpeg_image_buffer.has_subscribers or viewer is not None:
+            if frame is None:
+                frame = rotate_frame(camera_frame, detection_config.bottom_blackout_height)
+            preview = render_preview(frame, result, overlay_config)
+
+            if mjpeg_image_buffer.has_subscribers:
+                mjpeg_image_buffer.write(cv2.imencode('.jpg', preview)[1].tobytes())
+            if viewer is not None:
+                viewer.show(preview)
 
-        cv2.imshow("Image", frame)
-        key = cv2.waitKey(1)
-        if key == 27:
-            break
-        elif key == 13:
-            main.run_model = not main.run_model
+        loop_histogram.record(perf_counter() - loop_start)
 
-    cv2.destroyAllWindows()
-    print("Disconnecting")
+    if viewer is not None:
+        viewer.stop()
+    capture.close()
+    logger.info("Disconnecting")
     mqtt_connection.disconnect()
+    stop_logging()
 
 if __name__ == "__main__":
     main()
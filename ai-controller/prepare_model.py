@@ -0,0 +1,115 @@
+"""
+Prepares the model for the tensor backend: fuses every Conv with its
+BatchNorm, converts the network to channels_last, traces it at the input
+shapes the preprocessing makes from the camera frames, freezes it and saves
+one TorchScript artifact per shape. The artifacts are named after a hash of
+the weights, so new weights are never run with stale artifacts. Run it
+again after changing the weights, the camera resolution, the bottom
+blackout or the input sizes.
+
+    python3 prepare_model.py --camera_width 640 --camera_height 480
+"""
+import argparse
+import json
+import os
+from time import perf_counter
+
+import torch
+import yaml
+
+from core.preprocess import model_input_shape
+from core.yolov5 import WEIGHTS, artifact_path, load_model, weights_hash
+
+CONFIG_NAME = "config.yml"
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--camera_width', type=int, required=True, help='the width of the frames of the camera stream')
+    parser.add_argument('--camera_height', type=int, required=True)
+    parser.add_argument('--bottom_blackout_height', type=int, default=None,
+                        help='defaults to detection.bottom_blackout_height of config.yml')
+    parser.add_argument('--sizes', type=int, nargs='*', default=None,
+                        help='defaults to detection.input_sizes of config.yml')
+    parser.add_argument('--output', type=str, default=None, help='defaults to detection.model_dir of config.yml')
+    return parser.parse_args()
+
+
+def load_detection_config() -> dict:
+    config_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), CONFIG_NAME)
+    if not os.path.isfile(config_path):
+        return {}
+
+    with open(config_path, 'r') as config_file:
+        return yaml.full_load(config_file).get("detection") or {}
+
+
+def get_detection_model():
+    """
+    The fused DetectionModel inside the AutoShape wrapper, in eval mode.
+    """
+    network = load_model().model
+    # Newer YOLOv5 versions wrap the model in a DetectMultiBackend.
+    network = getattr(network, "model", network)
+    if hasattr(network, "fuse"):
+        network = network.fuse()
+
+    return network.cpu().float().eval().to(memory_format=torch.channels_last)
+
+
+def class_names() -> list:
+    names = load_model().names
+    if isinstance(names, dict):
+        names = [names[i] for i in sorted(names)]
+
+    return list(names)
+
+
+def trace(network, height: int, width: int):
+    example = torch.zeros((1, 3, height, width)).contiguous(memory_format=torch.channels_last)
+
+    with torch.no_grad():
+        # The Detect layer returns its feature maps as a list next to the
+        # predictions, which needs strict=False.
+        traced = torch.jit.trace(network, example, strict=False)
+        traced = torch.jit.freeze(traced)
+        if hasattr(torch.jit, "optimize_for_inference"):
+            traced = torch.jit.optimize_for_inference(traced)
+
+    return traced
+
+
+def main():
+    args = arg_parser()
+    config = load_detection_config()
+
+    bottom_blackout_height = args.bottom_blackout_height
+    if bottom_blackout_height is None:
+        bottom_blackout_height = config.get("bottom_blackout_height") or 0
+    sizes = args.sizes or config.get("input_sizes") or [416]
+    output = args.output or os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                         config.get("model_dir", "models"))
+    os.makedirs(output, exist_ok=True)
+
+    digest = weights_hash(WEIGHTS)
+    network = get_detection_model()
+    names = class_names()
+
+    shapes = sorted(set(
+        model_input_shape(args.camera_width, args.camera_height, bottom_blackout_height, size) for size in sizes
+    ))
+
+    for height, width in shapes:
+        start = perf_counter()
+        traced = trace(network, height, width)
+        target = artifact_path(output, digest, height, width)
+
+        # Written next to the target and renamed, so a running controller
+        # never loads a half-written artifact.
+        torch.jit.save(traced, target + ".tmp", _extra_files={"names.json": json.dumps(names)})
+        os.replace(target + ".tmp", target)
+        print("{}x{}: saved {} in {:.1f} s".format(height, width, target, perf_counter() - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+"""
+Simulates roaming in a furnished room to compare roaming strategies. The
+robot runs the real Robot and RoamState code on simulated motors and a
+simulated ultrasonic sensor. The wheels slip a little, so the odometry
+drifts like on the real floor. Every run starts at a random free spot and
+reports the floor area the robot drove over.
+
+    python3 benchmark_roaming.py --runs 10 --minutes 10
+"""
+import argparse
+import logging
+import math
+import random
+
+from controller import RoamState, RobotConfig
+from coverage import CoveragePlanner, OccupancyGrid, Odometry
+from robot import Robot
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--minutes', type=float, default=10, help='simulated minutes per run')
+    parser.add_argument('--loop_rate', type=float, default=20, help='updates per second of the control loop')
+    parser.add_argument('--slip', type=float, default=0.03, help='standard deviation of the wheel slip')
+    return parser.parse_args()
+
+
+class SimulatedMotor(object):
+    """
+    A tacho motor with the ev3dev2 attributes the robot uses. position is in
+    degrees of wheel rotation.
+    """
+
+    max_speed = 1050
+
+    def __init__(self) -> None:
+        self.speed_sp = 0
+        self.position = 0
+        self.running = False
+
+    @property
+    def speed(self) -> float:
+        return self.speed_sp if self.running else 0
+
+    def run_forever(self):
+        self.running = True
+
+    def stop(self, stop_action="brake"):
+        self.running = False
+
+    def run_to_abs_pos(self, **kwargs):
+        pass
+
+    def run_to_rel_pos(self, **kwargs):
+        pass
+
+
+class SimulatedRoom(object):
+    """
+    A rectangular room with rectangular furniture, and a robot in it. The
+    robot is a disc with the ultrasonic sensor at its front.
+    """
+
+    def __init__(self, width: float = 5, height: float = 4, obstacles=None, robot_radius: float = 0.09,
+                 wheel_diameter: float = 0.056, wheel_base: float = 0.12, cell_size: float = 0.1) -> None:
+        self.width = width
+        self.height = height
+        self.obstacles = obstacles if obstacles is not None else [
+            (1.0, 1.0, 1.8, 1.6),  # table
+            (3.2, 0.0, 5.0, 0.6),  # cupboard
+            (3.5, 2.5, 4.2, 3.2),  # chair
+            (0.0, 3.2, 1.2, 4.0),  # bookcase
+        ]
+        self.robot_radius = robot_radius
+        self.wheel_diameter = wheel_diameter
+        self.wheel_base = wheel_base
+        self.cell_size = cell_size
+        self.free_cells = set(
+            (i, j)
+            for i in range(int(width / cell_size))
+            for j in range(int(height / cell_size))
+            if self.is_free((i + 0.5) * cell_size, (j + 0.5) * cell_size, robot_radius)
+        )
+
+    def is_free(self, x: float, y: float, margin: float = 0) -> bool:
+        if not (margin <= x <= self.width - margin and margin <= y <= self.height - margin):
+            return False
+
+        for xmin, ymin, xmax, ymax in self.obstacles:
+            if xmin - margin <= x <= xmax + margin and ymin - margin <= y <= ymax + margin:
+                return False
+
+        return True
+
+    def ray_distance(self, x: float, y: float, angle: float, max_distance: float = 2.55) -> float:
+        step = 0.01
+        distance = 0
+        while distance < max_distance:
+            if not self.is_free(x + distance * math.cos(angle), y + distance * math.sin(angle)):
+                return distance
+            distance += step
+
+        return max_distance
+
+    def random_pose(self, rng: random.Random):
+        while True:
+            x, y = rng.uniform(0, self.width), rng.uniform(0, self.height)
+            if self.is_free(x, y, self.robot_radius + 0.05):
+                return (x, y, rng.uniform(-math.pi, math.pi))
+
+
+class SimulatedRun(object):
+    """
+    One roaming run: moves the robot by what its wheels do, and answers the
+    sensor readings from where it really is.
+    """
+
+    # The ultrasonic beam is about 30 degrees wide, so it is sampled with a
+    # few rays and reports the closest hit.
+    BEAM_ANGLES = [math.radians(-12), 0, math.radians(12)]
+
+    def __init__(self, room: SimulatedRoom, pose, slip: float, rng: random.Random) -> None:
+        self.room = room
+        self.x, self.y, self.heading = pose
+        self.slip = slip
+        self.rng = rng
+        self.time = 0
+        self.travelled = 0
+        self.covered = set()
+        self.left_motor = SimulatedMotor()
+        self.right_motor = SimulatedMotor()
+        self.robot = Robot(self.left_motor, self.right_motor, SimulatedMotor(), self)
+        # A fixed error in each wheel's size, on top of the random slip.
+        self.wheel_bias = (1 + rng.gauss(0, slip), 1 + rng.gauss(0, slip))
+        self.mark_covered()
+
+    @property
+    def distance_centimeters(self) -> float:
+        sensor_x = self.x + self.room.robot_radius * math.cos(self.heading)
+        sensor_y = self.y + self.room.robot_radius * math.sin(self.heading)
+        distance = min(self.room.ray_distance(sensor_x, sensor_y, self.heading + angle)
+                       for angle in SimulatedRun.BEAM_ANGLES)
+        return max(0, distance * 100 + self.rng.gauss(0, 1))
+
+    def clock(self) -> float:
+        return self.time
+
+    def step(self, dt: float):
+        meters_per_degree = math.pi * self.room.wheel_diameter / 360
+        left_degrees = self.left_motor.speed * dt
+        right_degrees = self.right_motor.speed * dt
+
+        left = left_degrees * meters_per_degree * self.wheel_bias[0] * (1 + self.rng.gauss(0, self.slip))
+        right = right_degrees * meters_per_degree * self.wheel_bias[1] * (1 + self.rng.gauss(0, self.slip))
+        distance = (left + right) / 2
+        rotation = (right - left) / self.room.wheel_base
+
+        x = self.x + distance * math.cos(self.heading + rotation / 2)
+        y = self.y + distance * math.sin(self.heading + rotation / 2)
+
+        # Bumping into something stalls the wheels, a turn in place is always
+        # possible for a round robot.
+        if self.room.is_free(x, y, self.room.robot_radius):
+            self.left_motor.position += left_degrees
+            self.right_motor.position += right_degrees
+            self.travelled += math.hypot(x - self.x, y - self.y)
+            self.x, self.y = x, y
+            self.heading += rotation
+            self.mark_covered()
+
+        self.time += dt
+
+    def mark_covered(self):
+        cell_size = self.room.cell_size
+        radius = self.room.robot_radius
+        for i in range(int((self.x - radius) // cell_size), int((self.x + radius) // cell_size) + 1):
+            for j in range(int((self.y - radius) // cell_size), int((self.y + radius) // cell_size) + 1):
+                if (i, j) in self.room.free_cells:
+                    self.covered.add((i, j))
+
+
+def run_roaming(strategy: str, turn_mode: str, room: SimulatedRoom, pose, args, rng: random.Random):
+    """
+    Roams for the configured time and returns the covered area in square
+    meters and the distance travelled in meters.
+    """
+    run = SimulatedRun(room, pose, args.slip, rng)
+
+    odometry = Odometry(room.wheel_diameter, room.wheel_base)
+    planner = None
+    if strategy == RobotConfig.ROAM_COVERAGE:
+        planner = CoveragePlanner(OccupancyGrid(room.cell_size))
+
+    state = RoamState(run.robot, odometry, planner, run.clock, turn_mode)
+    dt = 1 / args.loop_rate
+
+    while run.time < args.minutes * 60:
+        # The same map update as RobotController.update.
+        odometry.update(*run.robot.get_wheel_positions())
+        if planner is not None:
+            planner.grid.mark_visited(odometry.x, odometry.y, room.wheel_base / 2)
+
+        state.update()
+        run.step(dt)
+
+    return (len(run.covered) * room.cell_size ** 2, run.travelled)
+
+
+def main():
+    args = arg_parser()
+    logging.basicConfig(level=logging.ERROR)
+
+    room = SimulatedRoom()
+    free_area = len(room.free_cells) * room.cell_size ** 2
+    rng = random.Random(args.seed)
+    poses = [room.random_pose(rng) for _ in range(args.runs)]
+
+    strategies = [
+        ("random", RobotConfig.ROAM_RANDOM, RoamState.TURN_FIRST_CLEAR),
+        ("sweep", RobotConfig.ROAM_RANDOM, RoamState.TURN_SWEEP),
+        ("coverage", RobotConfig.ROAM_COVERAGE, RoamState.TURN_FIRST_CLEAR),
+    ]
+
+    for name, strategy, turn_mode in strategies:
+        # The strategies use the global random module, seeded per strategy so
+        # each sees the same sequence.
+        random.seed(args.seed)
+        areas, distances = [], []
+        for i, pose in enumerate(poses):
+            area, distance = run_roaming(strategy, turn_mode, room, pose, args, random.Random(args.seed + i))
+            areas.append(area)
+            distances.append(distance)
+
+        area = sum(areas) / len(areas)
+        distance = sum(distances) / len(distances)
+        print("{:>9}: covered {:.1f} of {:.1f} m2 ({:.0%}) in {:g} min, {:.2f} m2/min, travelled {:.1f} m/min".format(
+            name,
+            area,
+            free_area,
+            area / free_area,
+            args.minutes,
+            area / args.minutes,
+            distance / args.minutes
+        ))
+
+
+if __name__ == "__main__":
+    main()
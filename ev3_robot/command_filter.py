@@ -0,0 +1,95 @@
+from collections import deque
+import logging
+
+from msg_parser import Command
+
+logger = logging.getLogger(__name__)
+
+
+class ClockOffsetEstimator(object):
+    """
+    Estimates the offset between the controller's clock and ours from the
+    send timestamps of the commands. Without a round trip the offset cannot
+    be separated from the network delay, so the estimate is the smallest
+    (receive - send) difference seen in the last window of commands: the
+    offset plus the best-case delay. Ages measured against it are the extra
+    delay a command picked up on the way, which is what matters for
+    deciding whether it is stale.
+
+    When the controller's clock steps backward, e.g. on an NTP correction,
+    every sample is far above the old minimum and every command would look
+    expired until that minimum left the window. The controller stamps its
+    commands in order, so a send time more than step_threshold seconds
+    before the previous one is such a step, and the window restarts. Late
+    commands after a network stall still have increasing send times, so
+    they keep looking stale.
+    """
+
+    def __init__(self, window: int = 200, step_threshold: float = 0.5) -> None:
+        self.samples = deque(maxlen=window)
+        self.step_threshold = step_threshold
+        self.last_sent_at = None
+
+    def add_sample(self, sent_at: float, received_at: float) -> bool:
+        """
+        Adds the sample of a command, and returns whether the estimate
+        restarted because the controller's clock stepped back.
+        """
+        stepped = self.last_sent_at is not None and sent_at < self.last_sent_at - self.step_threshold
+        if stepped:
+            logger.warning("The controller's clock stepped back by %.1f secs, restarting the offset estimate.",
+                           self.last_sent_at - sent_at)
+            self.samples.clear()
+
+        self.last_sent_at = sent_at
+        self.samples.append(received_at - sent_at)
+        return stepped
+
+    @property
+    def offset(self) -> float:
+        return min(self.samples) if len(self.samples) > 0 else 0
+
+    def to_local_time(self, controller_time: float) -> float:
+        return controller_time + self.offset
+
+
+class CommandFilter(object):
+    """
+    Rejects stamped commands that can no longer be executed safely: commands
+    past their deadline, and movements older than a movement that was already
+    accepted. Commands without a timestamp are always accepted, so senders
+    that do not stamp their commands keep working.
+    """
+
+    def __init__(self, clock: ClockOffsetEstimator = None) -> None:
+        self.clock = clock if clock is not None else ClockOffsetEstimator()
+        self.last_move_sent_at = None
+        self.dropped = 0
+
+    def on_receive(self, command: Command, received_at: float) -> None:
+        if command.sent_at is not None and self.clock.add_sample(command.sent_at, received_at):
+            # Moves sent before the step look newer than every move after it.
+            self.last_move_sent_at = None
+
+    def is_fresh(self, command: Command, now: float) -> bool:
+        if command.sent_at is None:
+            return True
+
+        if command.deadline is not None and self.clock.to_local_time(command.deadline) < now:
+            self.dropped += 1
+            return False
+
+        return True
+
+    def accept_move(self, command: Command, now: float) -> bool:
+        if not self.is_fresh(command, now):
+            return False
+
+        if command.sent_at is not None:
+            if self.last_move_sent_at is not None and command.sent_at < self.last_move_sent_at:
+                self.dropped += 1
+                return False
+
+            self.last_move_sent_at = command.sent_at
+
+        return True
@@ -0,0 +1,68 @@
+from collections import deque
+from threading import Lock
+
+from metrics import REGISTRY
+from msg_parser import AIActiveCommand, Command, MoveCoordCommand, StopCarCommand, SwitchControllerState, \
+    TrajectoryCommand
+
+overflow_counter = REGISTRY.counter("commands_overflowed", "Commands dropped because the mailbox was full")
+
+
+class CommandMailbox(object):
+    """
+    Hands the commands decoded on paho's network thread to the control loop,
+    which is the only thread that drives the motors. Draining returns the
+    commands in the order they arrived, followed by only the latest
+    movement, a move or a trajectory. A control command (stop or a state
+    switch) discards the movement received before it, so it is never
+    followed by an older move. At most capacity commands are kept besides
+    the movement. When full, the oldest command that is not a control
+    command is dropped, so a stop is never lost.
+    """
+
+    CONTROL_COMMANDS = (StopCarCommand, SwitchControllerState, AIActiveCommand)
+    MOVE_COMMANDS = (MoveCoordCommand, TrajectoryCommand)
+
+    def __init__(self, capacity: int = 16) -> None:
+        self.lock = Lock()
+        self.commands = deque()
+        self.move = None
+        self.capacity = capacity
+
+    def put(self, command: Command, received_at: float):
+        with self.lock:
+            if isinstance(command, CommandMailbox.MOVE_COMMANDS):
+                self.move = (command, received_at)
+                return
+
+            if isinstance(command, CommandMailbox.CONTROL_COMMANDS):
+                self.move = None
+
+            if len(self.commands) >= self.capacity:
+                self.__drop_oldest()
+
+            self.commands.append((command, received_at))
+
+    def drain(self) -> list:
+        """
+        Empties the mailbox and returns its (command, received_at) pairs in
+        the order they should be executed.
+        """
+        with self.lock:
+            commands = list(self.commands)
+            if self.move is not None:
+                commands.append(self.move)
+
+            self.commands.clear()
+            self.move = None
+
+        return commands
+
+    def __drop_oldest(self):
+        overflow_counter.inc()
+        for i, (command, _) in enumerate(self.commands):
+            if not isinstance(command, CommandMailbox.CONTROL_COMMANDS):
+                del self.commands[i]
+                return
+
+        self.commands.popleft()
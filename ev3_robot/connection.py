@@ -1,4 +1,5 @@
-from time import sleep
+import json
+from time import sleep, time
 from typing import Callable
 from threading import Condition
 
@@ -11,12 +12,27 @@ class ConnectionConfig(object):
 
     client_id = "cleanee-rob"
 
-    def __init__(self, mqtt_host: str, mqtt_port: int, keep_alive: int, connection_topic: str, control_topic_prefix: str):
+    def __init__(self, mqtt_host: str, mqtt_port: int, keep_alive: int, connection_topic: str, control_topic_prefix: str,
+                 robot_id: str = None, presence_topic: str = "fleet/presence", reconnect_min_delay: float = 0.1,
+                 reconnect_max_delay: float = 2):
         self.mqtt_host = mqtt_host
         self.mqtt_port = mqtt_port
         self.keep_alive = keep_alive
+        self.reconnect_min_delay = reconnect_min_delay
+        self.reconnect_max_delay = reconnect_max_delay
         self.connection_topic = connection_topic
         self.control_topic_prefix = control_topic_prefix
+        self.robot_id = robot_id
+        self.presence_topic = None
+
+        # With a robot id, every topic of this robot lives in its own
+        # namespace, so robots sharing a broker never see each other's
+        # handshakes. Without one the shared legacy topics are used.
+        if robot_id is not None:
+            self.client_id = "cleanee-rob-{}".format(robot_id)
+            self.connection_topic = "{}/{}".format(connection_topic, robot_id)
+            self.control_topic_prefix = "{}/{}".format(control_topic_prefix, robot_id)
+            self.presence_topic = "{}/{}".format(presence_topic, robot_id)
 
 
 class Connection(object):
@@ -27,27 +43,59 @@ class Connection(object):
     """
 
     __connected = False
+    __started = False
     __controller_id = ""
 
     on_control_message = None
 
+    PRESENCE_OFFLINE = "offline"
+    PRESENCE_AVAILABLE = "available"
+    PRESENCE_CONNECTED = "connected"
+
     def __init__(self, config: ConnectionConfig):
         self.config = config
 
         self.client = MQTTClient(config.client_id)
+        self.__cv = Condition()
 
-    def establish(self) -> None:
-        print("Establishing end-to-end connection.")
+    def establish(self, timeout: float = None) -> bool:
+        """
+        Connects to the broker and waits until a controller finished the
+        handshake, or until the timeout (in seconds) passed. Returns whether
+        the end-to-end connection is established. Calling it again after a
+        timeout keeps waiting on the same connection.
+        """
+        if self.__started:
+            with self.__cv:
+                return self.__cv.wait_for(self.is_connected, timeout)
 
-        self.client.will_set(
-            self.config.connection_topic,
-            self.__get_disconnect_msg(),
-            2
-        )
+        print("Establishing end-to-end connection.")
+        self.__started = True
+
+        # A client only gets one will. In a fleet the controllers watch the
+        # retained presence of the robot, so that is what has to go offline.
+        if self.config.presence_topic is not None:
+            self.client.will_set(
+                self.config.presence_topic,
+                self.__get_presence_msg(Connection.PRESENCE_OFFLINE),
+                1,
+                True
+            )
+        else:
+            self.client.will_set(
+                self.config.connection_topic,
+                self.__get_disconnect_msg(),
+                2
+            )
 
         self.client.on_connect = self.__on_connect()
+        self.client.on_disconnect = self.__on_disconnect()
         self.client.on_message = self.__on_message()
 
+        # Paho reconnects on its own from the network loop, starting at the
+        # min delay and doubling up to the max delay.
+        self.client.reconnect_delay_set(self.config.reconnect_min_delay, self.config.reconnect_max_delay)
+
         self.client.loop_start()
 
         self.client.connect_async(
@@ -56,12 +104,11 @@ class Connection(object):
             self.config.keep_alive
         )
 
-        self.__cv = Condition()
-
         with self.__cv:
-            self.__cv.wait_for(self.is_connected)
+            return self.__cv.wait_for(self.is_connected, timeout)
 
     def disconnect(self) -> None:
+        self.__publish_presence(Connection.PRESENCE_OFFLINE)
         self.client.publish(
             self.config.connection_topic,
             self.__get_disconnect_msg(),
@@ -73,17 +120,59 @@ class Connection(object):
 
         self.__controller_id = ""
         self.__connected = False
+        self.__started = False
 
     def is_connected(self) -> bool:
         return self.__connected
 
+    def publish_metrics(self, metrics: dict) -> None:
+        """
+        Publishes a snapshot of the robot's metrics to the metrics topic next
+        to the connection topic. Metrics are best effort, so nothing is
+        queued when the broker is unreachable.
+        """
+        self.client.publish(
+            "{}/metrics".format(self.config.connection_topic),
+            json.dumps(metrics)
+        )
+
+    def publish_telemetry(self, telemetry: dict) -> None:
+        """
+        Publishes a batch of telemetry samples to the telemetry topic next to
+        the connection topic, best effort like the metrics.
+        """
+        self.client.publish(
+            self.get_telemetry_topic(),
+            json.dumps(telemetry, separators=(",", ":"))
+        )
+
+    def get_telemetry_topic(self) -> str:
+        return "{}/telemetry".format(self.config.connection_topic)
+
     def __on_connect(self) -> Callable[[MQTTClient, None, None, None], None]:
         def on_connect(client: MQTTClient, userdata: None, flags: None, rc: None) -> None:
             print("\tConnected to MQTT broker.")
             client.subscribe(self.config.connection_topic)
 
+            # The broker forgets our subscriptions when the connection drops,
+            # so after a reconnect the control topic has to be subscribed
+            # again for the controller to keep working.
+            if self.__connected:
+                client.subscribe(self.__get_control_topic(), 1)
+
+            self.__publish_presence(
+                Connection.PRESENCE_CONNECTED if self.__connected else Connection.PRESENCE_AVAILABLE
+            )
+
         return on_connect
 
+    def __on_disconnect(self) -> Callable[[MQTTClient, None, int], None]:
+        def on_disconnect(client: MQTTClient, userdata: None, rc: int) -> None:
+            if rc != 0:
+                print("Lost connection to MQTT broker, reconnecting.")
+
+        return on_disconnect
+
     def __on_message(self) -> Callable[[MQTTClient, MQTTMessage], None]:
         def on_message(client: MQTTClient, userdata: None, msg: MQTTMessage) -> None:
             # If the end-to-end connection has not been established, we only
@@ -132,15 +221,18 @@ class Connection(object):
                 self.client.unsubscribe(self.__get_control_topic())
                 self.__controller_id = ""
                 self.__connected = False
+                self.__publish_presence(Connection.PRESENCE_AVAILABLE)
 
     def __on_finish_connection(self) -> None:
         print("\tConnection established\n")
-        self.client.subscribe(self.__get_control_topic())
+        self.client.subscribe(self.__get_control_topic(), 1)
 
         with self.__cv:
             self.__connected = True
             self.__cv.notify()
 
+        self.__publish_presence(Connection.PRESENCE_CONNECTED)
+
     def __get_control_topic(self) -> str:
         return "{}/{}".format(
             self.config.control_topic_prefix,
@@ -149,3 +241,34 @@ class Connection(object):
 
     def __get_disconnect_msg(self):
         return "close_con:{}".format(self.config.client_id)
+
+    def __publish_presence(self, state: str) -> None:
+        if self.config.presence_topic is None:
+            return
+
+        self.client.publish(
+            self.config.presence_topic,
+            self.__get_presence_msg(state),
+            1,
+            True
+        )
+
+    def __get_presence_msg(self, state: str) -> str:
+        """
+        The retained presence message of this robot. Controllers read it to
+        find the robot's topics and, once connected, the control topic other
+        controllers (such as the ai-controller) should publish to.
+        """
+        connected = state == Connection.PRESENCE_CONNECTED
+
+        return json.dumps({
+            "robot_id": self.config.robot_id,
+            "client_id": self.config.client_id,
+            "state": state,
+            "connection_topic": self.config.connection_topic,
+            "telemetry_topic": self.get_telemetry_topic(),
+            "controller_id": self.__controller_id if connected else None,
+            "control_topic": self.__get_control_topic() if connected else None,
+            "timestamp": time()
+        })
+
@@ -1,14 +1,43 @@
 from abc import ABC, abstractmethod
-from msg_parser import AIActiveCommand, Command, CommandFactory, SwitchControllerState
+from command_filter import CommandFilter
+from coverage import CoveragePlanner, OccupancyGrid, Odometry, normalize_angle
+import logging
+from command_mailbox import CommandMailbox
+from metrics import REGISTRY
+from msg_parser import AIActiveCommand, Command, CommandFactory, MoveCoordCommand, SwitchControllerState, \
+    TrajectoryCommand
+from math import cos, degrees, hypot, pi, sin
 from time import time
-from random import random, randrange
+from random import random
 from robot import Robot
 
+logger = logging.getLogger(__name__)
+received_counter = REGISTRY.counter("commands_received", "Control messages received from the controller")
+dropped_counter = REGISTRY.counter("commands_dropped", "Stamped commands dropped because they arrived after their deadline or after a newer move")
+queued_histogram = REGISTRY.histogram("command_queued_seconds", "Time between receiving a command and executing it")
+
 
 class RobotConfig(object):
 
-    def __init__(self, grab_distance: float) -> None:
+    ROAM_RANDOM = "random"
+    ROAM_COVERAGE = "coverage"
+
+    def __init__(self, grab_distance: float, watchdog_interval: float = 0.5, metrics_interval: float = None,
+                 roam_strategy: str = ROAM_COVERAGE, wheel_diameter: float = 0.056, wheel_base: float = 0.12,
+                 cell_size: float = 0.1, turn_mode: str = "first_clear", turn_clearance: float = 50,
+                 gyro_port: int = None, telemetry_rate: float = None, telemetry_batch: int = 3) -> None:
         self.grab_distance = grab_distance
+        self.watchdog_interval = watchdog_interval
+        self.metrics_interval = metrics_interval
+        self.roam_strategy = roam_strategy
+        self.wheel_diameter = wheel_diameter
+        self.wheel_base = wheel_base
+        self.cell_size = cell_size
+        self.turn_mode = turn_mode
+        self.turn_clearance = turn_clearance
+        self.gyro_port = gyro_port
+        self.telemetry_rate = telemetry_rate
+        self.telemetry_batch = telemetry_batch
 
 
 class RobotControllerState(ABC):
@@ -37,7 +66,8 @@ class CommandState(RobotControllerState):
         command.execute(self.robot)
 
     def update(self):
-        pass
+        self.robot.update_trajectory()
+        self.robot.update_arm()
 
 
 class FinishGrabState(CommandState):
@@ -56,7 +86,16 @@ class FinishGrabState(CommandState):
         return super().on_command(command)
 
     def update(self):
-        if self.is_overruled or self.grabbing_initiated:
+        if self.is_overruled:
+            # Keeps following a trajectory or an arm grab that overruled
+            # this grab.
+            super().update()
+            return
+
+        if self.grabbing_initiated:
+            # The grab runs a step at a time, so the control loop keeps
+            # handling commands, e.g. a stop, while the arm moves.
+            self.robot.update_arm()
             return
 
         if self.robot.get_distance_reading() > self.grab_distance:
@@ -73,91 +112,261 @@ class RoamState(RobotControllerState):
     """
     Controls the robot by roaming around. This means the robot will continue
     straight on, until it detects there is an obstacle in-front. When that
-    happens, it will rotate left or right randomly and continue straight on
-    again.
+    happens, it turns in place while reading the ultrasonic sensor, and
+    continues straight on as soon as it faces a clear heading. In sweep mode
+    it first turns a full circle and then faces the clearest heading seen.
+    The odometry (or the gyro, when there is one) tells how far it turned.
+
+    With a coverage planner, the robot instead turns toward the heading with
+    the most unexplored floor, and every REPLAN_INTERVAL seconds checks
+    whether a better heading opened up.
     """
 
     STATE_STOPPED = "stopped"
     STATE_MOVING = "moving"
+    STATE_SCANNING = "scanning"
     STATE_TURNING = "turning"
 
-    MIN_TURN_DURATION = 10
-    MAX_TURN_DURATION = 15
+    TURN_FIRST_CLEAR = "first_clear"
+    TURN_SWEEP = "sweep"
 
     SAFE_DISTANCE_READING = 20 #cm
 
+    ROAM_SPEED = 0.2
+    TURN_SPEED = 0.4
+    # Scanning turns slower, so the sensor gets a reading every few degrees.
+    SCAN_SPEED = 0.25
+    # The slowest turn when closing in on the target heading, so it is not
+    # overshot between two updates.
+    MIN_TURN_SPEED = 0.1
+    HEADING_TOLERANCE = 0.15 # rad
+    # A scan turns at least this far, so the robot does not drive off along
+    # the edge of the obstacle it just saw.
+    MIN_SCAN_ANGLE = 0.35 # rad
+    # When the wheels move less than STALL_DISTANCE in STALL_CHECK_INTERVAL
+    # while driving, the robot ran into something the sensor did not see,
+    # e.g. with its side. It then turns at least STALL_SCAN_ANGLE away.
+    STALL_CHECK_INTERVAL = 1
+    STALL_DISTANCE = 0.02 # m
+    STALL_SCAN_ANGLE = pi / 2
+    # Turns that take longer than this are given up on, e.g. when the robot
+    # is stuck.
+    TURN_TIMEOUT = 5
+    REPLAN_INTERVAL = 2
+    # Readings further away than this are too unreliable to mark obstacles.
+    SENSOR_RANGE = 100 #cm
+
     __state = STATE_STOPPED
-    __turn_duration = 0
-    __turn_start = 0
-    __last_turn = None
 
-    def __init__(self, robot: Robot) -> None:
+    def __init__(self, robot: Robot, odometry: Odometry, planner: CoveragePlanner = None, clock=time,
+                 turn_mode: str = TURN_FIRST_CLEAR, turn_clearance: float = 50) -> None:
         super().__init__()
 
         self.robot = robot
+        self.odometry = odometry
+        self.planner = planner
+        self.clock = clock
+        self.turn_mode = turn_mode
+        self.turn_clearance = turn_clearance
+        self.__target_heading = None
+        self.__turn_start = 0
+        self.__turn_speed = None
+        self.__last_turn = None
+        self.__last_plan = 0
+        self.__last_heading = None
+        self.__last_error = None
+        self.__scanned_angle = 0
+        self.__min_scan_angle = RoamState.MIN_SCAN_ANGLE
+        self.__best_reading = None
+        self.__stall_check = None
 
     def on_command(self, command: Command):
         pass
 
     def update(self):
-        if self.__state == RoamState.STATE_MOVING:
-            self.__check_distance()
+        distance = self.robot.get_distance_reading()
+        now = self.clock()
+
+        if self.planner is not None:
+            self.__update_coverage(distance, now)
         elif self.__state == RoamState.STATE_STOPPED:
-            self.__start_moving()
+            if distance > RoamState.SAFE_DISTANCE_READING:
+                self.__start_moving(now)
+            else:
+                self.__start_scan(now)
+        elif self.__state == RoamState.STATE_MOVING:
+            if distance <= RoamState.SAFE_DISTANCE_READING:
+                logger.info("Obstacle detected, turning.")
+                self.__start_scan(now)
+            elif self.__is_stalled(now):
+                logger.info("Stalled, turning away.")
+                self.__start_scan(now, min_angle=RoamState.STALL_SCAN_ANGLE)
+        elif self.__state == RoamState.STATE_SCANNING:
+            self.__check_scan(distance, now)
         elif self.__state == RoamState.STATE_TURNING:
-            self.__check_turn()
+            self.__check_turn(distance, now)
 
-    def __is_safe(self):
-        return self.robot.get_distance_reading() > RoamState.SAFE_DISTANCE_READING
+    def __start_moving(self, now: float):
+        logger.info("Safe to move -> start moving")
+        self.__state = RoamState.STATE_MOVING
+        self.__turn_speed = None
+        self.__last_plan = now
+        self.__stall_check = (now, self.odometry.x, self.odometry.y)
+        self.robot.run(speed=RoamState.ROAM_SPEED)
+
+    def __is_stalled(self, now: float) -> bool:
+        checked_at, x, y = self.__stall_check
+        if now - checked_at < RoamState.STALL_CHECK_INTERVAL:
+            return False
+
+        self.__stall_check = (now, self.odometry.x, self.odometry.y)
+        return hypot(self.odometry.x - x, self.odometry.y - y) < RoamState.STALL_DISTANCE
+
+    def __start_scan(self, now: float, direction: str = None, min_angle: float = MIN_SCAN_ANGLE):
+        """
+        Turns in place until a clear heading shows up. Without a direction
+        it keeps turning the way it did last time, which gets out of corners
+        instead of swinging back and forth in them, and picks one at random
+        the first time.
+        """
+        direction = direction or self.__last_turn or ("left" if random() > 0.5 else "right")
+        self.__last_turn = direction
+
+        self.__state = RoamState.STATE_SCANNING
+        self.__turn_start = now
+        self.__last_heading = self.odometry.heading
+        self.__scanned_angle = 0
+        self.__min_scan_angle = min_angle
+        self.__best_reading = None
 
-    def __check_distance(self):
-        if self.__is_safe():
-            return
+        self.robot.stop()
+        # A negative x turns left, which is counterclockwise.
+        self.robot.moving_in_coord(-RoamState.SCAN_SPEED if direction == "left" else RoamState.SCAN_SPEED, 0)
 
-        print("Obstacle detected, turning.")
-        self.__start_turn()
+    def __check_scan(self, distance: float, now: float):
+        heading = self.odometry.heading
+        self.__scanned_angle += abs(normalize_angle(heading - self.__last_heading))
+        self.__last_heading = heading
 
-    def __start_moving(self):
-        if not self.__is_safe():
-            return
+        if self.__best_reading is None or distance > self.__best_reading[0]:
+            self.__best_reading = (distance, heading)
 
-        print("Safe to move -> start moving")
-        self.__state = RoamState.STATE_MOVING
-        self.robot.run(speed=0.2)
+        if self.turn_mode == RoamState.TURN_FIRST_CLEAR and self.__scanned_angle >= self.__min_scan_angle \
+                and distance >= self.turn_clearance:
+            self.__start_moving(now)
+            return
 
-    def __start_turn(self, direction=None):
-        self.__state = RoamState.STATE_TURNING
-        self.robot.stop()
+        if self.__scanned_angle < 2 * pi and now - self.__turn_start < RoamState.TURN_TIMEOUT:
+            return
 
-        TURN_SPEED = 0.4
-
-        if direction == "left":
-            self.robot.moving_in_coord(-TURN_SPEED, 0)
-            self.__last_turn = "left"
-        elif direction == "right":
-            self.__last_turn = "right"
-            self.robot.moving_in_coord(TURN_SPEED, 0)
-        elif random() > 0.5:
-            self.robot.moving_in_coord(-TURN_SPEED, 0)
-            self.__last_turn = "left"
+        best_distance, best_heading = self.__best_reading
+        if best_distance > RoamState.SAFE_DISTANCE_READING:
+            logger.info("Scanned %.0f degrees, facing the clearest heading (%.0f cm).",
+                        degrees(self.__scanned_angle), best_distance)
+            self.__turn_to(best_heading, now)
+        else:
+            logger.info("No clear heading found, scanning the other way.")
+            self.__start_scan(now, "right" if self.__last_turn == "left" else "left")
+
+    def __check_turn(self, distance: float, now: float):
+        """
+        Ends the turn toward the target heading once it is reached, or once
+        the turn rate says it will be passed before the next update.
+        """
+        if not self.__turn_done():
+            if now - self.__turn_start > RoamState.TURN_TIMEOUT:
+                logger.info("Turn timed out.")
+                self.__turn_done(force=True)
+            else:
+                return
+
+        if distance > RoamState.SAFE_DISTANCE_READING:
+            self.__start_moving(now)
+        elif self.planner is not None:
+            self.__plan_turn(now, exclude=self.odometry.heading)
         else:
-            self.robot.moving_in_coord(TURN_SPEED, 0)
-            self.__last_turn = "right"
+            self.__start_scan(now)
+
+    def __update_coverage(self, distance: float, now: float):
+        odometry = self.odometry
+
+        if distance < RoamState.SENSOR_RANGE:
+            # Marks the cell just behind the surface the sound bounced off.
+            reach = distance / 100 + self.planner.grid.cell_size / 2
+            self.planner.grid.mark_obstacle(
+                odometry.x + reach * cos(odometry.heading),
+                odometry.y + reach * sin(odometry.heading)
+            )
+
+        if self.__state == RoamState.STATE_STOPPED:
+            self.__plan_turn(now)
+
+        elif self.__state == RoamState.STATE_MOVING:
+            if distance <= RoamState.SAFE_DISTANCE_READING:
+                logger.info("Obstacle detected, planning a new heading.")
+                self.__plan_turn(now, exclude=odometry.heading)
+            elif self.__is_stalled(now):
+                logger.info("Stalled, planning a new heading.")
+                reach = 2 * self.planner.grid.cell_size
+                self.planner.grid.mark_obstacle(
+                    odometry.x + reach * cos(odometry.heading),
+                    odometry.y + reach * sin(odometry.heading)
+                )
+                self.__plan_turn(now, exclude=odometry.heading)
+            elif now - self.__last_plan >= RoamState.REPLAN_INTERVAL:
+                self.__last_plan = now
+                heading = self.planner.choose_heading(odometry.x, odometry.y, odometry.heading)
+                best, _ = self.planner.score(odometry.x, odometry.y, heading)
+                current, _ = self.planner.score(odometry.x, odometry.y, odometry.heading)
+                if best > 2 * current + 2:
+                    logger.info("Explored ahead, turning toward unexplored floor.")
+                    self.__turn_to(heading, now)
 
-        self.__turn_duration = randrange(RoamState.MIN_TURN_DURATION, RoamState.MAX_TURN_DURATION)
-        self.__turn_start = time()
-        print("Turning for {} secs".format(self.__turn_duration))
+        elif self.__state == RoamState.STATE_TURNING:
+            self.__check_turn(distance, now)
 
-    def __check_turn(self):
-        current_time = time()
-        if current_time - self.__turn_start < self.__turn_duration:
-            return
+    def __plan_turn(self, now: float, exclude: float = None):
+        odometry = self.odometry
+        heading = self.planner.choose_heading(odometry.x, odometry.y, odometry.heading, exclude)
+        self.__turn_to(heading, now)
+
+    def __turn_to(self, heading: float, now: float):
+        self.__state = RoamState.STATE_TURNING
+        self.__target_heading = heading
+        self.__turn_start = now
+        self.__turn_speed = None
+        self.__last_error = None
+        self.robot.stop()
+        self.__turn_done()
+
+    def __turn_done(self, force: bool = False) -> bool:
+        """
+        Steers toward the target heading and returns whether it is reached.
+        The error shrinks by about the same amount every update, so when the
+        next update would overshoot the target the turn already ends now.
+        """
+        error = normalize_angle(self.__target_heading - self.odometry.heading)
+        last_error = self.__last_error
+        self.__last_error = error
+
+        predicted = error
+        if last_error is not None and abs(error) < abs(last_error):
+            predicted = error - (last_error - error)
+
+        if force or abs(error) < RoamState.HEADING_TOLERANCE or (last_error is not None and predicted * error < 0):
+            self.robot.stop()
+            return True
 
-        if not self.__is_safe():
-            print("Unsafe after turn, starting new turn.")
-            self.__start_turn(self.__last_turn)
+        speed = min(RoamState.TURN_SPEED, max(RoamState.MIN_TURN_SPEED, abs(error) * 0.3))
+        # A positive error turns counterclockwise, which is a negative x.
+        speed = -speed if error > 0 else speed
 
-        self.__start_moving()
+        # Only talks to the motors when the speed changes noticeably.
+        if self.__turn_speed is None or abs(speed - self.__turn_speed) > 0.02:
+            self.__turn_speed = speed
+            self.robot.moving_in_coord(speed, 0)
+
+        return False
 
 
 class RobotController(object):
@@ -169,32 +378,124 @@ class RobotController(object):
         self.cmd_factory = cmd_factory
         self.__state = CommandState(self.robot)
         self.config = config
+        self.command_filter = CommandFilter()
+        self.mailbox = CommandMailbox()
+        self.__last_move_at = None
+
+        # The pose and the map outlive the roam states, so areas covered
+        # earlier, also while driven by commands, are not roamed again.
+        self.odometry = Odometry(config.wheel_diameter, config.wheel_base)
+        self.planner = None
+        if config.roam_strategy == RobotConfig.ROAM_COVERAGE:
+            self.planner = CoveragePlanner(OccupancyGrid(config.cell_size))
 
     def on_message(self, message: str):
+        """
+        Called from paho's network thread. The command is only decoded here
+        and executed by the next update(), so the motors are driven from the
+        control loop alone.
+        """
         command = self.cmd_factory.get_command(message)
-
-        if isinstance(command, SwitchControllerState):
-            self.__switch_state(command.new_state)
-        elif isinstance(command, AIActiveCommand) and not command.active:
-            self.__switch_state("commands")
-        elif isinstance(command, AIActiveCommand) and command.active:
-            self.__switch_state("roaming")
-        elif command is not None:
-            self.__state.on_command(command)
+        received_counter.inc()
+
+        if command is not None:
+            self.mailbox.put(command, time())
+
+    @property
+    def state_name(self) -> str:
+        """
+        The name of the current state, as in the switch_state command.
+        """
+        if isinstance(self.__state, RoamState):
+            return "roaming"
+        if isinstance(self.__state, FinishGrabState):
+            return "grabbing"
+        return "commands"
 
     def update(self):
+        self.__update_map()
+        self.__handle_commands()
+        self.__check_watchdog()
         self.__state.update()
 
+    def __update_map(self):
+        left, right = self.robot.get_wheel_positions()
+        self.odometry.update(left, right, self.robot.get_gyro_heading())
+
+        if self.planner is not None:
+            self.planner.grid.mark_visited(self.odometry.x, self.odometry.y, self.config.wheel_base / 2)
+
+    def __handle_commands(self):
+        for command, received_at in self.mailbox.drain():
+            self.command_filter.on_receive(command, received_at)
+
+            now = time()
+            if not self.command_filter.is_fresh(command, now):
+                dropped_counter.inc()
+                logger.warning("Dropping expired command %s", command.to_string())
+                continue
+
+            is_move = isinstance(command, CommandMailbox.MOVE_COMMANDS)
+            if is_move and not self.command_filter.accept_move(command, now):
+                dropped_counter.inc()
+                continue
+
+            if isinstance(command, TrajectoryCommand) and command.sent_at is not None:
+                # Starts the plan when it would have started without the
+                # delay it picked up on the way, so a late plan is not
+                # driven behind the robot's actual position.
+                command.start_at = min(now, self.command_filter.clock.to_local_time(command.sent_at))
+
+            queued_histogram.record(now - received_at)
+
+            if isinstance(command, SwitchControllerState):
+                self.__switch_state(command.new_state)
+            elif isinstance(command, AIActiveCommand):
+                self.__switch_state("roaming" if command.active else "commands")
+            else:
+                self.__state.on_command(command)
+
+            # Only stamped movements are watched, since other senders only
+            # send a movement when it changes. A trajectory stops on its own
+            # at its end.
+            if isinstance(command, MoveCoordCommand) and command.sent_at is not None:
+                self.__last_move_at = now if command.x != 0 or command.y != 0 else None
+            elif isinstance(command, TrajectoryCommand):
+                self.__last_move_at = None
+
+    def __check_watchdog(self):
+        """
+        Stops the motors when the controller stopped sending fresh movements,
+        so the robot does not keep driving on the last one when the
+        connection stalls. Only applies to stamped movements, since other
+        senders only send a movement when it changes.
+        """
+        if self.__last_move_at is None or time() - self.__last_move_at < self.config.watchdog_interval:
+            return
+
+        self.__last_move_at = None
+        if type(self.__state) is CommandState:
+            logger.warning("No fresh movement for %s secs, stopping.", self.config.watchdog_interval)
+            self.robot.stop()
+
     def __switch_state(self, new_state: str):
+        self.__last_move_at = None
+
         if new_state == "roaming" and not isinstance(self.__state, RoamState):
-            print("Switching state to roaming")
+            logger.info("Switching state to roaming")
             self.robot.stop()
-            self.__state = RoamState(self.robot)
+            self.__state = RoamState(
+                self.robot,
+                self.odometry,
+                self.planner,
+                turn_mode=self.config.turn_mode,
+                turn_clearance=self.config.turn_clearance
+            )
         elif new_state == "commands" and not isinstance(self.__state, CommandState):
-            print("Switching state to commands")
+            logger.info("Switching state to commands")
             self.robot.stop()
             self.__state = CommandState(self.robot)
         elif new_state == "grabbing" and not isinstance(self.__state, FinishGrabState):
-            print("Switching state to grabbing")
+            logger.info("Switching state to grabbing")
             self.robot.stop()
             self.__state = FinishGrabState(self.robot, self.config.grab_distance)
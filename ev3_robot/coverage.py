@@ -0,0 +1,159 @@
+from math import cos, pi, sin
+
+
+def normalize_angle(angle: float) -> float:
+    """
+    Wraps an angle in radians to [-pi, pi).
+    """
+    return (angle + pi) % (2 * pi) - pi
+
+
+class Odometry(object):
+    """
+    Dead-reckons the pose of the robot from the tacho counts of its wheel
+    motors. x and y are in meters from where tracking started, heading is in
+    radians, counterclockwise, starting at 0. The estimate drifts with wheel
+    slip, which is fine for remembering roughly where the robot has been.
+    When the robot has a gyro, its heading replaces the one from the wheels,
+    which drifts the most.
+    """
+
+    def __init__(self, wheel_diameter: float = 0.056, wheel_base: float = 0.12, counts_per_rot: int = 360) -> None:
+        self.meters_per_count = pi * wheel_diameter / counts_per_rot
+        self.wheel_base = wheel_base
+        self.x = 0
+        self.y = 0
+        self.heading = 0
+        self.heading_offset = 0
+        self.last_positions = None
+
+    def update(self, left_position: int, right_position: int, heading: float = None):
+        if self.last_positions is None:
+            self.last_positions = (left_position, right_position)
+            if heading is not None:
+                self.heading_offset = heading
+            return
+
+        left = (left_position - self.last_positions[0]) * self.meters_per_count
+        right = (right_position - self.last_positions[1]) * self.meters_per_count
+        self.last_positions = (left_position, right_position)
+
+        distance = (left + right) / 2
+        rotation = (right - left) / self.wheel_base
+        if heading is not None:
+            rotation = normalize_angle(heading - self.heading_offset - self.heading)
+
+        # Moving along the mean heading of the step is exact for arcs.
+        self.x += distance * cos(self.heading + rotation / 2)
+        self.y += distance * sin(self.heading + rotation / 2)
+        self.heading = normalize_angle(self.heading + rotation)
+
+
+class OccupancyGrid(object):
+    """
+    A sparse grid of the floor, with square cells of cell_size meters. It
+    remembers how often the robot was in each cell and which cells the
+    ultrasonic sensor saw an obstacle in. Only touched cells are stored, so
+    the grid grows with the explored area, not with the size of the room.
+    """
+
+    def __init__(self, cell_size: float = 0.1) -> None:
+        self.cell_size = cell_size
+        self.visits = {}
+        self.obstacles = set()
+
+    def cell(self, x: float, y: float):
+        return (int(x // self.cell_size), int(y // self.cell_size))
+
+    def mark_visited(self, x: float, y: float, radius: float = 0):
+        """
+        Marks the cells the robot covers when its center is at x, y and it
+        is radius meters wide to each side.
+        """
+        xmin, ymin = self.cell(x - radius, y - radius)
+        xmax, ymax = self.cell(x + radius, y + radius)
+
+        for i in range(xmin, xmax + 1):
+            for j in range(ymin, ymax + 1):
+                cell = (i, j)
+                self.visits[cell] = self.visits.get(cell, 0) + 1
+                # The robot drove through it, so whatever was seen there is
+                # gone or was a bad reading.
+                self.obstacles.discard(cell)
+
+    def mark_obstacle(self, x: float, y: float):
+        cell = self.cell(x, y)
+        if cell not in self.visits:
+            self.obstacles.add(cell)
+
+    def is_visited(self, cell) -> bool:
+        return cell in self.visits
+
+    def is_obstacle(self, cell) -> bool:
+        return cell in self.obstacles
+
+
+class CoveragePlanner(object):
+    """
+    Picks the heading to roam in. Every candidate heading is scored by the
+    unvisited cells on a ray of lookahead meters from the robot, up to the
+    first known obstacle, so the robot heads toward unexplored floor and
+    away from walls it has already found. Among equal candidates the one
+    needing the smallest turn wins.
+    """
+
+    def __init__(self, grid: OccupancyGrid, lookahead: float = 1.5, headings: int = 16,
+                 min_clearance: float = 0.3) -> None:
+        self.grid = grid
+        self.lookahead = lookahead
+        self.headings = headings
+        self.min_clearance = min_clearance
+
+    def score(self, x: float, y: float, heading: float):
+        """
+        Returns the number of unvisited cells and the free distance in
+        meters along the heading.
+        """
+        step = self.grid.cell_size
+        unvisited = 0
+        seen = set()
+        distance = step
+
+        while distance <= self.lookahead:
+            cell = self.grid.cell(x + distance * cos(heading), y + distance * sin(heading))
+            if self.grid.is_obstacle(cell):
+                return (unvisited, distance - step)
+
+            if cell not in seen:
+                seen.add(cell)
+                if not self.grid.is_visited(cell):
+                    unvisited += 1
+
+            distance += step
+
+        return (unvisited, self.lookahead)
+
+    def choose_heading(self, x: float, y: float, current_heading: float, exclude: float = None) -> float:
+        """
+        The most promising heading, in radians. Headings within 45 degrees of
+        exclude, e.g. the direction of an obstacle that was just seen, are
+        skipped.
+        """
+        best = None
+        best_key = None
+
+        for i in range(self.headings):
+            heading = normalize_angle(current_heading + 2 * pi * i / self.headings)
+            if exclude is not None and abs(normalize_angle(heading - exclude)) < pi / 4:
+                continue
+
+            unvisited, clearance = self.score(x, y, heading)
+            turn = abs(normalize_angle(heading - current_heading))
+            key = (clearance >= self.min_clearance, unvisited, clearance, -turn)
+
+            if best_key is None or key > best_key:
+                best = heading
+                best_key = key
+
+        return best if best is not None else normalize_angle(current_heading + pi)
+
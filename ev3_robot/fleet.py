@@ -0,0 +1,74 @@
+import json
+from threading import Condition
+from typing import Callable, Dict, List
+
+from paho.mqtt.client import Client as MQTTClient, MQTTMessage
+
+
+class FleetRegistry(object):
+    """
+    Keeps track of every robot on the broker. Each robot publishes a retained
+    presence message on <presence_topic>/<robot_id> (see Connection), so a
+    registry that subscribes late still receives the current state of the
+    whole fleet right away.
+    """
+
+    on_presence_change = None
+
+    def __init__(self, client: MQTTClient, presence_topic: str = "fleet/presence"):
+        self.client = client
+        self.presence_topic = presence_topic
+        self.robots = {}
+        self.cv = Condition()
+
+    def start(self) -> None:
+        """
+        Subscribes to the presence topics. Must be called once the client is
+        connected to the broker.
+        """
+        topic = "{}/+".format(self.presence_topic)
+        self.client.message_callback_add(topic, self.__on_presence_message())
+        self.client.subscribe(topic, 1)
+
+    def stop(self) -> None:
+        topic = "{}/+".format(self.presence_topic)
+        self.client.unsubscribe(topic)
+        self.client.message_callback_remove(topic)
+
+    def get_robots(self, state: str = None) -> Dict[str, dict]:
+        with self.cv:
+            return {
+                robot_id: presence for robot_id, presence in self.robots.items()
+                if state is None or presence.get("state") == state
+            }
+
+    def wait_for(self, robot_ids: List[str], state: str, timeout: float = None) -> bool:
+        """
+        Blocks until all given robots report the given state.
+        """
+        def all_in_state():
+            return all(self.robots.get(robot_id, {}).get("state") == state for robot_id in robot_ids)
+
+        with self.cv:
+            return self.cv.wait_for(all_in_state, timeout)
+
+    def __on_presence_message(self) -> Callable[[MQTTClient, None, MQTTMessage], None]:
+        def on_message(client: MQTTClient, userdata: None, msg: MQTTMessage) -> None:
+            robot_id = msg.topic[len(self.presence_topic) + 1:]
+
+            with self.cv:
+                # An empty retained message removes the robot from the
+                # registry.
+                if len(msg.payload) == 0:
+                    self.robots.pop(robot_id, None)
+                    presence = None
+                else:
+                    presence = json.loads(msg.payload.decode("utf-8"))
+                    self.robots[robot_id] = presence
+
+                self.cv.notify_all()
+
+            if self.on_presence_change is not None:
+                self.on_presence_change(robot_id, presence)
+
+        return on_message
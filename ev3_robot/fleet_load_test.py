@@ -0,0 +1,203 @@
+"""
+Load test for the fleet connection layer. For every fleet size it starts that
+many simulated robots (the real Connection class without motors) and as many
+simulated controllers on one broker, runs the init_con/con_ok handshake
+between every pair and then streams move commands. It reports the handshake
+latency and the message rate the broker sustained.
+
+Run it against a test broker, e.g. the one from docker-compose:
+    python3 fleet_load_test.py --host localhost --fleet_sizes 1 10 50
+"""
+import argparse
+import json
+import threading
+from time import sleep, time
+from uuid import uuid4
+
+from paho.mqtt.client import Client as MQTTClient
+
+from connection import Connection, ConnectionConfig
+from fleet import FleetRegistry
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default='localhost')
+    parser.add_argument('--port', type=int, default=1883)
+    parser.add_argument('--topic_connect', type=str, default='loadtest/connect')
+    parser.add_argument('--topic_control', type=str, default='loadtest/control')
+    parser.add_argument('--topic_presence', type=str, default='loadtest/presence')
+    parser.add_argument('--fleet_sizes', type=int, nargs='+', default=[1, 5, 10, 25, 50])
+    parser.add_argument('--rate', type=float, default=10, help='move commands per second per controller')
+    parser.add_argument('--duration', type=float, default=5, help='seconds to stream commands for')
+    return parser.parse_args()
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class SimulatedRobot(object):
+
+    def __init__(self, args, robot_id: str):
+        self.config = ConnectionConfig(
+            args.host, args.port, 60, args.topic_connect, args.topic_control, robot_id, args.topic_presence
+        )
+        self.connection = Connection(self.config)
+        self.connection.on_control_message = self.on_control_message
+        self.connected_at = None
+        self.received = 0
+        self.delivery_latencies = []
+
+    def start(self):
+        def runner():
+            self.connection.establish()
+            self.connected_at = time()
+
+        thread = threading.Thread(target=runner)
+        thread.daemon = True
+        thread.start()
+
+    def on_control_message(self, payload: str):
+        self.received += 1
+        sent_at = json.loads(payload)["metadata"].get("sent_at")
+        if sent_at is not None:
+            self.delivery_latencies.append(time() - sent_at)
+
+
+class SimulatedController(object):
+    """
+    Implements the controller side of the handshake, like the web-controller
+    does, for a single robot.
+    """
+
+    def __init__(self, args, robot: SimulatedRobot):
+        self.robot = robot
+        self.client_id = "loadtest-controller-{}".format(uuid4().hex[:8])
+        self.client = MQTTClient(self.client_id)
+        self.client.on_message = self.on_message
+        self.client.connect(args.host, args.port, 60)
+        self.client.loop_start()
+        self.init_sent_at = None
+
+    def start_handshake(self):
+        connection_topic = self.robot.config.connection_topic
+        self.client.subscribe(connection_topic, 2)
+        # Give the subscription time to land before the reply arrives.
+        sleep(0.05)
+        self.init_sent_at = time()
+        self.client.publish(connection_topic, "init_con:{}".format(self.client_id), 2)
+
+    def on_message(self, client, userdata, msg):
+        payload = msg.payload.decode("utf-8")
+        prefix = "con_ok:"
+        if payload.startswith(prefix) and payload[len(prefix):] == self.robot.config.client_id:
+            client.publish(
+                self.robot.config.connection_topic,
+                "con_ok:{}:{}".format(self.client_id, self.robot.config.client_id),
+                2
+            )
+
+    def send_move(self):
+        self.client.publish(
+            "{}/{}".format(self.robot.config.control_topic_prefix, self.client_id),
+            json.dumps({"command": "move", "metadata": {"x": 0, "y": 0.2, "sent_at": time()}})
+        )
+
+    def stop(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+
+def run_fleet(args, registry: FleetRegistry, size: int):
+    run_id = uuid4().hex[:6]
+    robots = [SimulatedRobot(args, "sim-{}-{}".format(run_id, i)) for i in range(size)]
+    robot_ids = [robot.config.robot_id for robot in robots]
+
+    for robot in robots:
+        robot.start()
+
+    if not registry.wait_for(robot_ids, Connection.PRESENCE_AVAILABLE, timeout=30):
+        print("{:>4} robots: not all robots came online".format(size))
+        return
+
+    controllers = [SimulatedController(args, robot) for robot in robots]
+    for controller in controllers:
+        controller.start_handshake()
+
+    if not registry.wait_for(robot_ids, Connection.PRESENCE_CONNECTED, timeout=30):
+        print("{:>4} robots: not all handshakes finished".format(size))
+
+    handshakes = [
+        robot.connected_at - controller.init_sent_at
+        for robot, controller in zip(robots, controllers) if robot.connected_at is not None
+    ]
+
+    start = time()
+    sent = 0
+    while time() - start < args.duration:
+        tick = time()
+        for controller in controllers:
+            controller.send_move()
+            sent += 1
+        sleep(max(0, 1 / args.rate - (time() - tick)))
+    # Let the last commands arrive.
+    sleep(0.5)
+    elapsed = time() - start
+
+    received = sum(robot.received for robot in robots)
+    latencies = [latency for robot in robots for latency in robot.delivery_latencies]
+
+    print("{:>4} robots: handshake p50 {:.1f} ms, p95 {:.1f} ms | {:.0f} msg/s sent, {:.0f} msg/s delivered "
+          "({:.1%}), delivery p95 {:.1f} ms".format(
+              size,
+              percentile(handshakes, 0.5) * 1000 if handshakes else float("nan"),
+              percentile(handshakes, 0.95) * 1000 if handshakes else float("nan"),
+              sent / elapsed,
+              received / elapsed,
+              received / sent if sent else 0,
+              percentile(latencies, 0.95) * 1000 if latencies else float("nan")
+          ))
+
+    for controller in controllers:
+        controller.stop()
+    for robot in robots:
+        robot.connection.disconnect()
+        # Clear the retained presence so the simulated robots do not linger
+        # in the registry of real controllers.
+        registry.client.publish(robot.config.presence_topic, b"", 1, True)
+
+
+def main():
+    args = arg_parser()
+
+    client = MQTTClient("loadtest-registry-{}".format(uuid4().hex[:8]))
+    client.connect(args.host, args.port, 60)
+    client.loop_start()
+
+    broker_load = {}
+
+    def on_sys_message(client, userdata, msg):
+        broker_load[msg.topic] = msg.payload.decode("utf-8")
+
+    # Mosquitto reports its own message rate on $SYS every sys_interval.
+    client.message_callback_add("$SYS/broker/load/messages/#", on_sys_message)
+    client.subscribe("$SYS/broker/load/messages/#")
+
+    registry = FleetRegistry(client, args.topic_presence)
+    registry.start()
+
+    for size in args.fleet_sizes:
+        run_fleet(args, registry, size)
+
+    for topic in sorted(broker_load):
+        if topic.endswith("1min"):
+            print("{}: {}".format(topic, broker_load[topic]))
+
+    client.disconnect()
+    client.loop_stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,17 @@
 from controller import RobotConfig, RobotController
 from ev3dev2.motor import LargeMotor, MediumMotor, OUTPUT_A, OUTPUT_B, OUTPUT_C
-from ev3dev2.sensor import INPUT_2
-from ev3dev2.sensor.lego import UltrasonicSensor
+from ev3dev2.sensor import INPUT_1, INPUT_2, INPUT_3, INPUT_4
+from ev3dev2.sensor.lego import GyroSensor, UltrasonicSensor
 from os import path
+from time import perf_counter
 import yaml
 
 from connection import Connection, ConnectionConfig
+from logger import LoggingConfig, start_logging
+from metrics import REGISTRY
 from msg_parser import CommandFactory
 from robot import Robot
+from telemetry import TelemetryPublisher
 
 
 CONFIG_NAME = "config.yml"
@@ -66,14 +70,36 @@ def load_config() -> ConnectionConfig:
         parsed_config["mqtt_server"].get("port"),
         parsed_config["mqtt_server"].get("keep_alive"),
         parsed_config["mqtt_server"].get("topic_connect"),
-        parsed_config["mqtt_server"].get("topic_control")
+        parsed_config["mqtt_server"].get("topic_control"),
+        parsed_config["mqtt_server"].get("robot_id"),
+        parsed_config["mqtt_server"].get("topic_presence") or "fleet/presence",
+        parsed_config["mqtt_server"].get("reconnect_min_delay") or 0.1,
+        parsed_config["mqtt_server"].get("reconnect_max_delay") or 2
     )
 
     robot_config = RobotConfig(
-        parsed_config["robot"].get("grab_distance")
+        parsed_config["robot"].get("grab_distance"),
+        parsed_config["robot"].get("watchdog_interval") or 0.5,
+        parsed_config["robot"].get("metrics_interval"),
+        parsed_config["robot"].get("roam_strategy") or RobotConfig.ROAM_COVERAGE,
+        parsed_config["robot"].get("wheel_diameter") or 0.056,
+        parsed_config["robot"].get("wheel_base") or 0.12,
+        parsed_config["robot"].get("cell_size") or 0.1,
+        parsed_config["robot"].get("turn_mode") or "first_clear",
+        parsed_config["robot"].get("turn_clearance") or 50,
+        parsed_config["robot"].get("gyro_port"),
+        parsed_config["robot"].get("telemetry_rate"),
+        parsed_config["robot"].get("telemetry_batch") or 3
     )
 
-    return (connection_config, robot_config)
+    logging_config = parsed_config.get("logging") or {}
+    logging_config = LoggingConfig(
+        logging_config.get("level") or "INFO",
+        logging_config.get("rate") or 1,
+        logging_config.get("burst") or 5
+    )
+
+    return (connection_config, robot_config, logging_config)
 
 
 def main():
@@ -81,13 +107,21 @@ def main():
     if config is None:
         return
 
-    mqtt_config, robot_config = config
+    mqtt_config, robot_config, logging_config = config
+
+    start_logging(logging_config.level, logging_config.rate, logging_config.burst)
+
+    gyro_sensor = None
+    if robot_config.gyro_port is not None:
+        gyro_sensor = GyroSensor([INPUT_1, INPUT_2, INPUT_3, INPUT_4][robot_config.gyro_port - 1])
+        gyro_sensor.mode = GyroSensor.MODE_GYRO_ANG
 
     robot = Robot(
         LargeMotor(OUTPUT_A),
         LargeMotor(OUTPUT_C),
         MediumMotor(OUTPUT_B),
-        UltrasonicSensor(INPUT_2)
+        UltrasonicSensor(INPUT_2),
+        gyro_sensor
     )
     cmd_factory = CommandFactory()
     robot_controller = RobotController(robot, cmd_factory, robot_config)
@@ -98,8 +132,34 @@ def main():
 
     connection.establish()
 
+    telemetry = None
+    if robot_config.telemetry_rate:
+        telemetry = TelemetryPublisher(
+            connection.publish_telemetry,
+            robot_config.telemetry_rate,
+            robot_config.telemetry_batch
+        )
+
+    interval_histogram = REGISTRY.histogram("loop_interval_seconds", "Time between the starts of two control loop iterations")
+    update_histogram = REGISTRY.histogram("update_seconds", "Time spent in one control loop update")
+    last_start = None
+    last_metrics = perf_counter()
+
     while True:
+        start = perf_counter()
+        if last_start is not None:
+            interval_histogram.record(start - last_start)
+        last_start = start
+
         robot_controller.update()
+        update_histogram.record(perf_counter() - start)
+
+        if telemetry is not None:
+            telemetry.update(robot_controller)
+
+        if robot_config.metrics_interval and start - last_metrics >= robot_config.metrics_interval:
+            last_metrics = start
+            connection.publish_metrics(REGISTRY.snapshot())
 
     # connection.disconnect()
 
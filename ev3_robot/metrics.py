@@ -0,0 +1,197 @@
+import math
+from threading import Lock
+from time import time
+
+
+class Counter(object):
+
+    def __init__(self, name: str, help: str) -> None:
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.lock = Lock()
+
+    def inc(self, amount: float = 1):
+        with self.lock:
+            self.value += amount
+
+    def render(self) -> list:
+        return [
+            "# HELP {}_total {}".format(self.name, self.help),
+            "# TYPE {}_total counter".format(self.name),
+            "{}_total {}".format(self.name, self.value),
+        ]
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge(object):
+
+    def __init__(self, name: str, help: str) -> None:
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def set(self, value: float):
+        self.value = value
+
+    def render(self) -> list:
+        return [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} gauge".format(self.name),
+            "{} {}".format(self.name, self.value),
+        ]
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram(object):
+    """
+    A latency histogram in the spirit of HdrHistogram: values are counted in
+    logarithmic buckets, so recording is a single dictionary update and every
+    percentile is accurate to the bucket precision (2% by default) no matter
+    how large the range of values is.
+    """
+
+    QUANTILES = [0.5, 0.9, 0.99, 0.999]
+
+    def __init__(self, name: str, help: str, precision: float = 0.02, lowest: float = 1e-6) -> None:
+        self.name = name
+        self.help = help
+        self.lowest = lowest
+        self.log_base = math.log(1 + precision)
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.buckets = {}
+            self.count = 0
+            self.sum = 0
+            self.max = 0
+
+    def record(self, value: float):
+        index = int(math.log(max(value, self.lowest) / self.lowest) / self.log_base)
+
+        with self.lock:
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, quantile: float) -> float:
+        with self.lock:
+            if self.count == 0:
+                return 0
+
+            rank = quantile * self.count
+            seen = 0
+            for index in sorted(self.buckets):
+                seen += self.buckets[index]
+                if seen >= rank:
+                    # The upper edge of the bucket, capped at the largest
+                    # recorded value.
+                    return min(self.max, self.lowest * math.exp((index + 1) * self.log_base))
+
+            return self.max
+
+    def render(self) -> list:
+        lines = [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} summary".format(self.name),
+        ]
+        for quantile in Histogram.QUANTILES:
+            lines.append('{}{{quantile="{}"}} {}'.format(self.name, quantile, self.percentile(quantile)))
+        lines.append("{}_sum {}".format(self.name, self.sum))
+        lines.append("{}_count {}".format(self.name, self.count))
+        return lines
+
+    def snapshot(self):
+        snapshot = {"count": self.count, "sum": self.sum, "max": self.max}
+        for quantile in Histogram.QUANTILES:
+            snapshot["p{:g}".format(quantile * 100)] = self.percentile(quantile)
+        return snapshot
+
+
+class MetricsRegistry(object):
+    """
+    Holds every metric of the process. Metrics are created once, usually at
+    import time, and updating them is cheap enough for the per-frame path.
+    """
+
+    def __init__(self) -> None:
+        self.metrics = {}
+        self.lock = Lock()
+
+    def counter(self, name: str, help: str = "") -> Counter:
+        return self.__get_or_create(Counter, name, help)
+
+    def gauge(self, name: str, help: str = "") -> Gauge:
+        return self.__get_or_create(Gauge, name, help)
+
+    def histogram(self, name: str, help: str = "") -> Histogram:
+        return self.__get_or_create(Histogram, name, help)
+
+    def render(self) -> str:
+        """
+        Renders all metrics in the Prometheus text format.
+        """
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        snapshot = {name: metric.snapshot() for name, metric in self.metrics.items()}
+        snapshot["timestamp"] = time()
+        return snapshot
+
+    def __get_or_create(self, metric_type, name: str, help: str):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = metric_type(name, help)
+
+            metric = self.metrics[name]
+            if not isinstance(metric, metric_type):
+                raise ValueError("Metric '{}' already exists as a {}".format(name, type(metric).__name__))
+
+            return metric
+
+
+class RateMeter(object):
+    """
+    Keeps a gauge at the smoothed rate of an event, e.g. frames per second.
+    """
+
+    SMOOTHING = 0.1
+
+    def __init__(self, gauge: Gauge) -> None:
+        self.gauge = gauge
+        self.last = None
+        self.interval = None
+
+    def tick(self, now: float) -> float:
+        """
+        Records an event and returns the seconds since the previous one.
+        """
+        if self.last is None:
+            self.last = now
+            return 0
+
+        elapsed = now - self.last
+        self.last = now
+        if self.interval is None:
+            self.interval = elapsed
+        else:
+            self.interval += RateMeter.SMOOTHING * (elapsed - self.interval)
+
+        if self.interval > 0:
+            self.gauge.set(1 / self.interval)
+
+        return elapsed
+
+
+REGISTRY = MetricsRegistry()
@@ -11,6 +11,15 @@ class CommandFactory:
         self.command_dict = json.loads(msg)
         cmd = self.command_dict.get("command", "")
         metadata = self.command_dict.get("metadata", {})
+
+        command = self.create_command(cmd, metadata)
+        if command is not None:
+            command.sent_at = self.command_dict.get("sent_at")
+            command.deadline = self.command_dict.get("deadline")
+
+        return command
+
+    def create_command(self, cmd, metadata):
         if cmd == "move":
             return MoveCoordCommand(cmd, metadata)
         elif cmd == "stop":
@@ -27,6 +36,8 @@ class CommandFactory:
             return ArmResetPositionCommand(cmd, metadata)
         elif cmd == "arm_set_position":
             return ArmSetPositionCommand(cmd, metadata)
+        elif cmd == "trajectory":
+            return TrajectoryCommand(cmd, metadata)
         elif cmd == "switch_state":
             return SwitchControllerState(cmd, metadata)
         elif cmd == "set_ai_active":
@@ -36,6 +47,12 @@ class CommandFactory:
 
 
 class Command:
+    # The controller's clock when the command was sent, and the time (on the
+    # same clock) after which it must not be executed anymore. Both are None
+    # for senders that do not stamp their commands.
+    sent_at = None
+    deadline = None
+
     def __init__(self,  command, metadata):
         self.command = command
         self.metadata = metadata
@@ -73,6 +90,22 @@ class MoveCoordCommand(Command):
         return "MoveCoordCommand"
 
 
+class TrajectoryCommand(Command):
+    # When the first segment starts on our clock, None to start when it is
+    # executed.
+    start_at = None
+
+    def __init__(self, command: str, metadata: dict):
+        super().__init__(command, metadata)
+        self.segments = [(duration, x, y) for duration, x, y in metadata.get("segments", [])]
+
+    def execute(self, robot: Robot):
+        robot.follow_trajectory(self.segments, self.start_at)
+
+    def to_string(self):
+        return "TrajectoryCommand({} segments)".format(len(self.segments))
+
+
 class ArmInCommand(Command):
     def __init__(self, command: str, metadata: dict):
         super().__init__(command, metadata)
@@ -1,48 +1,178 @@
+import logging
 import math
 import time
 
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+sensor_histogram = REGISTRY.histogram("sensor_read_seconds", "Time taken by one ultrasonic sensor reading")
+
 
 class Robot:
-    def __init__(self, left_motor, right_motor, rotate_motor,ultrasonic_sensor):
+    # How fast a wheel makes up for falling behind or running ahead of the
+    # trajectory, in 1/s: 10 degrees behind adds 20 degrees/s.
+    TRAJECTORY_GAIN = 2
+    # The most a wheel may fall behind, in degrees, so a blocked wheel does
+    # not race off once it is free.
+    MAX_TRAJECTORY_LAG = 90
+    # The smallest speed change, as a share of the max speed, that is
+    # written to the motors.
+    MIN_SPEED_CHANGE = 0.02
+    # The arm moves of a grab relative to where it is, in degrees: out, then
+    # back in past the start. None returns it to the set position.
+    GRAB_STEPS = [-720, 1080, None]
+    # The seconds a step of the grab may take at most, and the seconds
+    # before the motor state is trusted to show that the step is running.
+    GRAB_STEP_TIMEOUT = 3
+    GRAB_STEP_SETTLE = 0.1
+
+    def __init__(self, left_motor, right_motor, rotate_motor,ultrasonic_sensor, gyro_sensor=None):
         self.left_motor = left_motor
         self.right_motor = right_motor
         self.rotate_motor = rotate_motor
         self.ultrasonic_sensor = ultrasonic_sensor
+        self.gyro_sensor = gyro_sensor
         self.arm_position = 0
+        self.last_distance = None
+        self.last_distance_at = None
+        self.trajectory = None
+        self.trajectory_start = None
+        self.trajectory_targets = None
+        self.trajectory_updated_at = None
+        self.wheel_speeds = None
+        self.grab_steps = None
+        self.grab_speed = None
+        self.grab_step_at = None
 
     def get_distance_reading(self) -> float:
-        return self.ultrasonic_sensor.distance_centimeters
+        start = time.perf_counter()
+        distance = self.ultrasonic_sensor.distance_centimeters
+        sensor_histogram.record(time.perf_counter() - start)
+        self.last_distance = distance
+        self.last_distance_at = start
+        return distance
+
+    def get_recent_distance_reading(self, max_age: float) -> float:
+        """
+        The last distance reading if it is at most max_age seconds old, a new
+        one otherwise.
+        """
+        if self.last_distance_at is not None and time.perf_counter() - self.last_distance_at <= max_age:
+            return self.last_distance
+
+        return self.get_distance_reading()
 
     def run(self, speed):
-        if self.ultrasonic_sensor.distance_centimeters < 20:
-            print("Object infront!!!")
+        if self.get_distance_reading() < 20:
+            logger.warning("Object infront!!!")
 
+        self.trajectory = None
+        self.wheel_speeds = None
         self.left_motor.speed_sp = speed * self.left_motor.max_speed
         self.right_motor.speed_sp = speed * self.right_motor.max_speed
         self.run_motors()
 
 
+    def get_wheel_positions(self):
+        """
+        The tacho counts of the left and right wheel motors, in degrees.
+        """
+        return (self.left_motor.position, self.right_motor.position)
+
+    def get_gyro_heading(self):
+        """
+        The heading in radians, counterclockwise, or None without a gyro.
+        """
+        if self.gyro_sensor is None:
+            return None
+
+        # The gyro counts degrees clockwise.
+        return -math.radians(self.gyro_sensor.angle)
+
     def stop(self):
+        self.trajectory = None
+        self.wheel_speeds = None
         self.left_motor.stop(stop_action="brake")
         self.right_motor.stop(stop_action="brake")
 
     def moving_in_coord(self, x, y):
-        speed = math.sqrt(y ** 2 + x ** 2)
-        steering = 1 - 2 * abs(math.atan2(y, x) / math.pi)
-        if steering > 0:
-            self.left_motor.speed_sp = speed * self.left_motor.max_speed
-            self.right_motor.speed_sp = speed * \
-                self.right_motor.max_speed * (1 - int(steering) * 2)
-            self.run_motors()
-        elif steering == 0 and y < 0:
-            self.left_motor.speed_sp = speed * self.left_motor.max_speed * -1
-            self.right_motor.speed_sp = speed * self.right_motor.max_speed * -1
-            self.run_motors()
-        else:
-            self.left_motor.speed_sp = speed * \
-                self.left_motor.max_speed * (1 + int(steering) * 2)
-            self.right_motor.speed_sp = speed * self.right_motor.max_speed
-            self.run_motors()
+        """
+        Drives with x as steering and y as forward speed, both in [-1, 1]. A
+        pure x turns in place and a pure y drives straight, combined values
+        drive a curve.
+        """
+        self.trajectory = None
+        self.wheel_speeds = None
+
+        left, right = coord_to_wheels(x, y)
+        self.left_motor.speed_sp = left * self.left_motor.max_speed
+        self.right_motor.speed_sp = right * self.right_motor.max_speed
+        self.run_motors()
+
+    def follow_trajectory(self, segments, start_at=None):
+        """
+        Drives through the segments of (duration, x, y), with x and y as in
+        moving_in_coord, starting at start_at (time.time(), now if None).
+        Replaces the trajectory being followed, and stops at its end. The
+        trajectory is driven by update_trajectory(), which has to be called
+        from the control loop.
+        """
+        now = time.time()
+        self.trajectory = segments
+        self.trajectory_start = start_at if start_at is not None else now
+        # The wheels are held to where the plan says they should be, counted
+        # from where they are now, so a new plan continues without a jolt.
+        self.trajectory_targets = list(self.get_wheel_positions())
+        self.trajectory_updated_at = now
+        self.update_trajectory()
+
+    def update_trajectory(self):
+        """
+        Sets the wheel speeds of the current segment of the trajectory,
+        corrected by how far the tacho counts are from where the wheels
+        should be by now.
+        """
+        if self.trajectory is None:
+            return
+
+        now = time.time()
+        segment = None
+        elapsed = now - self.trajectory_start
+        for duration, x, y in self.trajectory:
+            if elapsed < duration:
+                segment = (x, y)
+                break
+            elapsed -= duration
+
+        if segment is None:
+            logger.info("Trajectory finished, stopping.")
+            self.stop()
+            return
+
+        dt = now - self.trajectory_updated_at
+        self.trajectory_updated_at = now
+
+        speeds = []
+        for i, (motor, wheel, position) in enumerate(zip(
+                (self.left_motor, self.right_motor),
+                coord_to_wheels(*segment),
+                self.get_wheel_positions())):
+            planned = wheel * motor.max_speed
+            target = self.trajectory_targets[i] + planned * dt
+            lag = max(-Robot.MAX_TRAJECTORY_LAG, min(Robot.MAX_TRAJECTORY_LAG, target - position))
+            self.trajectory_targets[i] = position + lag
+
+            speed = planned + Robot.TRAJECTORY_GAIN * lag
+            speeds.append(max(-motor.max_speed, min(motor.max_speed, speed)))
+
+        # Only talks to the motors when a speed changes noticeably.
+        threshold = Robot.MIN_SPEED_CHANGE * self.left_motor.max_speed
+        if self.wheel_speeds is not None and all(abs(a - b) < threshold for a, b in zip(speeds, self.wheel_speeds)):
+            return
+
+        self.wheel_speeds = speeds
+        self.left_motor.speed_sp, self.right_motor.speed_sp = speeds
+        self.run_motors()
 
     def run_motors(self):
         self.right_motor.run_forever()
@@ -52,17 +182,21 @@ class Robot:
         self.rotate_motor.run_forever()
 
     def arm_in(self, speed_sp=-300):
+        self.grab_steps = None
         self.rotate_motor.speed_sp = speed_sp
         self.arm_run()
 
     def arm_out(self, speed_sp=300):
+        self.grab_steps = None
         self.rotate_motor.speed_sp = speed_sp
         self.arm_run()
 
     def arm_stop(self):
+        self.grab_steps = None
         self.rotate_motor.stop(stop_action="brake")
 
     def arm_reset_position(self):
+        self.grab_steps = None
         self.rotate_motor.run_to_abs_pos(position_sp=self.arm_position)
 
     def arm_set_position(self):
@@ -72,9 +206,56 @@ class Robot:
         return self.rotate_motor.position
 
     def arm_grab(self, speed_sp=300):
+        """
+        Starts the grab without waiting for it: the arm goes back to its set
+        position and then through GRAB_STEPS. The grab is driven by
+        update_arm(), which has to be called from the control loop, and any
+        other arm command cancels it.
+        """
         self.arm_reset_position()
-        self.rotate_motor.run_to_rel_pos(position_sp=-720, speed_sp=speed_sp)
-        time.sleep(3)
-        self.rotate_motor.run_to_rel_pos(position_sp=1080, speed_sp=speed_sp)
-        time.sleep(3)
-        self.arm_reset_position()
+        self.grab_steps = list(Robot.GRAB_STEPS)
+        self.grab_speed = speed_sp
+        self.__start_grab_step()
+
+    def update_arm(self):
+        """
+        Starts the next step of the grab once the motor finished the current
+        one, or once it took GRAB_STEP_TIMEOUT seconds.
+        """
+        if self.grab_steps is None:
+            return
+
+        elapsed = time.time() - self.grab_step_at
+        if elapsed < Robot.GRAB_STEP_SETTLE or \
+                (elapsed < Robot.GRAB_STEP_TIMEOUT and "running" in self.rotate_motor.state):
+            return
+
+        if len(self.grab_steps) == 0:
+            self.grab_steps = None
+            return
+
+        self.__start_grab_step()
+
+    def __start_grab_step(self):
+        position = self.grab_steps.pop(0)
+        if position is None:
+            self.rotate_motor.run_to_abs_pos(position_sp=self.arm_position)
+        else:
+            self.rotate_motor.run_to_rel_pos(position_sp=position, speed_sp=self.grab_speed)
+        self.grab_step_at = time.time()
+
+def coord_to_wheels(x, y):
+    """
+    The left and right wheel speeds, as shares of the max speed, that drive
+    with x as steering and y as forward speed.
+    """
+    left = y + x
+    right = y - x
+
+    # Scale both wheels down together so the curve keeps its shape.
+    largest = max(abs(left), abs(right))
+    if largest > 1:
+        left /= largest
+        right /= largest
+
+    return (left, right)
@@ -0,0 +1,50 @@
+from time import time
+
+# The order of the values in a sample: the time it was taken, the ultrasonic
+# distance in cm, the left and right wheel and the arm motor positions in
+# degrees, and the controller state.
+FIELDS = ["t", "distance", "left", "right", "arm", "state"]
+
+
+class TelemetryPublisher(object):
+    """
+    Samples the sensors and motors rate times per second and publishes the
+    samples in batches of batch_size, as
+    {"fields": [...], "samples": [[...], ...]}. A change of the controller
+    state is published right away. The distance reading the control loop
+    took last is reused when it is recent enough, so the sensor is not read
+    more often than before.
+    """
+
+    def __init__(self, publish, rate: float = 10, batch_size: int = 3, clock=time) -> None:
+        self.publish = publish
+        self.interval = 1 / rate
+        self.batch_size = batch_size
+        self.clock = clock
+        self.samples = []
+        self.last_sample = None
+        self.last_state = None
+
+    def update(self, controller):
+        now = self.clock()
+        state = controller.state_name
+        if self.last_sample is not None and now - self.last_sample < self.interval and state == self.last_state:
+            return
+
+        robot = controller.robot
+        left, right = robot.get_wheel_positions()
+        self.samples.append([
+            round(now, 3),
+            round(robot.get_recent_distance_reading(self.interval), 1),
+            left,
+            right,
+            robot.arm_get_position(),
+            state
+        ])
+        self.last_sample = now
+
+        if len(self.samples) >= self.batch_size or state != self.last_state:
+            self.publish({"fields": FIELDS, "samples": self.samples})
+            self.samples = []
+
+        self.last_state = state
@@ -1,16 +1,29 @@
 from pycocotools.coco import COCO
-import numpy as np
 import tqdm
 import argparse
+import json
+import random
 import shutil
 import os
+import yaml
+
+
+# Used when no label map is given: only TACO category 5 ("Clear plastic
+# bottle") is converted, into YOLO class 0.
+DEFAULT_LABEL_TRANSFER = {5: 0}
+DEFAULT_CLASS_NAMES = ['PET (plastic) bottles']
 
 
 def arg_parser():
     parser = argparse.ArgumentParser('code by rbj')
     parser.add_argument('--annotation_path', type=str,
                         default='data/annotations.json')
+    parser.add_argument('--image_root', type=str, default='data')
     parser.add_argument('--save_base_path', type=str, default='data/taco/labels/')
+    parser.add_argument('--label_map', type=str, default=None,
+                        help='yaml file with the class mapping, see label_map.example.yml')
+    parser.add_argument('--val_ratio', type=float, default=None)
+    parser.add_argument('--seed', type=int, default=None)
     args = parser.parse_args()
     return args
 
@@ -23,14 +36,121 @@ def create_dir(path):
         os.makedirs(path)
 
 
+def load_label_map(label_map_path, categories):
+    """
+    Builds the lookup from COCO category id to YOLO class index. Each class in
+    the label map merges every category listed by name, id or supercategory.
+    Categories in the drop list are never converted, even if a class rule
+    matches them. Categories matching no rule are skipped and reported.
+    """
+    if label_map_path is None:
+        coco_to_label = {}
+        for index, c in enumerate(categories):
+            if index in DEFAULT_LABEL_TRANSFER:
+                coco_to_label[c['id']] = DEFAULT_LABEL_TRANSFER[index]
+        return coco_to_label, DEFAULT_CLASS_NAMES, set(), {}
+
+    with open(label_map_path, 'r') as label_map_file:
+        label_map = yaml.full_load(label_map_file)
+
+    def matches(category, rule):
+        return category['id'] in rule.get('ids', []) or \
+               category['name'] in rule.get('categories', []) or \
+               category.get('supercategory') in rule.get('supercategories', [])
+
+    drop_rule = label_map.get('drop', {})
+    class_names = []
+    coco_to_label = {}
+    dropped = set()
+
+    for class_index, class_rule in enumerate(label_map['classes']):
+        class_names.append(class_rule['name'])
+        for c in categories:
+            if matches(c, drop_rule):
+                dropped.add(c['id'])
+            elif matches(c, class_rule):
+                if c['id'] in coco_to_label:
+                    print("Category '{}' matches both '{}' and '{}', keeping the first.".format(
+                        c['name'], class_names[coco_to_label[c['id']]], class_rule['name']))
+                    continue
+                coco_to_label[c['id']] = class_index
+
+    return coco_to_label, class_names, dropped, label_map.get('split', {})
+
+
+def balanced_split(image_classes, class_num, val_ratio, seed):
+    """
+    Splits the converted images into train and val so every class keeps
+    roughly val_ratio of its images in val. Each image is bucketed by the
+    rarest class it contains, and every bucket is split on its own.
+    """
+    buckets = {}
+    for image_path, labels in image_classes.items():
+        rarest = min(labels, key=lambda label: class_num[label])
+        buckets.setdefault(rarest, []).append(image_path)
+
+    rng = random.Random(seed)
+    train, val = [], []
+    for label in sorted(buckets.keys()):
+        images = sorted(buckets[label])
+        rng.shuffle(images)
+        val_count = int(round(len(images) * val_ratio))
+        if val_count == 0 and len(images) > 1 and val_ratio > 0:
+            val_count = 1
+        val.extend(images[:val_count])
+        train.extend(images[val_count:])
+
+    return sorted(train), sorted(val)
+
+
+def write_manifests(output_path, class_names, class_num, class_images, skipped, train, val, image_classes):
+    with open(os.path.join(output_path, 'train.txt'), 'w') as fp:
+        fp.writelines(image + '\n' for image in train)
+    with open(os.path.join(output_path, 'val.txt'), 'w') as fp:
+        fp.writelines(image + '\n' for image in val)
+
+    def split_count(images, label):
+        return sum(1 for image in images if label in image_classes[image])
+
+    stats = {
+        'classes': {
+            name: {
+                'boxes': class_num.get(label, 0),
+                'images': class_images.get(label, 0),
+                'train_images': split_count(train, label),
+                'val_images': split_count(val, label),
+            } for label, name in enumerate(class_names)
+        },
+        'skipped': skipped,
+        'train_images': len(train),
+        'val_images': len(val),
+    }
+    with open(os.path.join(output_path, 'stats.json'), 'w') as fp:
+        json.dump(stats, fp, indent=2)
+
+    with open(os.path.join(output_path, 'dataset.yaml'), 'w') as fp:
+        yaml.dump({
+            'path': os.path.abspath(output_path),
+            'train': 'train.txt',
+            'val': 'val.txt',
+            'nc': len(class_names),
+            'names': class_names,
+        }, fp, sort_keys=False)
+
+    return stats
+
+
 if __name__ == '__main__':
-    label_transfer = {5: 0}
     class_num = {}
+    class_images = {}
+    image_classes = {}
+    skipped = {'dropped': 0, 'unmapped': 0, 'degenerate': 0}
 
     args = arg_parser()
     annotation_path = args.annotation_path
     save_base_path = args.save_base_path
     save_image_path = save_base_path.replace('labels', 'images')
+    output_path = os.path.dirname(os.path.normpath(save_base_path))
     create_dir(save_base_path)
     create_dir(save_image_path)
 
@@ -38,14 +158,11 @@ if __name__ == '__main__':
     catIds = data_source.getCatIds()
     categories = data_source.loadCats(catIds)
     categories.sort(key=lambda x: x['id'])
-    classes = {}
-    coco_labels = {}
-    coco_labels_inverse = {}
-    for c in categories:
-        coco_labels[len(classes)] = c['id']
-        coco_labels_inverse[c['id']] = len(classes)
-        classes[c['name']] = len(classes)
-        
+
+    coco_to_label, class_names, dropped, split_config = load_label_map(args.label_map, categories)
+    val_ratio = args.val_ratio if args.val_ratio is not None else split_config.get('val_ratio', 0.2)
+    seed = args.seed if args.seed is not None else split_config.get('seed', 0)
+
     img_ids = data_source.getImgIds()
     for index, img_id in tqdm.tqdm(enumerate(img_ids), desc='change .json file to .txt file'):
         img_info = data_source.loadImgs(img_id)[0]
@@ -54,41 +171,59 @@ if __name__ == '__main__':
         height = img_info['height']
         width = img_info['width']
 
-        save_path = save_base_path + file_name + '.txt'
-        is_exist = False
-        with open(save_path, mode='w') as fp:
-            annotation_id = data_source.getAnnIds(img_id)
-            boxes = np.zeros((0, 5))
-            if len(annotation_id) == 0:
-                fp.write('')
+        annotation_id = data_source.getAnnIds(img_id)
+        if len(annotation_id) == 0:
+            continue
+        annotations = data_source.loadAnns(annotation_id)
+
+        labels = set()
+        lines = ''
+        for annotation in annotations:
+            category_id = annotation['category_id']
+            if category_id in dropped:
+                skipped['dropped'] += 1
+                continue
+            if category_id not in coco_to_label:
+                skipped['unmapped'] += 1
                 continue
-            annotations = data_source.loadAnns(annotation_id)
-            lines = ''
-            for annotation in annotations:
-                label = coco_labels_inverse[annotation['category_id']]
-                if label in label_transfer.keys():
-                    is_exist = True
-                    box = annotation['bbox']
-                    # some annotations have basically no width / height, skip them
-                    if box[2] < 1 or box[3] < 1:
-                        continue
-                    # top_x,top_y,width,height---->cen_x,cen_y,width,height
-                    box[0] = round((box[0] + box[2] / 2) / width, 6)
-                    box[1] = round((box[1] + box[3] / 2) / height, 6)
-                    box[2] = round(box[2] / width, 6)
-                    box[3] = round(box[3] / height, 6)
-                    label = label_transfer[label]
-                    if label not in class_num.keys():
-                        class_num[label] = 0
-                    class_num[label] += 1
-                    lines = lines + str(label)
-                    for i in box:
-                        lines += ' ' + str(i)
-                    lines += '\n'
+
+            box = list(annotation['bbox'])
+            # some annotations have basically no width / height, skip them
+            if box[2] < 1 or box[3] < 1:
+                skipped['degenerate'] += 1
+                continue
+            # top_x,top_y,width,height---->cen_x,cen_y,width,height
+            box[0] = round((box[0] + box[2] / 2) / width, 6)
+            box[1] = round((box[1] + box[3] / 2) / height, 6)
+            box[2] = round(box[2] / width, 6)
+            box[3] = round(box[3] / height, 6)
+            label = coco_to_label[category_id]
+            if label not in class_num.keys():
+                class_num[label] = 0
+            class_num[label] += 1
+            labels.add(label)
+            lines = lines + str(label)
+            for i in box:
+                lines += ' ' + str(i)
+            lines += '\n'
+
+        if len(labels) == 0:
+            continue
+
+        with open(save_base_path + file_name + '.txt', mode='w') as fp:
             fp.writelines(lines)
-        if is_exist:
-            shutil.copy('data/{}'.format(img_info['file_name']), os.path.join(save_image_path, save_name))
-        else:
-            os.remove(save_path)
-    print(class_num)
-    print('finish')
\ No newline at end of file
+        image_path = os.path.join(save_image_path, save_name)
+        shutil.copy(os.path.join(args.image_root, img_info['file_name']), image_path)
+
+        image_classes[os.path.abspath(image_path)] = labels
+        for label in labels:
+            class_images[label] = class_images.get(label, 0) + 1
+
+    train, val = balanced_split(image_classes, class_num, val_ratio, seed)
+    stats = write_manifests(output_path, class_names, class_num, class_images, skipped, train, val, image_classes)
+
+    for name, class_stats in stats['classes'].items():
+        print('{}: {boxes} boxes in {images} images ({train_images} train / {val_images} val)'.format(
+            name, **class_stats))
+    print('skipped annotations: {}'.format(skipped))
+    print('finish')
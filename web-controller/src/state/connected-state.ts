@@ -14,6 +14,7 @@ export class ConnectedState implements ApplicationState, ControlStateListener {
 
     private movementStates: HTMLElement[] = [];
     private armStates: Element[] = [];
+    private overlaySource: EventSource | null = null;
 
     constructor(
         private camHost: Host,
@@ -35,6 +36,12 @@ export class ConnectedState implements ApplicationState, ControlStateListener {
         feedEl.src = `http://${this.camHost}/mjpeg`;
         cvFeed.src = `http://${this.cvHost}/mjpeg`;
 
+        const overlayCanvas = applicationUI.getApplicationElement("cv-feed")
+            .querySelector("canvas");
+        if (overlayCanvas) {
+            this.overlaySource = this.listenToOverlay(overlayCanvas);
+        }
+
         this.movementStates = this.getMovementStateElements(applicationUI);
 
         applicationUI.getApplicationElement("mqtt-address").textContent = this.controlConnection.host.toString();
@@ -61,6 +68,8 @@ export class ConnectedState implements ApplicationState, ControlStateListener {
     }
 
     onExit(application: Application, applicationUI: ApplicationUI): void {
+        this.overlaySource?.close();
+        this.overlaySource = null;
         this.movementStates = [];
         this.armStates = [];
         application.robotInput.clearHandlers();
@@ -86,8 +95,68 @@ export class ConnectedState implements ApplicationState, ControlStateListener {
         armStateEl?.style.setProperty("--opacity", "0.5");
     }
 
+    /**
+     * Draws the boxes the ai-controller sends when its overlay mode is
+     * "vector". In the other modes the endpoint answers 404, which ends the
+     * EventSource for good, and the boxes, if any, are part of the stream
+     * itself. When the connection drops, e.g. while the ai-controller
+     * restarts, the EventSource reconnects on its own.
+     */
+    private listenToOverlay(canvas: HTMLCanvasElement): EventSource {
+        const source = new EventSource(`http://${this.cvHost}/overlay`);
+
+        source.onmessage = event => {
+            const overlay: VectorOverlay = JSON.parse(event.data);
+            const context = canvas.getContext("2d");
+            if (!context) return;
+
+            canvas.width = canvas.clientWidth;
+            canvas.height = canvas.clientHeight;
+            context.clearRect(0, 0, canvas.width, canvas.height);
+            if (!overlay.width || !overlay.height) return;
+
+            const scaleX = canvas.width / overlay.width;
+            const scaleY = canvas.height / overlay.height;
+            context.lineWidth = 2;
+            context.font = "12px sans-serif";
+
+            overlay.boxes.forEach(box => {
+                context.strokeStyle = context.fillStyle = box.target ? "lime" : "blue";
+                context.strokeRect(
+                    box.xmin * scaleX,
+                    box.ymin * scaleY,
+                    (box.xmax - box.xmin) * scaleX,
+                    (box.ymax - box.ymin) * scaleY
+                );
+                context.fillText(`${box.label} ${box.conf.toFixed(2)}`, box.xmin * scaleX, box.ymin * scaleY - 2);
+            });
+        };
+
+        source.onerror = () => {
+            // Stale boxes are cleared until the overlay is back.
+            canvas.getContext("2d")?.clearRect(0, 0, canvas.width, canvas.height);
+        };
+
+        return source;
+    }
+
     private getMovementStateElements(applicationUI: ApplicationUI): HTMLElement[] {
         const containerEl = applicationUI.getApplicationElement("movement-states");
         return Array.from(containerEl.children) as HTMLElement[];
     }
 }
+
+interface VectorOverlay {
+    width: number | null;
+    height: number | null;
+    boxes: {
+        xmin: number;
+        ymin: number;
+        xmax: number;
+        ymax: number;
+        conf: number;
+        label: string;
+        target: boolean;
+    }[];
+    timestamp: number;
+}